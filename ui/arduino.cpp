@@ -8,6 +8,7 @@
  *  - Movement Commands (CMD:MOVE x,y) where x,y is the percentage of max to move in that direction (-1,1) for each
  *  - Debug Enable Commands (CMD:DEBUG TRUE)
  *  - Debug Enable Commands (CMD:DEBUG FALSE)
+ *  - Binary command frames (MOVE, STOP, DEBUG ON/OFF), 6 bytes each. Format is documented in ui/car_protocol.py
  * 
  *  Acknowledgments: 
  *  - FreeRTOS Blink_AnalogRead example served as the starting point for this code
@@ -73,6 +74,25 @@ TaskHandle_t updatePtr = NULL;
 // TaskMoveCar will read from the updateQueue and update its current movement order
 QueueHandle_t updateQueue = NULL;
 
+// Binary command frames (see ui/car_protocol.py): SYNC, VERSION << 4 | OPCODE, a, b, seq, CRC-8
+#define FRAME_SYNC 0xA5
+#define FRAME_VERSION 1
+#define FRAME_SIZE 6
+#define FRAME_SCALE 100.0
+#define OP_MOVE 0x1
+#define OP_STOP 0x2
+#define OP_DEBUG_ON 0x3
+#define OP_DEBUG_OFF 0x4
+
+byte frameBuf[FRAME_SIZE]; // frame being assembled
+int frameLen = 0;
+byte lastSeq = 0;
+
+// Old style ASCII commands ("CMD:...\n") are still accepted, assembled here byte by byte
+#define LINE_SIZE 32
+char lineBuf[LINE_SIZE];
+int lineLen = 0;
+
 ////////////////////////////////////////////////
 // CAR MANAGER VARIABLES
 ////////////////////////////////////////////////
@@ -179,41 +199,26 @@ void TaskCommunicationManager(void *pvParameters)
 
   updatePtr = NULL;
 
-  // Always want to be in a loop of waiting for CMDs from the server and then updating the current movement order and sending back an ACK
+  // Always want to be in a loop of reading commands from the server and updating the current movement order.
+  // Bytes are consumed as they arrive, so a partial command never blocks this task the way readStringUntil did.
   for (;;) {
-    // Wait for a CMD message from bluetooth serial (Blocking)
-    if (DEBUG) {
-      while(!Serial.available()) { // block until there is data to read
-        // Checking at a rate of 100Hz (100 times per second) so should be fast enough for real time, while waiting some time
-        vTaskDelay( 10 / portTICK_PERIOD_MS ); // wait for 10 ms, which frees up the time for the car to move
-      }
-    } else {
-      while(!HC06.available()) { // block until there is data to read
-        // Checking at a rate of 100Hz (100 times per second) so should be fast enough for real time, while waiting some time
-        vTaskDelay( 10 / portTICK_PERIOD_MS ); // wait for 10 ms, which frees up the time for the car to move
+    while (commAvailable()) {
+      byte b = commRead();
+      if (frameLen > 0 || b == FRAME_SYNC) { // binary frame (0xA5 never shows up in an ASCII command)
+        if (feedFrameByte(b)) {
+          handleFrame();
+        }
+      } else if (b == '\n') { // end of an ASCII command
+        lineBuf[lineLen] = '\0';
+        lineLen = 0;
+        handleCommand(String(lineBuf));
+      } else if (lineLen < LINE_SIZE - 1) {
+        lineBuf[lineLen++] = (char) b;
       }
     }
 
-    // Handle CMD message (in the form of "CMD:command\n")
-    String cmd = "";
-    if (DEBUG) {
-      cmd = Serial.readStringUntil('\n');
-    } else {
-      cmd = HC06.readStringUntil('\n');
-    }
-    debug(cmd);
-
-    // for each CMD message we must reply with a ACK message
-    // since the bluetooth chip isn't great and we aren't processing ACK commands rn
-    // it is not necesarry to reply.
-    if (cmd.startsWith("CMD: ")) { // command to update movement order
-      debug("Recevied Command");
-      processMoveOrder(cmd);
-      debug("ACK: MOVEORDER UPDATED");
-    } else { // unknown command
-      debug("Error Recevied Unknown Command: " + cmd);
-      debug("ACK:UNKNOWN CMD");
-    }
+    // Checking at a rate of 100Hz (100 times per second) so should be fast enough for real time, while waiting some time
+    vTaskDelay( 10 / portTICK_PERIOD_MS ); // wait for 10 ms, which frees up the time for the car to move
   }
 }
 
@@ -288,6 +293,127 @@ void communicationManagerSetup() {
   );
 }
 
+/**
+ * @brief Whether the active serial port (Serial in debug mode, otherwise the HC06) has bytes to read.
+ */
+bool commAvailable() {
+  if (DEBUG) {
+    return Serial.available() > 0;
+  }
+  return HC06.available() > 0;
+}
+
+/**
+ * @brief Reads one byte from the active serial port.
+ */
+byte commRead() {
+  if (DEBUG) {
+    return Serial.read();
+  }
+  return HC06.read();
+}
+
+/**
+ * @brief CRC-8 with polynomial 0x07 and initial value 0, same as crc8() in ui/car_protocol.py
+ */
+byte crc8(const byte *data, int len) {
+  byte crc = 0;
+  for (int i = 0; i < len; i++) {
+    crc ^= data[i];
+    for (int bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x80) ? (byte) ((crc << 1) ^ 0x07) : (byte) (crc << 1);
+    }
+  }
+  return crc;
+}
+
+/**
+ * @brief Adds one byte to the frame being assembled.
+ * 
+ * @return true once frameBuf holds a complete frame with a good version and CRC.
+ * A bad frame is not thrown away whole: parsing restarts from the next sync byte inside it.
+ */
+bool feedFrameByte(byte b) {
+  if (frameLen == 0 && b != FRAME_SYNC) {
+    return false;
+  }
+  frameBuf[frameLen++] = b;
+  if (frameLen < FRAME_SIZE) {
+    return false;
+  }
+
+  if ((frameBuf[1] >> 4) == FRAME_VERSION && crc8(frameBuf + 1, FRAME_SIZE - 2) == frameBuf[FRAME_SIZE - 1]) {
+    frameLen = 0;
+    return true;
+  }
+
+  debug("Error: Bad Frame");
+  int next = 1;
+  while (next < FRAME_SIZE && frameBuf[next] != FRAME_SYNC) {
+    next++;
+  }
+  frameLen = FRAME_SIZE - next;
+  memmove(frameBuf, frameBuf + next, frameLen);
+  return false;
+}
+
+/**
+ * @brief Handles the complete binary frame in frameBuf.
+ */
+void handleFrame() {
+  byte opcode = frameBuf[1] & 0x0F;
+  float a = ((int8_t) frameBuf[2]) / FRAME_SCALE;
+  float b = ((int8_t) frameBuf[3]) / FRAME_SCALE;
+  byte seq = frameBuf[4];
+
+  if (seq != (byte) (lastSeq + 1)) {
+    debug("Frames missed before seq " + String(seq));
+  }
+  lastSeq = seq;
+
+  if (opcode == OP_MOVE) {
+    queueMoveOrder(a, b);
+  } else if (opcode == OP_STOP) {
+    queueMoveOrder(0.0, 0.0);
+  } else if (opcode == OP_DEBUG_ON) {
+    DEBUG = true;
+  } else if (opcode == OP_DEBUG_OFF) {
+    DEBUG = false;
+  } else {
+    debug("Error Recevied Unknown Opcode");
+  }
+}
+
+/**
+ * @brief Sends a movement order to the car manager. The queue only holds one order, and a newer order
+ * replaces one the car manager hasn't picked up yet.
+ * 
+ * REFERENCE: FreeRTOS documentation
+ */
+void queueMoveOrder(float xVal, float yVal) {
+  movementOrder order = {xVal, yVal};
+  xQueueOverwrite(updateQueue, (void *) &order);
+}
+
+/**
+ * @brief Handles one ASCII command line (in the form of "CMD: x.x,y.y").
+ */
+void handleCommand(String cmd) {
+  debug(cmd);
+
+  // for each CMD message we must reply with a ACK message
+  // since the bluetooth chip isn't great and we aren't processing ACK commands rn
+  // it is not necesarry to reply.
+  if (cmd.startsWith("CMD: ")) { // command to update movement order
+    debug("Recevied Command");
+    processMoveOrder(cmd);
+    debug("ACK: MOVEORDER UPDATED");
+  } else { // unknown command
+    debug("Error Recevied Unknown Command: " + cmd);
+    debug("ACK:UNKNOWN CMD");
+  }
+}
+
 /**
  * @brief Proceses a move order and sends it to the update queue
  * 
@@ -307,16 +433,7 @@ void processMoveOrder(String cmd) {
   // xVal = -2.0;
   // yVal = -2.0;
 
-  // Create movement order
-  movementOrder order = {xVal, yVal};
-
-  // timeout = 0 aka an error has occured if we ever have to wait.
-  if (xQueueSendToBack(updateQueue, (void *) &order, (TickType_t) 0) != pdPASS) {
-    // error occured. For now there is no error handling, but can maybe try to restart the system as an expansion upon this project.
-    debug("Dropped Movement Order");
-  }
-  // wait for 10 ms, which frees up the time for the car to move
-  // vTaskDelay( 10 / portTICK_PERIOD_MS );
+  queueMoveOrder(xVal, yVal);
 }
 
 ////////////////////////////////////////////////
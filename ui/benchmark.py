@@ -0,0 +1,444 @@
+'''
+    benchmark.py
+    @brief     Times the gaze csv loaders and the batch control path against the recordings in sample_data/.
+
+    Compares the old ast.literal_eval converters with gaze_csv.read_gaze_csv, checks that both
+    produce the same frame, and prints the speedup. Checks that replay_gaze matches
+    preprocess_gaze / gaze_id / calculatePower_new3 row by row and times it on a long recording.
+
+    The allocation check runs the live path on SDK dictionaries and on a reused GazeSample under
+    tracemalloc, checks both give the same result and reports blocks kept and peak bytes per sample.
+    It fails unless preprocess_gaze on a GazeSample keeps 0 blocks per sample.
+
+    The hot path suite times every per-sample step of the control loop (csv loading, preprocess_gaze,
+    gaze_id, calculatePower_new2 / new3 and its lookup table, rescale_item, command encoding, latency tracing) on the
+    sample rows and reports per-call latency and samples/sec. Every path is timed next to a calibration
+    loop and the suite runs --rounds times, so a path's latency is compared as a multiple of the calibration
+    loop, the fastest of the rounds (load on the machine only ever makes a round slower). --save-baseline
+    writes the results to a json file (--add-new only adds paths it doesn't have yet); later runs compare
+    against it and exit with status 1 when a path is slower than the baseline by more than --threshold plus
+    the round to round spread, capped at --max-noise, both in the suite and when the flagged paths are
+    timed again.
+
+    Usage: python benchmark.py [sample_dir] [repeats] [--hot-only] [--save-baseline | --add-new] [--baseline FILE]
+                               [--threshold 0.25] [--max-noise 0.05] [--rounds 3]
+           python benchmark.py --allocations   (only the allocation check, exit status 1 if it fails)
+'''
+
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from utils import (safe_tuple_eval, build_dataset_from_csv, preprocess_gaze, gaze_id, rescale_item,
+                   calculatePower_new2, calculatePower_new3, replay_gaze, GazeSample)
+from gaze_csv import read_gaze_csv, load_gaze_frame
+from gaze_frame import GazeFrame
+from car_protocol import encode_power
+from eye_tracking import format_cmd
+from latency_trace import LatencyTracer
+from power_table import compile_power
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sample_data')
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# the loader build_dataset_from_csv used before gaze_csv, kept as the reference
+def literal_eval_loader(file_path, label):
+    tuples = ['left_gaze_point_on_display_area',
+    'left_gaze_point_in_user_coordinate_system',
+    'left_gaze_origin_in_user_coordinate_system',
+    'left_gaze_origin_in_trackbox_coordinate_system',
+    'right_gaze_point_on_display_area',
+    'right_gaze_point_in_user_coordinate_system',
+    'right_gaze_origin_in_user_coordinate_system',
+    'right_gaze_origin_in_trackbox_coordinate_system']
+    converters = {key: lambda s: safe_tuple_eval(s, default_value=None) for key in tuples}
+    df = pd.read_csv(file_path, converters=converters)
+    df['type'] = label
+    df['left_pupil_diameter'] = df['left_pupil_diameter'].fillna("None")
+    df['right_pupil_diameter'] = df['right_pupil_diameter'].fillna("None")
+    return df
+
+def split_loader(file_path, label):
+    return read_gaze_csv(file_path, label, split=True)
+
+def time_loader(loader, paths, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for path in paths:
+            loader(path, 'bench')
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def tiled_csv(paths, times, out_path):
+    """Writes the sample recordings repeated `times` times into one csv, the size of a real session."""
+    frames = [pd.read_csv(path, index_col=0) for path in paths]
+    pd.concat(frames * times, ignore_index=True).to_csv(out_path)
+    return out_path
+
+def report(title, paths, repeats):
+    old = time_loader(literal_eval_loader, paths, repeats)
+    new = time_loader(build_dataset_from_csv, paths, repeats)
+    split = time_loader(split_loader, paths, repeats)
+    print(title)
+    print(f"  literal_eval converters:        {old * 1000:9.2f} ms")
+    print(f"  read_gaze_csv (tuples):         {new * 1000:9.2f} ms  {old / new:6.1f}x")
+    print(f"  read_gaze_csv (split columns):  {split * 1000:9.2f} ms  {old / split:6.1f}x")
+
+def bench_csv_loaders(sample_dir=SAMPLE_DIR, repeats=20, tile=50):
+    paths = sorted(glob.glob(os.path.join(sample_dir, '*.csv')))
+    for path in paths:
+        pd.testing.assert_frame_equal(build_dataset_from_csv(path, 'bench'), literal_eval_loader(path, 'bench'))
+    report(f"{len(paths)} sample files, best of {repeats}", paths, repeats)
+
+    # the sample files are only a dozen rows each, so also time one session-sized file
+    with tempfile.TemporaryDirectory() as tmp:
+        big = tiled_csv(paths, tile, os.path.join(tmp, 'tiled.csv'))
+        rows = len(pd.read_csv(big))
+        report(f"sample files tiled {tile}x ({rows} rows), best of 3", [big], 3)
+
+def same_bits(a, b):
+    return np.float64(a).tobytes() == np.float64(b).tobytes()
+
+def check_batch_matches_scalar(sample_dir=SAMPLE_DIR):
+    """Asserts the batch functions reproduce the scalar ones bit-for-bit on every sample row."""
+    rows_checked = 0
+    for path in sorted(glob.glob(os.path.join(sample_dir, '*.csv'))):
+        frame = load_gaze_frame(path, dtype=np.float64)
+        regions, left, right, ok = replay_gaze(frame)
+        for i, sample in enumerate(frame.to_pandas(tuples=True).to_dict('records')):
+            gazexy = preprocess_gaze(sample)
+            if isinstance(gazexy, str): # rejected sample, preprocess_gaze returned "o1"
+                assert not ok[i] and regions[i] == gazexy, (path, i)
+                continue
+            scalar_left, scalar_right = calculatePower_new3(gazexy)
+            assert regions[i] == gaze_id(gazexy), (path, i)
+            assert same_bits(left[i], scalar_left) and same_bits(right[i], scalar_right), (path, i)
+            rows_checked += 1
+    return rows_checked
+
+def bench_replay(sample_dir=SAMPLE_DIR, hours=1, rate_hz=600):
+    paths = sorted(glob.glob(os.path.join(sample_dir, '*.csv')))
+    frames = [load_gaze_frame(path, dtype=np.float64) for path in paths]
+    n = hours * 3600 * rate_hz
+    names = frames[0].names
+    pooled = {name: np.concatenate([frame[name] for frame in frames]) for name in names}
+    reps = -(-n // len(pooled[names[0]]))
+    frame = GazeFrame({name: np.tile(col, reps)[:n] for name, col in pooled.items()})
+
+    start = time.perf_counter()
+    replay_gaze(frame)
+    elapsed = time.perf_counter() - start
+    print(f"replay_gaze: {n} samples ({hours} h at {rate_hz} Hz) in {elapsed * 1000:.1f} ms")
+
+################################################
+# ALLOCATIONS
+################################################
+
+def _traced_blocks():
+    return sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+
+def _trace(fn, inputs):
+    kept = [None] * len(inputs)
+    slots = list(enumerate(inputs)) # made before tracing, the loop allocates nothing per item
+    tracemalloc.start()
+    try:
+        before = _traced_blocks()
+        peak = 0
+        for i, item in slots:
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            kept[i] = fn(item)
+            peak += tracemalloc.get_traced_memory()[1] - current
+        blocks = _traced_blocks() - before
+    finally:
+        tracemalloc.stop()
+    return blocks, peak
+
+def allocations_per_call(fn, inputs):
+    """
+    Runs fn(item) over inputs under tracemalloc, keeping every result. Returns (blocks, bytes) per call:
+    memory blocks still held afterwards (results and anything they refer to) and the peak rise in traced
+    bytes during the call (everything allocated at once, temporaries included). Blocks are the difference
+    between a run over inputs twice and a run over them once, so what the loop itself holds cancels out.
+    """
+    for item in inputs: # lazy imports, caches, first use per thread: one pass before tracing
+        fn(item)
+    inputs = list(inputs)
+    once, peak = _trace(fn, inputs)
+    twice, _ = _trace(fn, inputs * 2)
+    return (twice - once) / len(inputs), peak / len(inputs)
+
+def check_sample_allocations(sample_dir=SAMPLE_DIR):
+    """
+    Compares the live path on SDK dictionaries (preprocess_gaze -> power table) with the same path on a
+    reused GazeSample: checks they agree on every sample row and prints the allocations per sample.
+    """
+    paths, samples, gazexys = sample_inputs(sample_dir)
+    power = compile_power(calculatePower_new3)
+    record = GazeSample()
+    for sample, gazexy in zip(samples, gazexys):
+        filled = preprocess_gaze(record.fill(sample))
+        assert filled is record.xy and filled == tuple(gazexy), (filled, gazexy)
+        assert power(filled) == power(gazexy)
+        assert gaze_id(filled) == gaze_id(gazexy)
+        assert calculatePower_new3(filled) == calculatePower_new3(gazexy)
+
+    cases = [
+        ('preprocess_gaze(dict)', preprocess_gaze),
+        ('preprocess_gaze(GazeSample)', lambda sample: preprocess_gaze(record.fill(sample))),
+        ('dict -> power table', lambda sample: power(preprocess_gaze(sample))),
+        ('GazeSample -> power table', lambda sample: power(preprocess_gaze(record.fill(sample)))),
+    ]
+    print(f"{'allocations per sample':<30}{'blocks kept':>12}{'peak bytes':>12}")
+    results = {}
+    for name, fn in cases:
+        blocks, peak = allocations_per_call(fn, samples)
+        results[name] = (blocks, peak)
+        print(f"{name:<30}{blocks:>12.1f}{peak:>12.0f}")
+    blocks = results['preprocess_gaze(GazeSample)'][0]
+    assert blocks == 0, f"preprocess_gaze on a GazeSample kept {blocks} blocks per sample, it should keep none"
+    return len(samples)
+
+################################################
+# HOT PATH SUITE
+################################################
+
+def time_per_call(fn, inputs, repeats=7, min_time=0.05):
+    """
+    Calls fn(item) for every item in inputs, looping over inputs until a run takes at least
+    min_time seconds. Returns the best of repeats runs as seconds per call.
+    """
+    loops, elapsed = 1, 0.0
+    while True: # calibrate the number of passes per run
+        start = time.perf_counter()
+        for _ in range(loops):
+            for item in inputs:
+                fn(item)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        loops *= 2
+    best = elapsed
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            for item in inputs:
+                fn(item)
+        best = min(best, time.perf_counter() - start)
+    return best / (loops * len(inputs))
+
+def sample_inputs(sample_dir=SAMPLE_DIR):
+    """The sample rows as SDK style dicts (only rows preprocess_gaze accepts) and their gazexy tuples."""
+    paths = sorted(glob.glob(os.path.join(sample_dir, '*.csv')))
+    samples = []
+    for path in paths:
+        frame = load_gaze_frame(path, dtype=np.float64)
+        ok = frame['left_gaze_point_validity'].astype(bool) | frame['right_gaze_point_validity'].astype(bool)
+        records = frame.to_pandas(tuples=True).to_dict('records')
+        samples += [record for record, keep in zip(records, ok) if keep]
+    gazexys = [preprocess_gaze(sample) for sample in samples]
+    return paths, samples, gazexys
+
+def calibration_loop(n=1000):
+    # fixed pure python workload, timed next to every path so machines / cpu clock changes can be normalized out
+    total = 0.0
+    for i in range(n):
+        total += (i % 7) * 0.5
+    return total
+
+def hot_path_cases(sample_dir=SAMPLE_DIR):
+    """(name, fn, inputs) for every step of the control loop, and the average rows per sample file."""
+    paths, samples, gazexys = sample_inputs(sample_dir)
+    powers = [calculatePower_new3(gazexy) for gazexy in gazexys]
+    record = GazeSample()
+    pairs = [(gazexy[0][0], gazexy[2][0]) for gazexy in gazexys]
+    rows_per_file = sum(len(pd.read_csv(path)) for path in paths) / len(paths)
+
+    power_new3 = compile_power(calculatePower_new3)
+    tracer = LatencyTracer()
+    def trace(i):
+        tracer.record(1000, 1100, i, i + 1, i + 2, i + 3, i + 4, i + 5, i + 6)
+
+    cases = [
+        ('build_dataset_from_csv', lambda path: build_dataset_from_csv(path, 'bench'), paths),
+        ('preprocess_gaze', preprocess_gaze, samples),
+        ('preprocess_gaze_sample', lambda sample: preprocess_gaze(record.fill(sample)), samples),
+        ('gaze_id', gaze_id, gazexys),
+        ('calculatePower_new2', calculatePower_new2, gazexys),
+        ('calculatePower_new3', calculatePower_new3, gazexys),
+        ('power_table_new3', power_new3, gazexys),
+        ('rescale_item', rescale_item, pairs),
+        ('format_cmd', lambda power: format_cmd(*power).encode(), powers),
+        ('encode_power', lambda power: encode_power(*power), powers),
+        ('latency_trace', trace, range(len(samples))),
+        ('sample_to_command', lambda sample: encode_power(*calculatePower_new3(preprocess_gaze(sample))), samples),
+        ('sample_to_command_table', lambda sample: encode_power(*power_new3(preprocess_gaze(record.fill(sample)))), samples),
+    ]
+    return cases, rows_per_file
+
+def bench_hot_path(sample_dir=SAMPLE_DIR, repeats=7, rounds=3, names=None):
+    """
+    Times each step of the control loop (or only those in names). Returns {name: {'us_per_call',
+    'samples_per_sec', 'calibration_us', 'relative', 'spread'}}, where a call handles one sample except for
+    build_dataset_from_csv (one file per call, samples_per_sec counts its rows).
+
+    The calibration loop is timed right before every path, so each path is normalized by the machine speed
+    of the moment it ran in rather than by one calibration at the start. The suite runs rounds times:
+    relative is the smallest path / calibration over the rounds, spread how far apart the rounds were
+    (max - min over median), which regressions() allows on top of the threshold, up to max_noise.
+    """
+    cases, rows_per_file = hot_path_cases(sample_dir)
+    runs = {name: [] for name, fn, inputs in cases if names is None or name in names}
+    calibration = []
+    for _ in range(rounds):
+        for name, fn, inputs in cases:
+            if name not in runs:
+                continue
+            cal = time_per_call(calibration_loop, (1000,), repeats)
+            calibration.append(cal)
+            runs[name].append((time_per_call(fn, inputs, repeats), cal))
+
+    middle = float(np.median(calibration))
+    results = {'calibration': {'us_per_call': round(middle * 1e6, 3), 'samples_per_sec': round(1 / middle),
+                               'calibration_us': round(middle * 1e6, 3), 'relative': 1.0,
+                               'spread': round((max(calibration) - min(calibration)) / middle, 3)}}
+    for name, timings in runs.items():
+        results[name] = _summary(timings, rows_per_file if name == 'build_dataset_from_csv' else 1)
+    return results
+
+def _summary(timings, samples_per_call):
+    per_call = float(np.median([t for t, cal in timings]))
+    relative = [t / cal for t, cal in timings]
+    middle = float(np.median(relative))
+    return {'us_per_call': round(per_call * 1e6, 3),
+            'samples_per_sec': round(samples_per_call / per_call),
+            'calibration_us': round(float(np.median([cal for t, cal in timings])) * 1e6, 3),
+            'relative': round(min(relative), 6),
+            'spread': round((max(relative) - min(relative)) / middle, 3)}
+
+def print_hot_path(results, baseline=None, normalize=True):
+    # change is normalized by the calibration loop like regressions(), spread is this run's round to round noise
+    print(f"{'path':<24}{'us/call':>12}{'samples/s':>14}{'spread':>8}{'baseline':>12}{'change':>9}")
+    for name, r in results.items():
+        line = f"{name:<24}{r['us_per_call']:>12.3f}{r['samples_per_sec']:>14,}{r.get('spread', 0.0):>8.1%}"
+        if baseline and name in baseline:
+            base = baseline[name]['us_per_call']
+            if normalize and name != 'calibration' and 'calibration' in baseline:
+                change = _relative(results, name) / _relative(baseline, name)
+            else:
+                change = r['us_per_call'] / base
+            line += f"{base:>12.3f}{(change - 1) * 100:>+8.1f}%"
+        print(line)
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+def save_baseline(results, path, keep=None):
+    """Writes results as the baseline. Paths in keep (the baseline at path) keep their old entry and its meta."""
+    meta = {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'machine': platform.machine(), 'processor': platform.processor(), 'time': time.time()}
+    if keep:
+        results = {**results, **keep}
+        with open(path) as f:
+            meta = json.load(f)['meta']
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2)
+
+def _relative(results, name):
+    # path latency over the calibration loop's; entries saved before calibration_us existed use the suite's calibration
+    r = results[name]
+    if 'relative' in r:
+        return r['relative']
+    return r['us_per_call'] / results['calibration']['us_per_call']
+
+def regressions(results, baseline, threshold=0.25, normalize=True, max_noise=0.05):
+    """
+    Names of the paths whose per-call latency grew by more than threshold (0.25 = 25%) over the baseline,
+    plus the spread of the noisier of the two runs (the run to run noise each of them measured). The spread
+    allowed is capped at max_noise, so a noisy run can't hide a real slowdown.
+    With normalize, latencies are first divided by the calibration loop timed next to them, so a uniformly
+    slower or faster machine does not count as a regression.
+    """
+    slower = []
+    for name, r in results.items():
+        if name == 'calibration' or name not in baseline:
+            continue
+        if normalize and 'calibration' in results and 'calibration' in baseline:
+            change = _relative(results, name) / _relative(baseline, name)
+        else:
+            change = r['us_per_call'] / baseline[name]['us_per_call']
+        noise = min(max(r.get('spread', 0.0), baseline[name].get('spread', 0.0)), max_noise)
+        if change > 1 + threshold + noise:
+            slower.append(name)
+    return slower
+
+################################################
+# MAIN METHOD
+################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sample_dir', nargs='?', default=SAMPLE_DIR)
+    parser.add_argument('repeats', nargs='?', type=int, default=20, help='runs per csv loader timing')
+    parser.add_argument('--hot-only', action='store_true', help='only run the hot path suite')
+    parser.add_argument('--allocations', action='store_true', help='only run the allocation check (fails unless a GazeSample keeps 0 blocks per sample)')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='json baseline to compare against / save to')
+    parser.add_argument('--save-baseline', action='store_true', help='write this run as the new baseline')
+    parser.add_argument('--add-new', action='store_true', help='add paths missing from the baseline, keep the others')
+    parser.add_argument('--rounds', type=int, default=3, help='suite runs, each path is the fastest of them')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown before failing, 0.25 = 25%%')
+    parser.add_argument('--max-noise', type=float, default=0.05, help='most round to round spread allowed on top of the threshold')
+    parser.add_argument('--absolute', action='store_true', help="compare raw latencies, don't normalize by the calibration loop")
+    args = parser.parse_args()
+
+    if args.allocations:
+        print(f"GazeSample == dict path on {check_sample_allocations(args.sample_dir)} sample rows, 0 blocks kept per sample")
+        return 0
+    if not args.hot_only:
+        bench_csv_loaders(args.sample_dir, args.repeats)
+        print(f"batch == scalar on {check_batch_matches_scalar(args.sample_dir)} sample rows")
+        bench_replay(args.sample_dir)
+        print(f"GazeSample == dict path on {check_sample_allocations(args.sample_dir)} sample rows")
+        print()
+
+    results = bench_hot_path(args.sample_dir, rounds=args.rounds)
+    if args.save_baseline or args.add_new:
+        keep = load_baseline(args.baseline) if args.add_new and os.path.exists(args.baseline) else None
+        print_hot_path(results, keep)
+        save_baseline(results, args.baseline, keep)
+        added = [name for name in results if not keep or name not in keep]
+        print(f"baseline saved to {args.baseline}" + (f", added {', '.join(added) or 'nothing'}" if keep else ''))
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print_hot_path(results)
+        print(f"no baseline at {args.baseline}, run with --save-baseline to create one")
+        return 0
+
+    baseline = load_baseline(args.baseline)
+    normalize = not args.absolute
+    print_hot_path(results, baseline, normalize)
+    slower = regressions(results, baseline, args.threshold, normalize, args.max_noise)
+    if slower:
+        # a path slow in one suite run can be a burst of load on the machine: time those again before failing
+        print(f"re-timing {', '.join(slower)}")
+        again = bench_hot_path(args.sample_dir, rounds=2 * args.rounds, names=slower)
+        print_hot_path(again, baseline, normalize)
+        slower = regressions(again, baseline, args.threshold, normalize, args.max_noise)
+    if slower:
+        print(f"REGRESSION (> {args.threshold:.0%} + noise slower than baseline): {', '.join(slower)}")
+        return 1
+    print(f"no path more than {args.threshold:.0%} + noise slower than baseline")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,264 @@
+'''
+    calibration.py
+    @file      calibration.py
+    @brief     Per-user calibration profiles from "looking for bounds" sessions
+
+    While the user looks at the edges of the screen (sample_data/*_looking_for_bounds.csv), the
+    averaged gaze of every sample goes into one QuantileSketch per axis. The profile takes the
+    range between the low and high quantiles (2% / 98% by default) instead of min / max, so a few
+    wild samples don't stretch it, and keeps the sketch so later sessions can be merged in.
+
+    QuantileSketch is a fixed-bin histogram over the screen coordinate range: constant memory
+    however long the session, bin-width accuracy, and two sketches merge by adding their counts.
+
+    Profiles are json files under profile_dir() ($OPTICARS_PROFILES, default ~/.config/opticars/profiles),
+    kept in an in-memory cache once loaded. calculatePower_new3(gazexy, profile) rescales with them.
+
+    Usage: python calibration.py <bounds.csv> [--user NAME]   (computes, saves and prints the profile)
+'''
+
+import argparse
+import json
+import os
+import threading
+import numpy as np
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch: counts per fixed-width bin over [lo, hi), plus underflow / overflow
+    counts and the exact min / max. Quantiles are accurate to one bin width inside the range.
+
+    Args:
+    lo, hi: float, range covered by the bins (screen units; gaze can land a bit off screen).
+    bins: int, number of bins.
+    """
+
+    def __init__(self, lo=-4.0, hi=4.0, bins=8000):
+        self.lo = lo
+        self.hi = hi
+        self.bins = bins
+        self.width = (hi - lo) / bins
+        self.counts = np.zeros(bins + 2, dtype=np.int64) # [underflow, bins..., overflow]
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values):
+        """Adds one value or an array of values; nan is ignored."""
+        values = np.atleast_1d(np.asarray(values, dtype=np.float64))
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return
+        idx = np.floor((values - self.lo) / self.width).astype(np.int64) + 1
+        np.clip(idx, 0, self.bins + 1, out=idx)
+        self.counts += np.bincount(idx, minlength=self.bins + 2)
+        self.count += int(values.size)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    def merge(self, other):
+        if (other.lo, other.hi, other.bins) != (self.lo, self.hi, self.bins):
+            raise ValueError("can only merge sketches with the same bins")
+        self.counts += other.counts
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        """Value below which a fraction q of the samples fall, interpolated inside its bin and clamped to [min, max]."""
+        if self.count == 0:
+            return np.nan
+        target = q * self.count
+        cumulative = np.cumsum(self.counts)
+        i = int(np.searchsorted(cumulative, target, side='left'))
+        if i == 0:
+            return self.min
+        if i == self.bins + 1:
+            return self.max
+        before = cumulative[i - 1]
+        inside = (target - before) / self.counts[i] if self.counts[i] else 0.0
+        value = self.lo + (i - 1 + inside) * self.width
+        return float(min(max(value, self.min), self.max))
+
+    def to_dict(self):
+        nonzero = np.flatnonzero(self.counts)
+        return {'lo': self.lo, 'hi': self.hi, 'bins': self.bins, 'count': self.count,
+                'min': self.min, 'max': self.max,
+                'index': nonzero.tolist(), 'counts': self.counts[nonzero].tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        sketch = cls(d['lo'], d['hi'], d['bins'])
+        sketch.counts[d['index']] = d['counts']
+        sketch.count = d['count']
+        sketch.min = d['min'] if d['count'] else np.inf
+        sketch.max = d['max'] if d['count'] else -np.inf
+        return sketch
+
+class CalibrationProfile:
+    """
+    One user's gaze range per axis, in preprocess_gaze screen units (x right, y up).
+
+    Args:
+    user: str, profile name.
+    x_sketch, y_sketch: QuantileSketch of the averaged gaze on each axis.
+    q_low, q_high: float, quantiles taken as the ends of the range.
+    min_span: float, the range is widened around its center to at least this, so a session where the
+              eyes barely moved can't turn tiny movements into full power.
+    """
+
+    def __init__(self, user, x_sketch=None, y_sketch=None, q_low=0.02, q_high=0.98, min_span=0.5):
+        self.user = user
+        self.x_sketch = x_sketch or QuantileSketch()
+        self.y_sketch = y_sketch or QuantileSketch()
+        self.q_low = q_low
+        self.q_high = q_high
+        self.min_span = min_span
+
+    def add_gaze(self, gx, gy):
+        """Adds averaged gaze points (arrays or single values) to the sketches."""
+        self.x_sketch.add(gx)
+        self.y_sketch.add(gy)
+
+    def merge(self, other):
+        self.x_sketch.merge(other.x_sketch)
+        self.y_sketch.merge(other.y_sketch)
+        return self
+
+    @property
+    def samples(self):
+        return self.x_sketch.count
+
+    def _range(self, sketch):
+        lo, hi = sketch.quantile(self.q_low), sketch.quantile(self.q_high)
+        if hi - lo < self.min_span:
+            center = (lo + hi) / 2
+            lo, hi = center - self.min_span / 2, center + self.min_span / 2
+        return lo, hi
+
+    def bounds(self):
+        """(x_min, x_max, y_min, y_max) for rescale_item."""
+        if self.samples == 0:
+            raise ValueError(f"profile {self.user} has no samples")
+        return self._range(self.x_sketch) + self._range(self.y_sketch)
+
+    def center(self):
+        """(x, y) center of the user's range: how far their straight ahead is from the screen center."""
+        x_min, x_max, y_min, y_max = self.bounds()
+        return (x_min + x_max) / 2, (y_min + y_max) / 2
+
+    def to_dict(self):
+        return {'user': self.user, 'q_low': self.q_low, 'q_high': self.q_high, 'min_span': self.min_span,
+                'bounds': list(self.bounds()) if self.samples else None,
+                'x_sketch': self.x_sketch.to_dict(), 'y_sketch': self.y_sketch.to_dict()}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['user'], QuantileSketch.from_dict(d['x_sketch']), QuantileSketch.from_dict(d['y_sketch']),
+                   d['q_low'], d['q_high'], d['min_span'])
+
+    def __repr__(self):
+        # stable text, also used to key power tables compiled for this profile
+        if not self.samples:
+            return f"CalibrationProfile({self.user!r}, empty)"
+        return f"CalibrationProfile({self.user!r}, bounds={tuple(round(b, 6) for b in self.bounds())})"
+
+################################################
+# BUILDING PROFILES
+################################################
+
+def averaged_gaze(frame):
+    """(gx, gy) arrays for a GazeFrame: the two eyes' average after preprocess_gaze, nan for rejected rows."""
+    from utils import preprocess_gaze_batch
+    (left_x, left_y, right_x, right_y), ok = preprocess_gaze_batch(frame)
+    return (left_x + right_x) / 2, (left_y + right_y) / 2
+
+def user_from_path(path):
+    """'lam_looking_for_bounds.csv' -> 'lam'"""
+    return os.path.basename(path).split('_')[0]
+
+def calibrate(frames, user, **kwargs):
+    """Builds a profile from one or more GazeFrames of a bounds session."""
+    profile = CalibrationProfile(user, **kwargs)
+    for frame in frames:
+        profile.add_gaze(*averaged_gaze(frame))
+    return profile
+
+def calibrate_csv(path, user=None, **kwargs):
+    """Builds a profile from a bounds csv. The user defaults to the file name prefix."""
+    from gaze_csv import load_gaze_frame
+    return calibrate([load_gaze_frame(path, dtype=np.float64)], user or user_from_path(path), **kwargs)
+
+################################################
+# STORAGE
+################################################
+
+_profiles = {}
+_profiles_lock = threading.Lock()
+
+def profile_dir():
+    return os.environ.get('OPTICARS_PROFILES') or os.path.join(os.path.expanduser('~'), '.config', 'opticars', 'profiles')
+
+def profile_path(user):
+    return os.path.join(profile_dir(), f"{user}.json")
+
+def save_profile(profile):
+    """Writes the profile (atomically) and puts it in the in-memory cache."""
+    path = profile_path(profile.user)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(profile.to_dict(), f)
+    os.replace(tmp, path)
+    with _profiles_lock:
+        _profiles[profile.user] = profile
+    return path
+
+def load_profile(user):
+    """Returns the user's profile from the in-memory cache, reading it from disk the first time. None if there is none."""
+    with _profiles_lock:
+        if user in _profiles:
+            return _profiles[user]
+    path = profile_path(user)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        profile = CalibrationProfile.from_dict(json.load(f))
+    with _profiles_lock:
+        return _profiles.setdefault(user, profile)
+
+def update_profile(user, frames):
+    """Merges new bounds recordings into the user's saved profile (or starts one) and saves it."""
+    new = calibrate(frames, user)
+    profile = load_profile(user)
+    profile = new if profile is None else profile.merge(new)
+    save_profile(profile)
+    return profile
+
+################################################
+# MAIN METHOD
+################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='bounds session csv files')
+    parser.add_argument('--user', default=None, help='profile name (default: from the first file name)')
+    parser.add_argument('--merge', action='store_true', help='merge into the saved profile instead of replacing it')
+    args = parser.parse_args()
+
+    user = args.user or user_from_path(args.paths[0])
+    profile = CalibrationProfile(user)
+    for path in args.paths:
+        profile.merge(calibrate_csv(path, user))
+    if args.merge and load_profile(user) is not None:
+        profile = load_profile(user).merge(profile)
+    path = save_profile(profile)
+    x_min, x_max, y_min, y_max = profile.bounds()
+    cx, cy = profile.center()
+    print(f"{user}: {profile.samples} samples -> x [{x_min:.3f}, {x_max:.3f}]  y [{y_min:.3f}, {y_max:.3f}]  center ({cx:.3f}, {cy:.3f})")
+    print(f"  raw min/max: x [{profile.x_sketch.min:.3f}, {profile.x_sketch.max:.3f}]  y [{profile.y_sketch.min:.3f}, {profile.y_sketch.max:.3f}]")
+    print(f"  saved to {path}")
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import pandas as pd
 from utils import build_dataset, get_tracker
-import time, serial
+import time
+from car_link import CarLink
 
 # divide numbers by 10 and make sure they're floats (-1.0, 1.1)
 
@@ -18,9 +19,7 @@ baud = 9600
 # set up serial port to communicate with the car over bluetooth
 # bluetoothPort = "COM5"
 bluetoothPort = "COM3"
-car = serial.Serial(bluetoothPort, baud)
-# give time to connect
-time.sleep(2)
+car = CarLink(bluetoothPort, baud) # connects in the background and reconnects if the link drops
 
 # want to be able to catch keyboard interrupt exceptions so we can safely close serial ports
 try:
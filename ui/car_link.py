@@ -0,0 +1,364 @@
+'''
+    car_link.py
+    @file      car_link.py
+    @brief     Non-blocking serial link to the car with command coalescing and automatic reconnect
+
+    CarLink looks like a serial.Serial to the code sending commands (write / flush / close), but
+    write() only queues the bytes and returns. A writer thread owns the port:
+
+    - Superseded motor commands are dropped: a new MOVE (binary OP_MOVE frame or "CMD: l,r" /
+      "CMD:MOVEORDER" text line) replaces any MOVE still waiting in the queue. Other commands
+      (STOP, DEBUG) are never dropped for being old and keep their order.
+    - Everything waiting is written in one write() call, up to the in-flight budget.
+    - Bytes in flight are estimated from the baud rate (10 bits per byte). The writer keeps at most
+      max_in_flight bytes on the wire, so stale commands wait in the queue,
+      where a newer MOVE can still replace them, and don't pile up in the OS / HC-06 buffers.
+    - When a write or open fails (the HC-06 drops out), the port is closed and reopened with
+      exponential backoff. write() keeps accepting commands meanwhile. The failed batch goes back
+      to the front of the queue (minus moves that have been superseded since), so STOP commands
+      aren't lost and the newest MOVE is sent once the link is back.
+
+    metrics() reports link health: connected, reconnects, queue depth, superseded / sent / lost
+    frames, bytes, write times and the last error.
+
+    Usage: python car_link.py  (runs the coalescing / reconnect self check against a flaky fake port)
+'''
+
+import collections
+import threading
+import time
+from car_protocol import SYNC, FRAME_SIZE, OP_MOVE, encode_move, encode_frame, FrameParser, OP_STOP
+
+def is_move(data):
+    """True for motor commands a newer one makes obsolete: binary OP_MOVE frames and the old text move lines."""
+    if len(data) == FRAME_SIZE and data[0] == SYNC:
+        return data[1] & 0x0F == OP_MOVE
+    return data.startswith(b"CMD: ") or data.startswith(b"CMD:MOVEORDER")
+
+class CarLink:
+    """
+    Args:
+    port: str, serial port of the car (e.g. "COM14").
+    baud: int, link speed, used to open the port and to estimate bytes in flight.
+    opener: function returning an open serial-like object, defaults to serial.Serial(port, baud, write_timeout=1).
+    max_queue: int, commands kept waiting. When full the oldest is dropped (counted in overflow).
+    max_in_flight: int, most bytes on the wire at once (32 bytes is 33 ms at 9600 baud).
+    connect_delay: float, seconds to wait after opening before writing (the HC-06 needs about 2 s).
+    backoff_min, backoff_max: float, reconnect delays in seconds, doubling after each failed attempt.
+    """
+
+    def __init__(self, port, baud=9600, opener=None, max_queue=32, max_in_flight=32, connect_delay=2.0,
+                 backoff_min=0.5, backoff_max=10.0):
+        self.port = port
+        self.baudrate = baud
+        self.opener = opener or self._open_serial
+        self.max_queue = max_queue
+        self.max_in_flight = max_in_flight
+        self.connect_delay = connect_delay
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self._byte_s = 10.0 / baud
+
+        self._cond = threading.Condition(threading.Lock())
+        self._queue = collections.deque() # (is_move, bytes), in send order
+        self._closing = False
+        self._serial = None
+        self._busy_until = 0.0 # monotonic time the bytes already written are estimated to be sent
+
+        self.connected = False
+        self.connects = 0
+        self.reconnects = 0
+        self.queued = 0 # write() calls
+        self.superseded = 0 # moves replaced by a newer one before they were sent
+        self.overflow = 0 # commands dropped because the queue was full
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.batches = 0 # write() calls on the port
+        self.lost_frames = 0 # frames of a failed write that were not retried (superseded moves)
+        self.write_errors = 0
+        self.open_errors = 0
+        self.last_error = None
+        self.write_s_max = 0.0
+        self._write_s_total = 0.0
+        self._down_since = time.monotonic()
+        self.downtime_s = 0.0 # time spent disconnected after the first connect
+
+        self._thread = threading.Thread(target=self._run, name=f"car-link-{port}", daemon=True)
+        self._thread.start()
+
+    def _open_serial(self):
+        import serial
+        return serial.Serial(self.port, self.baudrate, write_timeout=1.0)
+
+    ################################################
+    # SERIAL SURFACE
+    ################################################
+
+    @property
+    def is_open(self):
+        return not self._closing
+
+    def write(self, data, move=None):
+        """
+        Queues bytes for the car and returns at once.
+        move: bool, whether a newer MOVE supersedes this one. Detected from the bytes (is_move) by default.
+        """
+        data = bytes(data)
+        if move is None:
+            move = is_move(data)
+        with self._cond:
+            if self._closing:
+                raise OSError(f"car link {self.port} is closed")
+            if move:
+                kept = [entry for entry in self._queue if not entry[0]]
+                self.superseded += len(self._queue) - len(kept)
+                if len(kept) != len(self._queue):
+                    self._queue = collections.deque(kept)
+            if len(self._queue) >= self.max_queue:
+                self._queue.popleft()
+                self.overflow += 1
+            self._queue.append((move, data))
+            self.queued += 1
+            self._cond.notify()
+        return len(data)
+
+    def flush(self):
+        # the writer thread owns the port, nothing to wait for here
+        pass
+
+    def close(self, timeout=2.0):
+        """
+        Sends what is still queued (if connected, for up to timeout seconds) and closes the port.
+        Only the writer thread touches the port: if it is still stuck in a write after timeout, the rest of
+        the queue is dropped and the writer closes the port as soon as that write returns.
+        """
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        with self._cond:
+            self._queue.clear()
+
+    ################################################
+    # WRITER THREAD
+    ################################################
+
+    def _run(self):
+        try:
+            self._send_loop()
+        finally:
+            self._close_serial()
+
+    def _send_loop(self):
+        backoff = self.backoff_min
+        while True:
+            with self._cond:
+                while not self._queue and not self._closing:
+                    self._cond.wait()
+                if self._closing and (not self._queue or self._serial is None):
+                    return
+
+            if self._serial is None:
+                if self._connect():
+                    backoff = self.backoff_min
+                else:
+                    with self._cond:
+                        self._cond.wait_for(lambda: self._closing, backoff)
+                    backoff = min(backoff * 2, self.backoff_max)
+                continue
+
+            # baud budget: keep at most max_in_flight bytes on the wire (one command more if the wire is empty)
+            in_flight = self.in_flight()
+            room = self.max_in_flight - in_flight
+            with self._cond:
+                first = len(self._queue[0][1]) if self._queue else 0
+            if first > room and in_flight > 0:
+                time.sleep((first - room) * self._byte_s) # newer moves keep replacing queued ones meanwhile
+                continue
+
+            with self._cond:
+                batch = []
+                size = 0
+                while self._queue and (not batch or size + len(self._queue[0][1]) <= room):
+                    entry = self._queue.popleft()
+                    batch.append(entry)
+                    size += len(entry[1])
+            if batch:
+                self._write(batch, size)
+
+    def _connect(self):
+        try:
+            serial = self.opener()
+        except (OSError, ValueError) as e: # pyserial raises ValueError for a bad port name or setting
+            self.open_errors += 1
+            self.last_error = f"open: {e!r}"
+            return False
+        with self._cond:
+            if self._cond.wait_for(lambda: self._closing, self.connect_delay): # give time to connect
+                try:
+                    serial.close()
+                except OSError:
+                    pass
+                return False
+        self._serial = serial
+        self._busy_until = 0.0
+        self.connected = True
+        if self.connects:
+            self.reconnects += 1
+            self.downtime_s += time.monotonic() - self._down_since
+        self.connects += 1
+        return True
+
+    def _write(self, batch, size):
+        start = time.perf_counter()
+        try:
+            self._serial.write(b"".join(data for move, data in batch))
+        except OSError as e: # serial.SerialException is an OSError too
+            self.write_errors += 1
+            self.last_error = f"write: {e!r}"
+            self._close_serial()
+            self._requeue(batch)
+            return
+        elapsed = time.perf_counter() - start
+        now = time.monotonic()
+        self._busy_until = max(now, self._busy_until) + size * self._byte_s
+        self.batches += 1
+        self.sent_frames += len(batch)
+        self.sent_bytes += size
+        self._write_s_total += elapsed
+        self.write_s_max = max(self.write_s_max, elapsed)
+
+    def _requeue(self, batch):
+        # retry a failed batch after reconnecting: every non-move command, and its last move unless a newer one is waiting
+        with self._cond:
+            newer_move = any(move for move, data in self._queue)
+            last_move = max((i for i, (move, data) in enumerate(batch) if move), default=None)
+            keep = [entry for i, entry in enumerate(batch) if not entry[0] or (i == last_move and not newer_move)]
+            self.lost_frames += len(batch) - len(keep)
+            self._queue.extendleft(reversed(keep))
+            while len(self._queue) > self.max_queue:
+                self._queue.pop()
+                self.overflow += 1
+
+    def _close_serial(self):
+        serial, self._serial = self._serial, None
+        if self.connected:
+            self.connected = False
+            self._down_since = time.monotonic()
+        if serial is not None:
+            try:
+                serial.close()
+            except OSError:
+                pass
+
+    ################################################
+    # HEALTH
+    ################################################
+
+    def in_flight(self):
+        """Estimated bytes written but not yet on the car's side."""
+        return max(0.0, self._busy_until - time.monotonic()) / self._byte_s
+
+    def metrics(self):
+        return {
+            'connected': self.connected,
+            'reconnects': self.reconnects,
+            'queue': len(self._queue),
+            'queued': self.queued,
+            'superseded': self.superseded,
+            'overflow': self.overflow,
+            'sent_frames': self.sent_frames,
+            'sent_bytes': self.sent_bytes,
+            'batches': self.batches,
+            'lost_frames': self.lost_frames,
+            'write_errors': self.write_errors,
+            'open_errors': self.open_errors,
+            'in_flight_bytes': round(self.in_flight(), 1),
+            'write_ms_avg': round(self._write_s_total / self.batches * 1000, 3) if self.batches else 0.0,
+            'write_ms_max': round(self.write_s_max * 1000, 3),
+            'downtime_s': round(self.downtime_s + (0 if self.connected or not self.connects else time.monotonic() - self._down_since), 3),
+            'last_error': self.last_error,
+        }
+
+################################################
+# SELF CHECK
+################################################
+
+class _FlakyPort:
+    """Fake serial port that records what arrives and fails on the writes / opens it is told to."""
+
+    def __init__(self, fail_writes=(), fail_opens=0, open_error=OSError, stall=None):
+        self.parser = FrameParser()
+        self.received = []
+        self.fail_writes = set(fail_writes)
+        self.fail_opens = fail_opens
+        self.open_error = open_error
+        self.stall = stall # threading.Event every write waits for
+        self.writes = 0
+        self.closed_by = None # name of the thread that closed the port
+
+    def opener(self):
+        if self.fail_opens:
+            self.fail_opens -= 1
+            raise self.open_error("could not open port")
+        return self
+
+    def write(self, data):
+        if self.stall is not None:
+            self.stall.wait()
+        self.writes += 1
+        if self.writes in self.fail_writes:
+            raise OSError("device reports readiness to read but returned no data")
+        self.received.extend(self.parser.feed(data))
+
+    def close(self):
+        self.closed_by = threading.current_thread().name
+
+def _self_check():
+    port = _FlakyPort(fail_writes={3, 4}, fail_opens=2)
+    received = port.received
+    link = CarLink('FAKE', baud=9600, opener=port.opener, connect_delay=0.01, backoff_min=0.01, backoff_max=0.05)
+
+    # a burst of moves with a stop in the middle: only the newest move may survive around the stop
+    for seq in range(200):
+        link.write(encode_move(seq / 200, -seq / 200, seq))
+        if seq == 100:
+            link.write(encode_frame(OP_STOP, seq=seq))
+        time.sleep(0.0005)
+    deadline = time.monotonic() + 5
+    while (link.metrics()['queue'] or not received or received[-1][3] != 199) and time.monotonic() < deadline:
+        link.write(encode_move(199 / 200, -199 / 200, 199))
+        time.sleep(0.05)
+    metrics = link.metrics()
+    link.close()
+
+    seqs = [frame[3] for frame in received if frame[0] == OP_MOVE]
+    assert seqs == sorted(seqs), "moves arrived out of order"
+    assert seqs[-1] == 199, "newest move never arrived"
+    stops = [frame for frame in received if frame[0] == OP_STOP]
+    assert len(stops) == 1, "stop command dropped"
+    assert metrics['reconnects'] >= 1 and metrics['open_errors'] == 2, metrics
+    assert metrics['superseded'] > 0
+    assert port.closed_by == 'car-link-FAKE', port.closed_by
+
+    # bad port settings are retried like a missing port; a close that times out in a stuck write
+    # leaves the port to the writer, which closes it once the write returns
+    stall = threading.Event()
+    stuck = _FlakyPort(fail_opens=1, open_error=ValueError, stall=stall)
+    link = CarLink('STUCK', opener=stuck.opener, connect_delay=0.01, backoff_min=0.01)
+    link.write(encode_move(0.5, 0.5, 0))
+    deadline = time.monotonic() + 5
+    while not link.connected and time.monotonic() < deadline:
+        time.sleep(0.01)
+    link.write(encode_move(0.6, 0.6, 1))
+    link.close(timeout=0.05)
+    assert link.metrics()['open_errors'] == 1 and stuck.closed_by is None
+    stall.set()
+    link._thread.join(1.0)
+    assert stuck.closed_by == 'car-link-STUCK', stuck.closed_by
+
+    print(f"ok: {len(received)} frames arrived for {metrics['queued']} queued")
+    print(f"  {metrics}")
+
+if __name__ == '__main__':
+    _self_check()
@@ -0,0 +1,204 @@
+'''
+    car_protocol.py
+    @file      car_protocol.py
+    @brief     Binary framing for commands sent to the car over the HC-06 bluetooth serial link
+
+    At 9600 baud every byte costs about 1 ms, so instead of ASCII lines like "CMD: 1.3,0.7\n" (13 bytes)
+    each command is a fixed 6 byte frame:
+
+        byte 0   SYNC (0xA5)
+        byte 1   VERSION << 4 | OPCODE
+        byte 2   a   signed, value * 100 (so -1.27 to 1.27 in steps of 0.01)
+        byte 3   b   signed, value * 100
+        byte 4   sequence number, wraps at 256
+        byte 5   CRC-8 (poly 0x07, init 0) over bytes 1-4
+
+    For OP_MOVE, a and b are the left and right motor powers (both in [-1, 1], -1 full reverse, 1 full
+    forward). The matching parsers live in arduino.cpp, which drives the motors with them directly, and
+    hardware/car/car.ino, whose movementOrder is (turn, forward): it takes turn = (a - b) / 2 and
+    forward = (a + b) / 2. Both still accept the old ASCII lines.
+
+    Usage: python car_protocol.py  (runs the round-trip and fuzz checks)
+'''
+
+import random
+
+SYNC = 0xA5
+VERSION = 1
+FRAME_SIZE = 6
+SCALE = 100 # quantization steps per unit
+
+OP_MOVE = 0x1
+OP_STOP = 0x2
+OP_DEBUG_ON = 0x3
+OP_DEBUG_OFF = 0x4
+OPCODES = (OP_MOVE, OP_STOP, OP_DEBUG_ON, OP_DEBUG_OFF)
+
+class FrameError(ValueError):
+    pass
+
+def _crc8_table(poly=0x07):
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return bytes(table)
+
+CRC8_TABLE = _crc8_table()
+
+def crc8(data):
+    crc = 0
+    for byte in data:
+        crc = CRC8_TABLE[crc ^ byte]
+    return crc
+
+def quantize(value):
+    """Maps a motor value to the signed byte sent on the wire, clamped to [-127, 127]."""
+    q = int(round(value * SCALE))
+    return max(-127, min(127, q))
+
+def dequantize(q):
+    return q / SCALE
+
+################################################
+# ENCODING
+################################################
+
+'''
+    @brief Builds one frame.
+
+    @param opcode One of OPCODES.
+    @param a First value (for OP_MOVE the left motor power).
+    @param b Second value (for OP_MOVE the right motor power).
+    @param seq Sequence number, taken modulo 256.
+
+    @return The 6 byte frame.
+'''
+def encode_frame(opcode, a=0.0, b=0.0, seq=0):
+    body = bytes(((VERSION << 4) | opcode, quantize(a) & 0xFF, quantize(b) & 0xFF, seq & 0xFF))
+    return bytes((SYNC,)) + body + bytes((crc8(body),))
+
+def encode_move(a, b, seq=0):
+    return encode_frame(OP_MOVE, a, b, seq)
+
+# motor power from calculatePower_new3 is 0 to 2, the car expects -1 to 1 per motor
+def encode_power(left, right, seq=0):
+    return encode_frame(OP_MOVE, left - 1.0, right - 1.0, seq)
+
+################################################
+# DECODING
+################################################
+
+def _signed(byte):
+    return byte - 256 if byte > 127 else byte
+
+'''
+    @brief Decodes one complete frame.
+
+    @param frame 6 bytes starting with SYNC.
+
+    @return (opcode, a, b, seq)
+    @throws FrameError if the sync byte, version, opcode or CRC is wrong.
+'''
+def decode_frame(frame):
+    if len(frame) != FRAME_SIZE:
+        raise FrameError(f"frame must be {FRAME_SIZE} bytes, got {len(frame)}")
+    if frame[0] != SYNC:
+        raise FrameError("missing sync byte")
+    if crc8(frame[1:5]) != frame[5]:
+        raise FrameError("bad crc")
+    version, opcode = frame[1] >> 4, frame[1] & 0x0F
+    if version != VERSION:
+        raise FrameError(f"unsupported version {version}")
+    if opcode not in OPCODES:
+        raise FrameError(f"unknown opcode {opcode}")
+    return opcode, dequantize(_signed(frame[2])), dequantize(_signed(frame[3])), frame[4]
+
+class FrameParser:
+    """
+    Incremental decoder for a byte stream, the same state machine the car runs.
+    Bytes before a sync byte are skipped; when a candidate frame fails its checks the parser
+    resyncs from the next sync byte inside it instead of throwing the whole frame away.
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self.frames = 0
+        self.errors = 0 # candidate frames rejected
+        self.skipped = 0 # bytes discarded while looking for a sync byte
+
+    def feed(self, data):
+        """Adds received bytes and returns the list of (opcode, a, b, seq) frames completed by them."""
+        buf = self._buf
+        buf.extend(data)
+        out = []
+        while True:
+            start = buf.find(SYNC)
+            if start < 0:
+                self.skipped += len(buf)
+                buf.clear()
+                break
+            if start:
+                self.skipped += start
+                del buf[:start]
+            if len(buf) < FRAME_SIZE:
+                break
+            try:
+                out.append(decode_frame(bytes(buf[:FRAME_SIZE])))
+                self.frames += 1
+                del buf[:FRAME_SIZE]
+            except FrameError:
+                self.errors += 1
+                del buf[:1]
+        return out
+
+################################################
+# SELF CHECK
+################################################
+
+def _self_check(n=20000, seed=0):
+    rng = random.Random(seed)
+
+    # round trip: every quantized value and opcode survives encode -> decode
+    for q in range(-127, 128):
+        for opcode in OPCODES:
+            frame = encode_frame(opcode, q / SCALE, -q / SCALE, q)
+            assert len(frame) == FRAME_SIZE
+            assert decode_frame(frame) == (opcode, q / SCALE, -q / SCALE, q & 0xFF)
+    assert decode_frame(encode_move(5.0, -5.0))[1:3] == (1.27, -1.27) # clamped
+
+    # every single bit flip must be caught by the crc or the header checks
+    frame = encode_move(0.3, -0.7, 42)
+    for i in range(1, FRAME_SIZE):
+        for bit in range(8):
+            corrupt = bytearray(frame)
+            corrupt[i] ^= 1 << bit
+            try:
+                decode_frame(bytes(corrupt))
+                raise AssertionError(f"bit flip at byte {i} bit {bit} not detected")
+            except FrameError:
+                pass
+
+    # fuzz: valid frames interleaved with random noise, split into random chunks
+    parser = FrameParser()
+    sent, stream = [], bytearray()
+    for seq in range(n):
+        a, b = rng.uniform(-1, 1), rng.uniform(-1, 1)
+        sent.append((OP_MOVE, quantize(a) / SCALE, quantize(b) / SCALE, seq & 0xFF))
+        stream += encode_move(a, b, seq)
+        if rng.random() < 0.1:
+            stream += bytes(rng.randrange(256) for _ in range(rng.randrange(1, 8)))
+    received, i = [], 0
+    while i < len(stream):
+        step = rng.randrange(1, 16)
+        received += parser.feed(stream[i:i + step])
+        i += step
+    # noise can occasionally form a frame with a valid crc, but no real frame may be lost
+    it = iter(received)
+    assert all(frame in it for frame in sent), "frames lost in noisy stream"
+    print(f"ok: {len(sent)} frames sent, {len(received)} decoded, {parser.errors} rejected candidates, {parser.skipped} noise bytes skipped")
+
+if __name__ == '__main__':
+    _self_check()
@@ -0,0 +1,264 @@
+'''
+    catalog.py
+    @file      catalog.py
+    @brief     Indexed catalog of the gaze recordings in a directory, with lazy loading and a parse cache
+
+    Recordings are named <user>_<gesture>_<trial>.csv (Graham_eye_roll_left_3.csv); the trial
+    number is optional (lam_looking_leftUpDiagonal.csv) and a name without any underscore is all
+    gesture (sample.csv). Catalog scans a directory (csv and session_recorder .session files),
+    parses those names into an index, and hands out Recording handles that only read the file the
+    first time .frame is used.
+
+    A parsed csv is cached as an npz under cache_path('catalog'), keyed by the file's absolute path,
+    mtime and size, so notebooks and training runs after the first one skip csv parsing entirely.
+    Editing or replacing a recording changes its key and it is parsed again.
+
+    Usage: python catalog.py [directory]  (prints the index and times a cold vs cached load of everything)
+'''
+
+import hashlib
+import os
+import time
+import numpy as np
+import pandas as pd
+from gaze_frame import GazeFrame
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sample_data')
+EXTENSIONS = ('.csv', '.session')
+CACHE_VERSION = 2 # bump when the cached layout changes
+
+def parse_name(path):
+    """'Graham_eye_roll_left_3.csv' -> ('Graham', 'eye_roll_left', 3); the trial is None when the name has no number."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    parts = stem.split('_')
+    if len(parts) == 1:
+        return None, stem, None
+    user, rest = parts[0], parts[1:]
+    trial = None
+    if len(rest) > 1 and rest[-1].isdigit():
+        trial = int(rest.pop())
+    return user, '_'.join(rest), trial
+
+class Recording:
+    """
+    Lazy handle on one recording. Nothing is read until frame (or df()) is used.
+
+    Args:
+    path: str, the recording.
+    dtype: float dtype of the coordinate columns (np.float64 for bit-exact batch replays).
+    cache: bool, use the npz parse cache for csv files.
+    """
+
+    def __init__(self, path, dtype=np.float32, cache=True):
+        self.path = os.path.abspath(path)
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.user, self.gesture, self.trial = parse_name(path)
+        stat = os.stat(self.path)
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self.dtype = np.dtype(dtype)
+        self.cache = cache
+        self._frame = None
+
+    def __repr__(self):
+        trial = '' if self.trial is None else f" #{self.trial}"
+        return f"Recording({self.user} {self.gesture}{trial}, {'loaded' if self.loaded else 'not loaded'})"
+
+    @property
+    def loaded(self):
+        return self._frame is not None
+
+    @property
+    def key(self):
+        """Cache key: changes when the file is edited, replaced or moved."""
+        blob = f"{CACHE_VERSION}|{self.path}|{self.mtime_ns}|{self.size}|{self.dtype.str}"
+        return hashlib.sha1(blob.encode()).hexdigest()[:16]
+
+    def cache_file(self):
+        from utils import cache_path
+        return cache_path('catalog', f"{self.name}_{self.key}.npz")
+
+    @property
+    def frame(self):
+        """The recording as a GazeFrame (parsed, or loaded from the cache, on first use)."""
+        if self._frame is None:
+            self._frame = self._load()
+        return self._frame
+
+    def df(self, tuples=True):
+        """Dataframe in build_dataset_from_csv's layout (tuple columns), with the gesture as the 'type' label."""
+        df = self.frame.to_pandas(tuples=tuples)
+        df['type'] = self.gesture
+        return df
+
+    def release(self):
+        """Drops the loaded frame; the next access loads it again (from the cache)."""
+        self._frame = None
+
+    def _load(self):
+        if self.path.endswith('.session'):
+            from session_reader import SessionReader
+            reader = SessionReader(self.path)
+            frame = reader.rows()
+            if self.dtype != np.float32: # sessions are stored as float32
+                frame = GazeFrame({name: col.astype(self.dtype) if col.dtype.kind == 'f' else col
+                                   for name, col in frame.columns.items()})
+            return frame
+        path = self.cache_file() if self.cache else None
+        if path is not None and os.path.exists(path):
+            try:
+                return _read_npz(path)
+            except (OSError, ValueError, KeyError):
+                pass # partial or old cache file, parse again
+        from gaze_csv import load_gaze_frame
+        frame = load_gaze_frame(self.path, dtype=self.dtype)
+        if path is not None:
+            _write_npz(path, frame)
+        return frame
+
+def _write_npz(path, frame):
+    # one 2-D block per dtype instead of an npz member per column: reading a few members is much faster
+    blocks = {}
+    for name, col in frame.columns.items():
+        blocks.setdefault(col.dtype.str, []).append(name)
+    arrays = {}
+    for i, (dtype, names) in enumerate(blocks.items()):
+        arrays[f"block{i}"] = np.stack([frame.columns[name] for name in names])
+        arrays[f"names{i}"] = np.array(names)
+    # extras are object arrays of strings (the csv index, 'type'): store them as unicode so no pickle is needed
+    arrays.update({f"extra:{name}": np.asarray(col).astype(str) for name, col in frame.extras.items()})
+    tmp = path + '.tmp.npz'
+    np.savez(tmp, **arrays)
+    os.replace(tmp, path)
+
+def _read_npz(path):
+    columns, extras = {}, {}
+    with np.load(path, allow_pickle=False) as data:
+        for key in data.files:
+            if key.startswith('block'):
+                block = data[key]
+                for name, row in zip(data['names' + key[5:]].tolist(), block):
+                    columns[name] = row
+            elif key.startswith('extra:'):
+                extras[key[6:]] = data[key].astype(object)
+    return GazeFrame(columns, extras)
+
+class Catalog:
+    """
+    Index of the recordings in a directory.
+
+    Args:
+    root: str, directory to scan. Defaults to sample_data/.
+    dtype: float dtype recordings are loaded with.
+    cache: bool, use the npz parse cache.
+    recursive: bool, scan subdirectories too.
+    """
+
+    def __init__(self, root=SAMPLE_DIR, dtype=np.float32, cache=True, recursive=False):
+        self.root = root
+        self.dtype = dtype
+        self.cache = cache
+        self.recursive = recursive
+        self.recordings = []
+        self.scan()
+
+    def scan(self):
+        """(Re)reads the directory. Handles whose file didn't change keep what they already loaded."""
+        old = {(r.path, r.mtime_ns, r.size): r for r in self.recordings}
+        paths = []
+        for folder, dirs, files in os.walk(self.root):
+            paths.extend(os.path.join(folder, f) for f in files if f.endswith(EXTENSIONS))
+            if not self.recursive:
+                break
+        recordings = []
+        for path in sorted(paths):
+            recording = Recording(path, self.dtype, self.cache)
+            recordings.append(old.get((recording.path, recording.mtime_ns, recording.size), recording))
+        self.recordings = recordings
+        return self
+
+    def __len__(self):
+        return len(self.recordings)
+
+    def __iter__(self):
+        return iter(self.recordings)
+
+    def __getitem__(self, item):
+        """By position or by file name without extension."""
+        if isinstance(item, str):
+            for recording in self.recordings:
+                if recording.name == item:
+                    return recording
+            raise KeyError(item)
+        return self.recordings[item]
+
+    def __repr__(self):
+        return f"Catalog({self.root!r}, {len(self)} recordings, {len(self.users())} users, {len(self.gestures())} gestures)"
+
+    def select(self, user=None, gesture=None, trial=None):
+        """Recordings matching every given field. Each field can be a value or a list / set of values."""
+        def match(value, wanted):
+            return wanted is None or (value in wanted if isinstance(wanted, (list, tuple, set)) else value == wanted)
+        return [r for r in self.recordings if match(r.user, user) and match(r.gesture, gesture) and match(r.trial, trial)]
+
+    def users(self):
+        return sorted({r.user for r in self.recordings if r.user is not None})
+
+    def gestures(self):
+        return sorted({r.gesture for r in self.recordings})
+
+    def index(self):
+        """The metadata index as a dataframe (nothing is parsed)."""
+        return pd.DataFrame([{'name': r.name, 'user': r.user, 'gesture': r.gesture, 'trial': r.trial,
+                              'size': r.size, 'mtime': r.mtime_ns / 1e9, 'path': r.path, 'loaded': r.loaded}
+                             for r in self.recordings])
+
+    def load(self, **filters):
+        """Concatenates the selected recordings into one GazeFrame with 'user', 'gesture' and 'trial' extras."""
+        recordings = self.select(**filters)
+        frames = [r.frame for r in recordings]
+        names = [name for name in frames[0].columns if all(name in f.columns for f in frames)] if frames else []
+        columns = {name: np.concatenate([f.columns[name] for f in frames]) for name in names}
+        extras = {}
+        for field in ('user', 'gesture', 'trial'):
+            extras[field] = np.concatenate([np.full(len(f), getattr(r, field), dtype=object) for r, f in zip(recordings, frames)]) \
+                if frames else np.empty(0, dtype=object)
+        return GazeFrame(columns, extras)
+
+    def prune_cache(self):
+        """Deletes cached parses that no recording in this catalog uses any more. Returns how many were removed."""
+        from utils import cache_path
+        folder = os.path.dirname(cache_path('catalog', 'x'))
+        keep = {os.path.basename(r.cache_file()) for r in self.recordings}
+        names = {r.name for r in self.recordings}
+        removed = 0
+        for f in os.listdir(folder):
+            stem = f.rsplit('_', 1)[0]
+            if f.endswith('.npz') and stem in names and f not in keep:
+                os.remove(os.path.join(folder, f))
+                removed += 1
+        return removed
+
+################################################
+# MAIN METHOD
+################################################
+
+if __name__ == '__main__':
+    import sys
+    root = sys.argv[1] if len(sys.argv) > 1 else SAMPLE_DIR
+    catalog = Catalog(root)
+    print(catalog)
+    print(catalog.index()[['name', 'user', 'gesture', 'trial', 'size']].to_string(index=False))
+
+    for r in catalog:
+        if os.path.exists(r.cache_file()):
+            os.remove(r.cache_file())
+    start = time.perf_counter()
+    cold = catalog.load()
+    cold_s = time.perf_counter() - start
+    start = time.perf_counter()
+    warm = Catalog(root).load() # fresh handles, everything from the cache
+    warm_s = time.perf_counter() - start
+    for name in cold.columns:
+        assert np.array_equal(cold[name], warm[name], equal_nan=True), name
+    print(f"load all ({len(cold)} samples): {cold_s * 1000:.1f} ms parsing csv, {warm_s * 1000:.1f} ms from the cache")
@@ -1,43 +1,326 @@
+import math
 import threading
-import serial
+from functools import partial
+from car_link import CarLink
 import numpy as np
-from utils import get_tracker, gaze_data, gaze_id, preprocess_gaze, calculatePower_new3
+from utils import get_tracker, gaze_data, gaze_id, preprocess_gaze, calculatePower_new3, LatestMailbox, GazeRingBuffer, GazeSample
+from car_protocol import encode_power, encode_frame, OP_STOP
+from latency_trace import LatencyTracer
+from gaze_filters import make_filter
+from gaze_events import make_detector, SACCADE, BLINK
+from gaze_regions import DwellFilter
+from power_table import compile_power
+from calibration import load_profile
+from metrics import REGISTRY, Deltas
+from gesture_model import make_gesture_predictor, GESTURE_ACTIONS
 import tobii_research as tr
 import time
 
+# the SDK callback only drops the newest sample in the mailboxes, the CarSender and RegionPublisher threads do everything else
+mailbox = LatestMailbox()
+region_mailbox = LatestMailbox()
+history = GazeRingBuffer() # every sample, for the CarSender's gaze filter and event detector which have to see all of them
+sender = None
+publisher = None
+
+# screen region the user is looking at (gaze_id: o1 - o9, "o" when no eye is tracked), None before the first sample.
+# written only by the RegionPublisher, read by the flask UI
+eye_tracking_data = None
+
+# clock the tracker stamps system_time_stamp with, read at callback entry for the 'sdk' latency stage
+system_clock = tr.get_system_time_stamp
+
+# samples with no usable eye validity, the ones preprocess_gaze rejects: counted here, once per tracker sample,
+# however many consumers preprocess it
+preprocess_rejected = REGISTRY.counter('opticars_preprocess_rejected_total', "Gaze samples from the tracker preprocess_gaze rejects (no usable eye validity)")
+
 def gaze_data_callback(out):
-    # if np.isnan(out['left_gaze_point_on_display_area'][0]) and np.isnan(out['right_gaze_point_on_display_area'][0]):
-    #     return
-            
-    gazexy = preprocess_gaze(out)
-    # print(gazexy)
-    # print(np.round(gazexy, 1))
-    # print('\n')
-    # time.sleep(0.5)
-    # eye_tracking_data = gaze_id(gazexy)
-    
-    # # stream to bytes
-    # left, right = calculatePower_new2(gazexy)
-    left, right = calculatePower_new3(gazexy)  # try
-
-    # print(f"{left}, {right}")
-    cmd = f"CMD: {round(((left)), 1)},{round((right), 1)}\n" # format request to controller
-    # cmd=f"CMD: 0.1, 1.9"
-    # print(cmd)
-
-    car.write(cmd.encode())
-    car.flush() # make sure it all sends before you start reading
-    print(cmd)
-    time.sleep(0.1)
-    
-def update_eye_tracking_data():
-    global car
+    # runs on the tracker SDK's delivery thread: no math, no serial i/o, no sleeping
+    history.push(out)
+    left, right = out['left_gaze_point_validity'], out['right_gaze_point_validity']
+    if left != 0 and right != 0 and (left != 1 or right != 1): # preprocess_gaze has no eye to fall back on
+        preprocess_rejected.inc()
+    item = (time.perf_counter_ns(), system_clock(), out)
+    mailbox.put(item)
+    region_mailbox.put(item)
+
+def format_cmd(left, right):
+    return f"CMD: {round(((left)), 1)},{round((right), 1)}\n" # format request to controller
+
+class CarSender(threading.Thread):
+    """
+    Consumer side of the mailbox. Takes the newest gaze sample at most once every min_interval
+    seconds (everything in between is coalesced away), turns it into motor power and writes it to the car.
+
+    Args:
+    mailbox: LatestMailbox fed by gaze_data_callback.
+    car: connection to the car: a car_link.CarLink, or anything with serial.Serial's write / flush.
+    min_interval: float, seconds between commands. 0.1 keeps the old command rate.
+    binary: bool, send 6 byte frames (car_protocol.py) instead of "CMD: l,r" text lines.
+    verbose: bool, print every command sent.
+    tracer: LatencyTracer that gets the stage timestamps of every command sent. Defaults to none.
+    gaze_filter: smoothing between preprocess_gaze and the power mapper, anything make_filter accepts
+                 (e.g. 'one_euro' or {'type': 'ema', 'alpha': 0.1}). It is fed every sample in history,
+                 not just the ones taken from the mailbox. Defaults to none.
+    detector: fixation / saccade detector, anything gaze_events.make_detector accepts ('ivt', 'idt', a dict).
+              Also fed every sample; while the newest one is a saccade or a blink nothing is sent,
+              so the car keeps its last command instead of lurching toward every glance. Defaults to none.
+    history: GazeRingBuffer the callback also writes every sample to, read when gaze_filter or detector is set.
+    power: gazexy -> (left, right) motor power function, e.g. a power_table.PowerTable. Defaults to calculatePower_new3.
+           Without a gaze_filter it is called with the reused gazexy tuple of the sender's GazeSample.
+    gesture: experimental eye-roll recognizer, anything gesture_model.make_gesture_predictor accepts (a model
+             .npz path or a dict). Also fed every sample. A recognized gesture runs its GESTURE_ACTIONS entry
+             ('stop' holds the car until the next one, 'reverse' drives backwards until the next one: both
+             motors flip and swap, so looking right still turns the car's nose right). Models trained on
+             sample_data/ are right on 58% of held-out windows (40% by chance), so this is no way to stop
+             the car yet. Defaults to none.
+    """
+
+    def __init__(self, mailbox, car, min_interval=0.1, binary=True, verbose=True, tracer=None,
+                 gaze_filter=None, detector=None, history=history, power=calculatePower_new3, gesture=None):
+        super().__init__(daemon=True)
+        self.mailbox = mailbox
+        self.car = car
+        self.min_interval = min_interval
+        self.binary = binary
+        self.verbose = verbose
+        self.tracer = tracer
+        self.gaze_filter = make_filter(gaze_filter)
+        self.detector = make_detector(detector)
+        self.power = power
+        self.gesture = make_gesture_predictor(gesture)
+        self.paused = False # stopped by a gesture
+        self.reversed = False # driving backwards by a gesture
+        self.history = history
+        self._cursor = history.cursor
+        self._sample = GazeSample() # refilled for every sample instead of building gazexy lists
+        self.sent = 0 # commands written to the car
+        self.dropped = 0 # samples taken but not sent: preprocess_gaze rejected them or no eye was tracked
+        self.held = 0 # samples not sent because the eye was mid saccade or blinking, or a gesture stopped the car
+        self.gestures = 0 # gestures recognized
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+        self.mailbox.close()
+
+    def run(self):
+        next_send = 0.0
+        while not self._stop_event.is_set():
+            # pace the link; samples arriving meanwhile overwrite each other in the mailbox
+            wait = next_send - time.monotonic()
+            if wait > 0 and self._stop_event.wait(wait):
+                break
+
+            item = self.mailbox.get(timeout=0.5)
+            if item is None:
+                continue
+            self.send(*item)
+            next_send = time.monotonic() + self.min_interval
+
+    # filtered runs the gaze filter over samples (everything that arrived since the last send),
+    # returns the newest filtered gazexy, or None if none of them had a usable eye
+    def filtered(self, samples):
+        gazexy = None
+        for sample in samples:
+            raw = preprocess_gaze(sample)
+            if not isinstance(raw, str):
+                gazexy = self.gaze_filter.filter_gazexy(raw, sample['device_time_stamp'] / 1e6)
+        return gazexy
+
+    # on_gesture runs the GESTURE_ACTIONS entry of a recognized gesture
+    def on_gesture(self, name):
+        self.gestures += 1
+        action = GESTURE_ACTIONS.get(name)
+        if self.verbose:
+            print(f"gesture {name}: {action}")
+        if action == 'stop':
+            self.paused = not self.paused
+            if self.paused:
+                self.car.write(encode_frame(OP_STOP, seq=self.sent) if self.binary else format_cmd(1.0, 1.0).encode())
+                self.car.flush()
+                self.sent += 1
+        elif action == 'reverse':
+            self.reversed = not self.reversed
+
+    # send takes one mailbox item: callback entry time (perf_counter_ns), SDK clock at entry (us) and the gaze sample
+    def send(self, entry_ns, entry_us, out):
+        taken_ns = time.perf_counter_ns()
+        if self.gaze_filter is not None or self.detector is not None or self.gesture is not None:
+            samples, self._cursor = self.history.since(self._cursor)
+            if self.gesture is not None:
+                for sample in samples:
+                    name = self.gesture.update(sample)
+                    if name is not None:
+                        self.on_gesture(name)
+            if self.detector is not None: # fed during a gesture stop too, so it is current when driving resumes
+                for sample in samples:
+                    self.detector.update(sample)
+            if self.paused or (self.detector is not None and self.detector.label in (SACCADE, BLINK)):
+                self.held += 1
+                return
+        gazexy = preprocess_gaze(self._sample.fill(out)) if self.gaze_filter is None else self.filtered(samples)
+        if gazexy is None:
+            gazexy = "o1"
+        preprocess_ns = time.perf_counter_ns()
+        if isinstance(gazexy, str): # both eyes rejected, preprocess_gaze fell back to a region id
+            self.dropped += 1
+            return
+
+        # # stream to bytes
+        # left, right = calculatePower_new2(gazexy)
+        left, right = self.power(gazexy)
+        power_ns = time.perf_counter_ns()
+        if np.isnan(left) or np.isnan(right): # no eye tracked in this sample
+            self.dropped += 1
+            return
+        if self.reversed: # power is 0 to 2 with 1 standing still; swapped too, so the car still turns toward the gaze
+            left, right = 2.0 - right, 2.0 - left
+
+        if self.binary:
+            cmd = encode_power(left, right, self.sent)
+        else:
+            cmd = format_cmd(left, right).encode()
+        encode_ns = time.perf_counter_ns()
+        self.car.write(cmd)
+        write_ns = time.perf_counter_ns()
+        self.car.flush() # make sure it all sends before you start reading
+        flush_ns = time.perf_counter_ns()
+        self.sent += 1
+
+        if self.tracer is not None:
+            self.tracer.record(out['system_time_stamp'], entry_us, entry_ns, taken_ns, preprocess_ns,
+                               power_ns, encode_ns, write_ns, flush_ns)
+        if self.verbose:
+            print(format_cmd(left, right))
+
+class RegionPublisher(threading.Thread):
+    """
+    Second consumer of the gaze samples, for the UI. Not paced like the CarSender: it runs
+    gaze_id on every sample it gets and publishes the region to eye_tracking_data only when it changes.
+
+    Args:
+    mailbox: LatestMailbox fed by gaze_data_callback (region_mailbox).
+    on_change: optional function called with the new region from this thread after every change.
+    dwell_ms: float, a region is published only after the gaze has stayed in it this long
+              (by device_time_stamp). 0 publishes every change.
+    """
+
+    def __init__(self, mailbox, on_change=None, dwell_ms=0.0):
+        super().__init__(daemon=True)
+        self.mailbox = mailbox
+        self.on_change = on_change
+        self.dwell = DwellFilter(dwell_ms)
+        self._sample = GazeSample()
+        self.processed = 0 # samples run through gaze_id
+        self.changes = 0 # times the region changed
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+        self.mailbox.close()
+
+    def run(self):
+        global eye_tracking_data
+        while not self._stop_event.is_set():
+            item = self.mailbox.get(timeout=0.5)
+            if item is None:
+                continue
+            gazexy = preprocess_gaze(self._sample.fill(item[2]))
+            if isinstance(gazexy, str): # rejected sample, keep showing the last region
+                continue
+            region = self.dwell.update(gaze_id(gazexy), item[2]['device_time_stamp'] / 1e6)
+            self.processed += 1
+            if region is None: # nothing held long enough yet
+                continue
+            if region != eye_tracking_data:
+                eye_tracking_data = region
+                self.changes += 1
+                if self.on_change is not None:
+                    self.on_change(region)
+
+# stats returns the pipeline counters: samples from the tracker, samples coalesced in the mailbox,
+# samples dropped by the sender, samples held back during saccades / blinks, commands sent, gestures recognized
+# and region changes published
+def stats():
+    return {
+        'received': mailbox.received,
+        'coalesced': mailbox.coalesced,
+        'dropped': sender.dropped if sender else 0,
+        'sent': sender.sent if sender else 0,
+        'held': sender.held if sender else 0,
+        'gestures': sender.gestures if sender else 0,
+        'region_changes': publisher.changes if publisher else 0,
+        'link': sender.car.metrics() if sender and hasattr(sender.car, 'metrics') else None,
+    }
+
+_deltas = Deltas()
+
+# collect_metrics exports stats() for /metrics. It only reads counters the pipeline keeps anyway,
+# so a scrape adds nothing to the callback or the sender; rates are per second and the invalid fraction per
+# tracker sample (preprocess_rejected over received, before any coalescing) since the previous scrape
+@REGISTRY.collector
+def collect_metrics():
+    s = stats()
+    link = s['link'] or {}
+    rates, changes = _deltas.update({'received': s['received'], 'sent': s['sent'], 'bytes': link.get('sent_bytes', 0),
+                                     'rejected': preprocess_rejected.value})
+    yield 'opticars_gaze_samples_total', 'counter', 'Gaze samples delivered by the tracker callback', s['received']
+    yield 'opticars_gaze_samples_per_second', 'gauge', 'Tracker callback rate since the previous scrape', rates['received']
+    yield 'opticars_mailbox_coalesced_total', 'counter', 'Samples overwritten in the mailbox before the sender took them', s['coalesced']
+    yield 'opticars_mailbox_depth', 'gauge', 'Samples waiting in the sender mailbox (0 or 1)', mailbox.pending
+    yield 'opticars_sender_dropped_total', 'counter', 'Samples taken but not sent because no eye was usable', s['dropped']
+    yield 'opticars_sender_held_total', 'counter', 'Samples not sent during saccades, blinks or a gesture stop', s['held']
+    yield 'opticars_invalid_eye_fraction', 'gauge', 'Share of tracker samples since the previous scrape with no usable eye validity', \
+        changes['rejected'] / changes['received'] if changes['received'] else math.nan
+    yield 'opticars_commands_total', 'counter', 'Commands written to the car', s['sent']
+    yield 'opticars_commands_per_second', 'gauge', 'Command rate since the previous scrape', rates['sent']
+    yield 'opticars_gestures_total', 'counter', 'Eye-roll gestures recognized', s['gestures']
+    yield 'opticars_region_changes_total', 'counter', 'Gaze region changes published to the UI', s['region_changes']
+    if link:
+        yield 'opticars_serial_bytes_total', 'counter', 'Bytes written to the car link', link['sent_bytes']
+        yield 'opticars_serial_bytes_per_second', 'gauge', 'Serial throughput since the previous scrape', rates['bytes']
+        yield 'opticars_link_queue_depth', 'gauge', 'Frames queued in the car link writer', link['queue']
+        yield 'opticars_link_in_flight_bytes', 'gauge', 'Bytes written but estimated not yet through the link', link['in_flight_bytes']
+        yield 'opticars_link_connected', 'gauge', 'Whether the car link is open', link['connected']
+        yield 'opticars_link_reconnects_total', 'counter', 'Car link reconnects', link['reconnects']
+        yield 'opticars_link_superseded_total', 'counter', 'Move frames replaced by a newer one before being written', link['superseded']
+        yield 'opticars_link_lost_frames_total', 'counter', 'Frames lost to write failures', link['lost_frames']
+
+# power_for_user returns calculatePower_new3 compiled to a lookup table at the car's 0.01 resolution
+# (cached on disk after the first run), rescaled with the user's calibration profile if they have one
+def power_for_user(user=None):
+    profile = load_profile(user) if user else None
+    if user and profile is None:
+        print(f"no calibration profile for {user}, using the default range")
+    if profile is None:
+        return compile_power(calculatePower_new3)
+    limit = max(1.2, max(abs(b) for b in profile.bounds()))
+    return compile_power(partial(calculatePower_new3, profile=profile), limit=limit)
+
+# trace_path: where the per-stage latency summary is written every 10 s (None turns tracing off)
+# gaze_filter: per-user smoothing setting passed to CarSender (see gaze_filters.make_filter)
+# detector: saccade / blink detector setting passed to CarSender (see gaze_events.make_detector)
+# dwell_ms: how long the gaze must stay in a region before the UI highlights it
+# user: name of a calibration profile (see calibration.py) to rescale gaze with instead of the fixed +-1.2 range
+# on_change: called with every new region from the RegionPublisher thread (the flask UI pushes them to the page)
+def update_eye_tracking_data(trace_path='latency_trace.json', gaze_filter=None, detector='ivt', dwell_ms=100.0, user=None,
+                             gesture=None, on_change=None):
+    global sender, publisher
     baud = 9600
     bluetoothPort = "COM14"
-    car = serial.Serial(bluetoothPort, baud)
+    car = CarLink(bluetoothPort, baud) # opens (and reopens) the port on its own thread, writes never block
+
+    tracer = LatencyTracer(trace_path) if trace_path else None
+    power = power_for_user(user)
+    sender = CarSender(mailbox, car, tracer=tracer, gaze_filter=gaze_filter, detector=detector, power=power,
+                       gesture=gesture)
+    sender.start()
+    publisher = RegionPublisher(region_mailbox, on_change=on_change, dwell_ms=dwell_ms)
+    publisher.start()
 
     TRACKER = get_tracker()
-    
+
     TRACKER.subscribe_to(tr.EYETRACKER_GAZE_DATA, gaze_data_callback, as_dictionary=True)
 
     try:
@@ -47,7 +330,14 @@ def update_eye_tracking_data():
         # print("ouch")
         TRACKER.unsubscribe_from(tr.EYETRACKER_GAZE_DATA, gaze_data_callback)
 
-        car.close() 
+        sender.stop()
+        publisher.stop()
+        sender.join()
+        publisher.join()
+        if tracer is not None:
+            tracer.flush()
+            tracer.dump(trace_path)
+        car.close()
 
 # Start a thread to continuously update eye tracking data
 if __name__ == '__main__':
@@ -1,24 +1,70 @@
-from flask import Flask, render_template
-from flask_socketio import SocketIO
+from flask import Flask, Response, render_template
+from flask_socketio import SocketIO, emit
+from eventlet import tpool
+import os
 import threading
+import time
 import eye_tracking
+import metrics
+from utils import LatestMailbox
 
 app = Flask(__name__)
 socketio = SocketIO(app, async_mode='eventlet')
 
+MAX_RATE_HZ = 30 # most region updates pushed per second, None for no limit
+USER = os.environ.get('OPTICARS_USER') # calibration profile to drive with (python calibration.py <bounds.csv> makes one)
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+# Prometheus scrape target: reads the pipeline's counters, never waits on the tracker or sender threads
+@app.route('/metrics')
+def metrics_route():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+# RegionPublisher's on_change puts every new region here from the tracking thread; only the newest is kept
+region_updates = LatestMailbox()
+
+# push_regions broadcasts the gaze region whenever the tracking thread publishes a new one,
+# at most max_rate times a second. A region that changes and changes back inside one
+# throttle window is never sent.
+def push_regions(max_rate=MAX_RATE_HZ):
+    min_gap = 1.0 / max_rate if max_rate else 0.0
+    last_sent = None
+    next_emit = 0.0
+    while True:
+        # the tracking thread is a real thread: wait for it in eventlet's native thread pool so the hub keeps serving
+        region = tpool.execute(region_updates.get, 1.0)
+        if region is None: # nothing new within the timeout
+            continue
+        now = time.monotonic()
+        if now < next_emit:
+            socketio.sleep(next_emit - now)
+            region = region_updates.get(0) or region # anything that came in meanwhile replaces it
+            now = time.monotonic()
+        if region == last_sent:
+            continue
+        socketio.emit('update_eye_tracking_data', {'data': region})
+        last_sent = region
+        next_emit = now + min_gap
+
+@socketio.on('connect')
+def on_connect():
+    # a new page gets the current region right away instead of waiting for the next change
+    if eye_tracking.eye_tracking_data is not None:
+        emit('update_eye_tracking_data', {'data': eye_tracking.eye_tracking_data})
+
+# kept for clients that still ask, answers only the client that asked
 @socketio.on('get_eye_tracking_data')
 def get_eye_tracking_data():
-    eye_tracking_data = eye_tracking.eye_tracking_data
-    # print(eye_tracking_data)
-    socketio.emit('update_eye_tracking_data', {'data': eye_tracking_data})
+    emit('update_eye_tracking_data', {'data': eye_tracking.eye_tracking_data})
 
 if __name__ == '__main__':
     # start the eye tracking script
-    threading.Thread(target=eye_tracking.update_eye_tracking_data).start()
+    threading.Thread(target=eye_tracking.update_eye_tracking_data,
+                     kwargs={'user': USER, 'on_change': region_updates.put}).start()
+    socketio.start_background_task(push_regions)
 
     # start the Flask app
     socketio.run(app, debug=True, port=5001)
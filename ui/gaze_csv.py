@@ -0,0 +1,84 @@
+import warnings
+import numpy as np
+import pandas as pd
+from gaze_frame import GazeFrame, component_names
+
+def tuple_columns(df):
+    """
+    Finds the columns whose cells are stringified tuples such as "(0.66, -0.19)" or "(nan, nan, nan)",
+    judging by the first non-empty cell. Cells that turn out not to parse are handled in parse_tuple_column.
+
+    Returns:
+    dict of column name -> number of tuple components.
+    """
+    found = {}
+    for name in df.columns:
+        if df[name].dtype != object:
+            continue
+        for value in df[name].to_numpy():
+            if isinstance(value, str):
+                if value.startswith('(') and value.endswith(')'):
+                    found[name] = value.count(',') + 1
+                break
+    return found
+
+def parse_tuple_column(values, n_comp):
+    """
+    Parses a column of stringified tuples into an (n, n_comp) float64 array with one
+    np.fromstring call over the whole column. Empty cells and "nan" components become nan.
+    """
+    missing = ','.join(['nan'] * n_comp)
+    inner = [v[1:-1] if isinstance(v, str) else missing for v in values]
+    try:
+        # fromstring only warns on malformed text, make it an error so we can fall back
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', DeprecationWarning)
+            flat = np.fromstring(','.join(inner), sep=',')
+    except (ValueError, DeprecationWarning):
+        flat = None
+    if flat is None or flat.size != len(inner) * n_comp:
+        # ragged or malformed cells: split per cell and let anything unparsable be nan
+        parts = pd.Series(inner).str.split(',', expand=True).reindex(columns=range(n_comp))
+        return parts.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+    return flat.reshape(-1, n_comp)
+
+def read_gaze_csv(file_path, label=None, split=True):
+    '''
+    Reads a gaze csv (as written by build_dataset(...).to_csv) without evaluating tuples cell by cell.
+    Tuple columns are discovered automatically and parsed with one vectorized split per column.
+    file_path: path to csv file
+    label: if given, stored in the 'type' column
+    split: if True each tuple column becomes float columns key_x, key_y(, key_z).
+           if False the tuple columns are rebuilt as tuples, identical to the old
+           ast.literal_eval converters (a tuple containing nan becomes None)
+
+    returns: dataframe with data from csv file
+    '''
+    df = pd.read_csv(file_path)
+    tuples = tuple_columns(df)
+
+    if split:
+        data = {}
+        for name in df.columns:
+            if name not in tuples:
+                data[name] = df[name].to_numpy()
+                continue
+            parsed = parse_tuple_column(df[name].to_numpy(), tuples[name])
+            for i, col in enumerate(component_names(name, tuples[name])):
+                data[col] = parsed[:, i]
+        df = pd.DataFrame(data, index=df.index)
+    else:
+        for name, n_comp in tuples.items():
+            parsed = parse_tuple_column(df[name].to_numpy(), n_comp)
+            rows = list(map(tuple, parsed.tolist()))
+            for i in np.flatnonzero(np.isnan(parsed).any(axis=1)):
+                rows[i] = None
+            df[name] = rows
+
+    if label is not None:
+        df['type'] = label
+    return df
+
+def load_gaze_frame(file_path, label=None, dtype=np.float32):
+    """Reads a gaze csv straight into a GazeFrame."""
+    return GazeFrame.from_pandas(read_gaze_csv(file_path, label, split=True), dtype=dtype)
@@ -0,0 +1,306 @@
+'''
+    gaze_events.py
+    @file      gaze_events.py
+    @brief     Fixation / saccade / blink detection from consecutive gaze samples (I-VT and I-DT)
+
+    Gaze direction comes from the user coordinate system fields every tobii sample carries: the
+    vector from gaze_origin to gaze_point, averaged over the valid eyes, expressed as azimuth and
+    elevation in degrees. Time comes from device_time_stamp.
+
+        IVTDetector   velocity threshold: saccade while the angular speed over the last `window`
+                      samples is above velocity_threshold (deg/s)
+        IDTDetector   dispersion threshold: fixation while the last `window` samples stay within
+                      dispersion_threshold degrees (azimuth range + elevation range)
+
+    Samples with no valid eye are BLINK for the first blink_max_ms of the gap and LOST after that.
+    Velocity and dispersion windows never reach back across a gap.
+
+    Each detector has an incremental API (update(sample) -> label, constant time per sample) for the
+    live controller and a vectorized batch(frame) -> labels for whole recordings. Both give the same
+    labels; python gaze_events.py checks that and times them.
+'''
+
+import math
+import time
+from collections import deque
+import numpy as np
+
+FIXATION = 0
+SACCADE = 1
+BLINK = 2
+LOST = 3
+EVENT_NAMES = ('fixation', 'saccade', 'blink', 'lost')
+
+################################################
+# GAZE ANGLES
+################################################
+
+def sample_angles(sample):
+    """
+    Returns (azimuth, elevation) in degrees for one gaze dictionary, or None if no eye is valid.
+    Azimuth grows to the right, elevation upwards, (0, 0) is straight at the tracker's z axis.
+    """
+    vx = vy = vz = 0.0
+    valid = False
+    for eye in ('left', 'right'):
+        if sample[f'{eye}_gaze_point_validity'] != 1:
+            continue
+        point = sample[f'{eye}_gaze_point_in_user_coordinate_system']
+        origin = sample[f'{eye}_gaze_origin_in_user_coordinate_system']
+        if point is None or origin is None:
+            continue
+        dx, dy, dz = point[0] - origin[0], point[1] - origin[1], point[2] - origin[2]
+        if dx != dx or dy != dy or dz != dz:
+            continue
+        vx += dx
+        vy += dy
+        vz += dz
+        valid = True
+    if not valid:
+        return None
+    return math.degrees(math.atan2(vx, -vz)), math.degrees(math.atan2(vy, -vz))
+
+def frame_angles(frame):
+    """sample_angles for a whole GazeFrame: (azimuth, elevation) float64 arrays, nan where no eye is valid."""
+    n = len(frame)
+    v = np.zeros((3, n))
+    valid = np.zeros(n, dtype=bool)
+    for eye in ('left', 'right'):
+        d = np.stack([frame[f'{eye}_gaze_point_in_user_coordinate_system_{a}'].astype(np.float64)
+                      - frame[f'{eye}_gaze_origin_in_user_coordinate_system_{a}'].astype(np.float64) for a in 'xyz'])
+        ok = (frame[f'{eye}_gaze_point_validity'] == 1) & ~np.isnan(d).any(axis=0)
+        v += np.where(ok, d, 0.0)
+        valid |= ok
+    az = np.degrees(np.arctan2(v[0], -v[2]))
+    el = np.degrees(np.arctan2(v[1], -v[2]))
+    az[~valid] = np.nan
+    el[~valid] = np.nan
+    return az, el
+
+def frame_seconds(frame):
+    return frame['device_time_stamp'].astype(np.float64) / 1e6
+
+def _run_starts(mask):
+    """For every index, the index where the current run of True (or of False) in mask started."""
+    idx = np.arange(len(mask))
+    changed = np.ones(len(mask), dtype=bool)
+    changed[1:] = mask[1:] != mask[:-1]
+    return np.maximum.accumulate(np.where(changed, idx, 0))
+
+def _gap_labels(t, starts, blink_max_ms):
+    gap_ms = (t - t[starts]) * 1000
+    return np.where(gap_ms <= blink_max_ms, BLINK, LOST)
+
+################################################
+# DETECTORS
+################################################
+
+class EventDetector:
+    """
+    Shared gap handling. Subclasses implement _classify(t, az, el) for valid samples,
+    _reset_window() and _batch_valid(t, az, el, starts) for the vectorized path.
+
+    Args:
+    blink_max_ms: float, gaps up to this long are blinks, longer ones are tracking loss.
+    """
+
+    def __init__(self, blink_max_ms=500.0):
+        self.blink_max_ms = blink_max_ms
+        self.label = None # label of the last sample
+        self._gap_start = None # timestamp of the first invalid sample of the current gap
+
+    def update(self, sample):
+        """Labels one gaze dictionary. Returns FIXATION, SACCADE, BLINK or LOST."""
+        t = sample['device_time_stamp'] / 1e6
+        angles = sample_angles(sample)
+        if angles is None:
+            if self._gap_start is None:
+                self._gap_start = t
+                self._reset_window()
+            self.label = BLINK if (t - self._gap_start) * 1000 <= self.blink_max_ms else LOST
+        else:
+            self._gap_start = None
+            self.label = self._classify(t, angles[0], angles[1])
+        return self.label
+
+    def reset(self):
+        self.label = None
+        self._gap_start = None
+        self._reset_window()
+
+    def batch(self, frame):
+        """Labels every sample of a GazeFrame (int8 array), the same as calling update() on each from a fresh state."""
+        t = frame_seconds(frame)
+        az, el = frame_angles(frame)
+        valid = ~np.isnan(az)
+        starts = _run_starts(valid)
+        labels = np.where(valid, FIXATION, _gap_labels(t, starts, self.blink_max_ms)).astype(np.int8)
+        labels[valid & self._batch_valid(t, az, el, starts)] = SACCADE
+        return labels
+
+class IVTDetector(EventDetector):
+    """
+    Velocity-threshold (I-VT) detector.
+
+    Args:
+    velocity_threshold: float, deg/s. 30 is the usual value for 600 Hz trackers.
+    window: int, samples between the two ends of the velocity estimate (18 is 30 ms at 600 Hz).
+            Shorter windows turn fixational noise into saccades.
+    blink_max_ms: see EventDetector.
+    """
+
+    def __init__(self, velocity_threshold=30.0, window=18, blink_max_ms=500.0):
+        super().__init__(blink_max_ms)
+        self.velocity_threshold = velocity_threshold
+        self.window = window
+        self.velocity = math.nan # deg/s at the last valid sample
+        self._recent = deque(maxlen=window + 1)
+
+    def _reset_window(self):
+        self._recent.clear()
+
+    def _classify(self, t, az, el):
+        recent = self._recent
+        recent.append((t, az, el))
+        t0, az0, el0 = recent[0]
+        dt = t - t0
+        self.velocity = math.hypot(az - az0, el - el0) / dt if dt > 0 else math.nan
+        return SACCADE if self.velocity > self.velocity_threshold else FIXATION
+
+    def _batch_valid(self, t, az, el, starts):
+        ref = np.maximum(np.arange(len(t)) - self.window, starts)
+        dt = t - t[ref]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            velocity = np.hypot(az - az[ref], el - el[ref]) / dt
+        velocity[~(dt > 0)] = np.nan
+        return velocity > self.velocity_threshold
+
+class IDTDetector(EventDetector):
+    """
+    Dispersion-threshold (I-DT) detector, causal version: a sample is part of a fixation when it and
+    the window - 1 samples before it span at most dispersion_threshold degrees.
+
+    Args:
+    dispersion_threshold: float, degrees of (azimuth range + elevation range).
+    window: int, samples in the dispersion window (48 is 80 ms at 600 Hz).
+    blink_max_ms: see EventDetector.
+    """
+
+    def __init__(self, dispersion_threshold=1.5, window=48, blink_max_ms=500.0):
+        super().__init__(blink_max_ms)
+        self.dispersion_threshold = dispersion_threshold
+        self.window = window
+        self.dispersion = math.nan # degrees at the last valid sample
+        # monotonic deques of (index, value): sliding max / min in amortized O(1)
+        self._extremes = [deque(), deque(), deque(), deque()] # az max, az min, el max, el min
+        self._i = 0
+
+    def _reset_window(self):
+        for d in self._extremes:
+            d.clear()
+
+    def _classify(self, t, az, el):
+        i = self._i = self._i + 1
+        oldest = i - self.window
+        extremes = []
+        for d, value, sign in zip(self._extremes, (az, az, el, el), (1, -1, 1, -1)):
+            while d and (d[-1][1] - value) * sign <= 0:
+                d.pop()
+            d.append((i, value))
+            while d[0][0] <= oldest:
+                d.popleft()
+            extremes.append(d[0][1])
+        az_max, az_min, el_max, el_min = extremes
+        spread = self.dispersion = (az_max - az_min) + (el_max - el_min)
+        return SACCADE if spread > self.dispersion_threshold else FIXATION
+
+    def _batch_valid(self, t, az, el, starts):
+        spread = ((_window_max(az, self.window, starts) - _window_min(az, self.window, starts))
+                  + (_window_max(el, self.window, starts) - _window_min(el, self.window, starts)))
+        with np.errstate(invalid='ignore'):
+            return spread > self.dispersion_threshold
+
+def _window_max(x, w, starts):
+    """
+    Max of x over [max(i - w + 1, starts[i]), i] for every i, in O(n) with the van Herk / Gil-Werman
+    block trick: cut x into blocks of w, then each window is one block suffix plus one block prefix.
+    """
+    n = len(x)
+    blocks = np.concatenate([x, np.full(-n % w, -np.inf)]).reshape(-1, w)
+    prefix = np.maximum.accumulate(blocks, axis=1).ravel()[:n]
+    suffix = np.maximum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()[:n]
+    out = prefix.copy()
+    out[w - 1:] = np.maximum(suffix[:n - w + 1], prefix[w - 1:])
+    # the first w - 1 samples of each run: the window is cut at the run start instead
+    for s in np.flatnonzero(starts == np.arange(n)):
+        end = s + 1
+        while end < min(n, s + w - 1) and starts[end] == s:
+            end += 1
+        out[s:end] = np.maximum.accumulate(x[s:end])
+    return out
+
+def _window_min(x, w, starts):
+    return -_window_max(-x, w, starts)
+
+DETECTORS = {'ivt': IVTDetector, 'idt': IDTDetector}
+
+def make_detector(config):
+    """Builds a detector from None, 'ivt' / 'idt', or a dict like {'type': 'ivt', 'velocity_threshold': 40}."""
+    if config is None or isinstance(config, EventDetector):
+        return config
+    params = {'type': config} if isinstance(config, str) else dict(config)
+    kind = params.pop('type')
+    if kind not in DETECTORS:
+        raise ValueError(f"unknown event detector {kind}, expected one of {', '.join(DETECTORS)}")
+    return DETECTORS[kind](**params)
+
+################################################
+# EVENTS
+################################################
+
+def events(labels, t):
+    """Run-length encodes per-sample labels into (label, start_time, end_time, n_samples) events."""
+    labels = np.asarray(labels)
+    if len(labels) == 0:
+        return []
+    edges = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+    starts = np.concatenate([[0], edges])
+    ends = np.concatenate([edges, [len(labels)]])
+    return [(int(labels[s]), float(t[s]), float(t[e - 1]), int(e - s)) for s, e in zip(starts, ends)]
+
+def summarize(labels, t):
+    """Count and mean duration (ms) of each event type."""
+    out = {}
+    for label, name in enumerate(EVENT_NAMES):
+        durations = [(end - start) * 1000 for l, start, end, n in events(labels, t) if l == label]
+        out[name] = {'count': len(durations), 'mean_ms': round(float(np.mean(durations)), 1) if durations else 0.0}
+    return out
+
+################################################
+# SELF CHECK
+################################################
+
+def _self_check(seconds=60.0, rate_hz=600):
+    from sim_tracker import synthetic_frame, frame_to_dicts
+
+    frame = synthetic_frame(seconds, rate_hz, pattern='saccades', period=0.4, blink_every=3.0)
+    samples = frame_to_dicts(frame)
+    t = frame_seconds(frame)
+    for detector in (IVTDetector(), IDTDetector()):
+        name = type(detector).__name__
+        start = time.perf_counter()
+        labels = detector.batch(frame)
+        batch_rate = len(frame) / (time.perf_counter() - start)
+
+        detector.reset()
+        start = time.perf_counter()
+        streamed = np.array([detector.update(sample) for sample in samples], dtype=np.int8)
+        us_per_sample = (time.perf_counter() - start) / len(samples) * 1e6
+
+        mismatches = int((streamed != labels).sum())
+        assert mismatches == 0, f"{name}: {mismatches} samples differ between update() and batch()"
+        print(f"{name}: batch {batch_rate / 1e6:.1f} M samples/s, update {us_per_sample:.1f} us/sample, labels match")
+        print(f"  {summarize(labels, t)}")
+
+if __name__ == '__main__':
+    _self_check()
@@ -0,0 +1,439 @@
+'''
+    gaze_features.py
+    @file      gaze_features.py
+    @brief     Sliding-window gaze features for gesture recognition (batch and streaming)
+
+    Every sample first gets a few per-sample signals: gaze angles (gaze_events.sample_angles), the
+    angular step from the previous sample and the speed / acceleration it gives, binocular disparity
+    (distance between the two eyes' points on the display area) and the mean pupil diameter of the
+    valid eyes. Signals that can't be computed (eye lost, first sample, repeated timestamp) are nan.
+
+    A window is the last `window` samples ending at a sample, and one is emitted every `stride`
+    samples. Its features (FEATURE_NAMES) are statistics of the signals over the valid samples:
+
+        velocity_mean / _max       deg/s
+        acceleration_mean / _max   deg/s^2, absolute
+        dispersion                 degrees, azimuth range + elevation range
+        direction / amplitude      degrees, of the summed gaze steps (0 = right, 90 = up, nan when they cancel out)
+        disparity_mean / _std      display area units
+        pupil_mean / _std          mm
+        valid_fraction             share of samples with a valid gaze direction
+
+    batch(frame) computes every window of a recording at once, with no per-window Python loop: sums
+    and counts come from cumulative sums, maxima / minima are reductions over sliding_window_view.
+    update(sample) is the live version: running sums and monotonic deques make it constant time per
+    sample whatever the window. Both give the same features; python gaze_features.py checks that
+    and times them.
+
+    Windows count samples, so features only compare between streams at the same rate. resample_frame
+    and Resampler put a recording or a live stream on a fixed time base first: one sample per tick of
+    rate_hz, the latest one at or before the tick, stamped with the tick's time.
+'''
+
+import math
+import time
+from collections import deque
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from gaze_events import sample_angles, frame_angles, frame_seconds
+
+FEATURE_NAMES = (
+    'velocity_mean', 'velocity_max',
+    'acceleration_mean', 'acceleration_max',
+    'dispersion', 'direction', 'amplitude',
+    'disparity_mean', 'disparity_std',
+    'pupil_mean', 'pupil_std',
+    'valid_fraction',
+)
+
+MIN_AMPLITUDE = 1e-6 # degrees; below it direction is rounding noise (batch and update round differently)
+
+################################################
+# PER-SAMPLE SIGNALS
+################################################
+
+def frame_signals(frame):
+    """{signal name: float64 array} for every sample of a GazeFrame, nan where it can't be computed."""
+    t = frame_seconds(frame)
+    az, el = frame_angles(frame)
+    n = len(frame)
+    dt = np.full(n, np.nan)
+    dt[1:] = np.diff(t)
+    dt[~(dt > 0)] = np.nan
+    step_az = np.full(n, np.nan)
+    step_el = np.full(n, np.nan)
+    step_az[1:] = np.diff(az)
+    step_el[1:] = np.diff(el)
+    step_az[np.isnan(dt)] = np.nan
+    step_el[np.isnan(dt)] = np.nan
+    velocity = np.hypot(step_az, step_el) / dt
+    acceleration = np.full(n, np.nan)
+    acceleration[1:] = np.abs(np.diff(velocity)) / dt[1:]
+
+    both = (frame['left_gaze_point_validity'] == 1) & (frame['right_gaze_point_validity'] == 1)
+    disparity = np.hypot(frame['left_gaze_point_on_display_area_x'].astype(np.float64) - frame['right_gaze_point_on_display_area_x'],
+                         frame['left_gaze_point_on_display_area_y'].astype(np.float64) - frame['right_gaze_point_on_display_area_y'])
+    disparity[~both] = np.nan
+
+    total = np.zeros(n)
+    count = np.zeros(n)
+    for eye in ('left', 'right'):
+        d = frame[f'{eye}_pupil_diameter'].astype(np.float64)
+        ok = (frame[f'{eye}_pupil_validity'] == 1) & ~np.isnan(d)
+        total += np.where(ok, d, 0.0)
+        count += ok
+    with np.errstate(invalid='ignore'):
+        pupil = total / count
+    return {'azimuth': az, 'elevation': el, 'velocity': velocity, 'acceleration': acceleration,
+            'step_az': step_az, 'step_el': step_el, 'disparity': disparity, 'pupil': pupil}
+
+def _sample_pupil(sample):
+    total = count = 0
+    for eye in ('left', 'right'):
+        d = sample[f'{eye}_pupil_diameter']
+        if sample[f'{eye}_pupil_validity'] == 1 and d == d:
+            total += d
+            count += 1
+    return total / count if count else math.nan
+
+def _sample_disparity(sample):
+    if sample['left_gaze_point_validity'] != 1 or sample['right_gaze_point_validity'] != 1:
+        return math.nan
+    left, right = sample['left_gaze_point_on_display_area'], sample['right_gaze_point_on_display_area']
+    return math.hypot(left[0] - right[0], left[1] - right[1])
+
+################################################
+# RESAMPLING
+################################################
+
+def _tick(t0, k, rate_hz):
+    return t0 + int(round(k * 1e6 / rate_hz))
+
+def resample_indices(t_us, rate_hz):
+    """
+    (rows, ticks) putting device_time_stamps t_us on a rate_hz grid starting at t_us[0]: ticks[k] is the k-th
+    tick in microseconds and rows[k] the latest sample at or before it. Only ticks before the last sample are
+    kept, as a stream can't know a tick's sample until a later one arrives.
+    """
+    t_us = np.asarray(t_us, dtype=np.int64)
+    if len(t_us) < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    t0 = int(t_us[0])
+    n = int((t_us[-1] - t0) * rate_hz / 1e6) + 2
+    ticks = np.array([_tick(t0, k, rate_hz) for k in range(n)], dtype=np.int64)
+    ticks = ticks[ticks < t_us[-1]]
+    return np.searchsorted(t_us, ticks, side='right') - 1, ticks
+
+def resample_frame(frame, rate_hz):
+    """The GazeFrame on a rate_hz time base (see resample_indices): a copy of the picked rows with the ticks as device_time_stamp."""
+    rows, ticks = resample_indices(frame['device_time_stamp'], rate_hz)
+    out = frame[rows]
+    out.columns['device_time_stamp'] = ticks.astype(out.columns['device_time_stamp'].dtype)
+    return out
+
+class Resampler:
+    """
+    Streaming resample_frame: update() takes gaze dictionaries at any rate and returns the ones due on the
+    rate_hz time base (usually none, one per tick).
+
+    Args:
+    rate_hz: float, ticks per second.
+    """
+
+    def __init__(self, rate_hz):
+        if not rate_hz > 0:
+            raise ValueError("rate_hz must be positive")
+        self.rate_hz = rate_hz
+        self._held = None # latest sample so far
+        self._t0 = None
+        self._k = 0
+        self._next = None # time of tick k
+
+    def reset(self):
+        self.__init__(self.rate_hz)
+
+    def update(self, sample):
+        t = sample['device_time_stamp']
+        if self._held is None:
+            self._held, self._t0, self._next = sample, t, t
+            return ()
+        out = ()
+        while self._next < t: # no later sample can land on this tick any more
+            out += (dict(self._held, device_time_stamp=self._next),)
+            self._k += 1
+            self._next = _tick(self._t0, self._k, self.rate_hz)
+        self._held = sample
+        return out
+
+################################################
+# WINDOW FEATURES
+################################################
+
+def _window_sums(x, w, stride):
+    """
+    (count, mean, variance) of the non-nan values of every window, from cumulative sums: O(n) whatever w is.
+    Values are centred on their overall mean first so the variance doesn't cancel away.
+    """
+    valid = ~np.isnan(x)
+    center = x[valid].mean() if valid.any() else 0.0
+    y = np.where(valid, x - center, 0.0)
+    def sums(v):
+        c = np.concatenate([[0.0], np.cumsum(v)])
+        return (c[w:] - c[:-w])[::stride]
+    n = sums(valid.astype(np.float64))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = sums(y) / n
+        var = np.maximum(sums(y * y) / n - mean * mean, 0.0)
+    return n, mean + center, var
+
+def _window_max(x, w, stride):
+    """Max of the non-nan values of every window: a reduction over the strided view, nan for an all-nan window."""
+    filled = np.where(np.isnan(x), -np.inf, x)
+    out = sliding_window_view(filled, w)[::stride].max(axis=1)
+    out[out == -np.inf] = np.nan
+    return out
+
+def _window_min(x, w, stride):
+    return -_window_max(-x, w, stride)
+
+class _WindowStat:
+    """Count / mean / variance of the non-nan values in a window, with Welford updates for values entering and leaving."""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, x):
+        if x != x:
+            return
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def remove(self, x):
+        if x != x:
+            return
+        self.n -= 1
+        if self.n == 0: # start clean so rounding never carries over a gap
+            self.mean = self.m2 = 0.0
+            return
+        delta = x - self.mean
+        self.mean -= delta / self.n
+        self.m2 = max(self.m2 - delta * (x - self.mean), 0.0)
+
+    def average(self):
+        return self.mean if self.n else math.nan
+
+    def std(self):
+        return math.sqrt(self.m2 / self.n) if self.n else math.nan
+
+    def total(self):
+        return self.mean * self.n
+
+class _WindowExtreme:
+    """Max (sign 1) or min (sign -1) of the non-nan values in a window: monotonic deque of (index, value)."""
+
+    def __init__(self, sign=1):
+        self.sign = sign
+        self.items = deque()
+
+    def add(self, i, x):
+        if x != x:
+            return
+        items, sign = self.items, self.sign
+        while items and (items[-1][1] - x) * sign <= 0:
+            items.pop()
+        items.append((i, x))
+
+    def expire(self, oldest):
+        """Drops values with index < oldest."""
+        items = self.items
+        while items and items[0][0] < oldest:
+            items.popleft()
+
+    def value(self):
+        return self.items[0][1] if self.items else math.nan
+
+################################################
+# EXTRACTOR
+################################################
+
+class FeatureExtractor:
+    """
+    Windowed gaze features.
+
+    Args:
+    window: int, samples per window (120 is 200 ms at 600 Hz).
+    stride: int, samples between the ends of consecutive windows.
+    """
+
+    def __init__(self, window=120, stride=12):
+        if window < 2 or stride < 1:
+            raise ValueError("window must be at least 2 samples and stride at least 1")
+        self.window = window
+        self.stride = stride
+        self.features = None # features of the last emitted window
+        self._recent = deque(maxlen=window) # per-sample signals in the window
+        self._stats = {name: _WindowStat() for name in ('velocity', 'acceleration', 'step_az', 'disparity', 'pupil')}
+        self._extremes = {name: _WindowExtreme(sign) for name, sign in
+                          (('velocity', 1), ('acceleration', 1), ('az_max', 1), ('az_min', -1), ('el_max', 1), ('el_min', -1))}
+        self._step_el = 0.0
+        self._valid = 0
+        self._prev = None # (t, az, el, velocity) of the previous sample
+        self._i = 0
+
+    def reset(self):
+        self.__init__(self.window, self.stride)
+
+    def batch(self, frame):
+        """
+        Features of every window of a GazeFrame, the same as calling update() on each sample from a fresh state.
+
+        Returns: (ends, X), the index of each window's last sample and an (n_windows, len(FEATURE_NAMES)) float64 array.
+        """
+        signals = frame_signals(frame)
+        n, w, stride = len(frame), self.window, self.stride
+        if n < w:
+            return np.empty(0, dtype=np.int64), np.empty((0, len(FEATURE_NAMES)))
+        ends = np.arange(w - 1, n, stride)
+        az, el = signals['azimuth'], signals['elevation']
+        valid, _, _ = _window_sums(az, w, stride)
+        _, velocity, _ = _window_sums(signals['velocity'], w, stride)
+        _, acceleration, _ = _window_sums(signals['acceleration'], w, stride)
+        steps, step_az, _ = _window_sums(signals['step_az'], w, stride)
+        step_el = _window_sums(signals['step_el'], w, stride)[1] * steps # step_el is valid exactly where step_az is
+        step_az = step_az * steps
+        _, disparity, disparity_var = _window_sums(signals['disparity'], w, stride)
+        _, pupil, pupil_var = _window_sums(signals['pupil'], w, stride)
+        amplitude = np.hypot(step_az, step_el)
+        direction = np.where(amplitude > MIN_AMPLITUDE, np.degrees(np.arctan2(step_el, step_az)), np.nan)
+        dispersion = ((_window_max(az, w, stride) - _window_min(az, w, stride))
+                      + (_window_max(el, w, stride) - _window_min(el, w, stride)))
+        X = np.column_stack([
+            velocity, _window_max(signals['velocity'], w, stride),
+            acceleration, _window_max(signals['acceleration'], w, stride),
+            dispersion, direction, amplitude,
+            disparity, np.sqrt(disparity_var),
+            pupil, np.sqrt(pupil_var),
+            valid / w,
+        ])
+        return ends, X
+
+    def update(self, sample):
+        """
+        Adds one gaze dictionary. Returns the features of the window ending at it (an array in FEATURE_NAMES
+        order) when a window is due, None otherwise.
+        """
+        t = sample['device_time_stamp'] / 1e6
+        angles = sample_angles(sample)
+        az, el = angles if angles is not None else (math.nan, math.nan)
+        step_az = step_el = velocity = acceleration = math.nan
+        if self._prev is not None and t > self._prev[0]:
+            t0, az0, el0, v0 = self._prev
+            dt = t - t0
+            step_az, step_el = az - az0, el - el0
+            velocity = math.hypot(step_az, step_el) / dt
+            acceleration = abs(velocity - v0) / dt
+        self._prev = (t, az, el, velocity)
+        signals = (az, el, velocity, acceleration, step_az, step_el, _sample_disparity(sample), _sample_pupil(sample))
+
+        if len(self._recent) == self.window:
+            self._account(self._recent[0], -1)
+        self._recent.append(signals)
+        self._account(signals, 1)
+        i = self._i
+        self._i += 1
+        extremes = self._extremes
+        for name, value in (('velocity', velocity), ('acceleration', acceleration), ('az_max', az), ('az_min', az),
+                            ('el_max', el), ('el_min', el)):
+            extreme = extremes[name]
+            extreme.add(i, value)
+            extreme.expire(i - self.window + 1)
+
+        if self._i < self.window or (self._i - self.window) % self.stride:
+            return None
+        self.features = self._current()
+        return self.features
+
+    def _account(self, signals, sign):
+        az, el, velocity, acceleration, step_az, step_el, disparity, pupil = signals
+        stats = self._stats
+        for name, value in (('velocity', velocity), ('acceleration', acceleration), ('step_az', step_az),
+                            ('disparity', disparity), ('pupil', pupil)):
+            (stats[name].add if sign > 0 else stats[name].remove)(value)
+        if step_az == step_az:
+            self._step_el += sign * step_el
+        if az == az:
+            self._valid += sign
+        if stats['step_az'].n == 0:
+            self._step_el = 0.0
+
+    def _current(self):
+        stats, extremes = self._stats, self._extremes
+        direction = amplitude = math.nan
+        if stats['step_az'].n:
+            step_az = stats['step_az'].total()
+            amplitude = math.hypot(step_az, self._step_el)
+            if amplitude > MIN_AMPLITUDE:
+                direction = math.degrees(math.atan2(self._step_el, step_az))
+        dispersion = ((extremes['az_max'].value() - extremes['az_min'].value())
+                      + (extremes['el_max'].value() - extremes['el_min'].value()))
+        return np.array([
+            stats['velocity'].average(), extremes['velocity'].value(),
+            stats['acceleration'].average(), extremes['acceleration'].value(),
+            dispersion, direction, amplitude,
+            stats['disparity'].average(), stats['disparity'].std(),
+            stats['pupil'].average(), stats['pupil'].std(),
+            self._valid / self.window,
+        ])
+
+def features_frame(frame, window=120, stride=12):
+    """batch() as a dataframe: one row per window with its end time (device_time_stamp) and the features."""
+    import pandas as pd
+    ends, X = FeatureExtractor(window, stride).batch(frame)
+    df = pd.DataFrame(X, columns=FEATURE_NAMES)
+    df.insert(0, 'device_time_stamp', frame['device_time_stamp'][ends])
+    return df
+
+################################################
+# SELF CHECK
+################################################
+
+def _self_check(seconds=60.0, rate_hz=600):
+    from sim_tracker import synthetic_frame, frame_to_dicts
+
+    frame = synthetic_frame(seconds, rate_hz, pattern='saccades', period=0.4, blink_every=3.0)
+    samples = frame_to_dicts(frame)
+    for window, stride in ((120, 12), (600, 1)):
+        extractor = FeatureExtractor(window, stride)
+        start = time.perf_counter()
+        ends, X = extractor.batch(frame)
+        batch_s = time.perf_counter() - start
+
+        extractor.reset()
+        start = time.perf_counter()
+        streamed = [f for f in (extractor.update(sample) for sample in samples) if f is not None]
+        us_per_sample = (time.perf_counter() - start) / len(samples) * 1e6
+
+        streamed = np.array(streamed)
+        assert streamed.shape == X.shape, (streamed.shape, X.shape)
+        for j, name in enumerate(FEATURE_NAMES):
+            assert np.allclose(streamed[:, j], X[:, j], rtol=1e-6, atol=1e-9, equal_nan=True), name
+        print(f"window {window}, stride {stride}: {len(ends)} windows, batch {len(frame) / batch_s / 1e6:.2f} M samples/s, "
+              f"update {us_per_sample:.1f} us/sample, features match")
+
+    # a stream on a fixed time base gives the same samples as the resampled recording
+    rate_hz = 60
+    resampled = resample_frame(frame, rate_hz)
+    resampler = Resampler(rate_hz)
+    streamed = [tick for sample in samples for tick in resampler.update(sample)]
+    assert [s['device_time_stamp'] for s in streamed] == resampled['device_time_stamp'].tolist()
+    pupil = resampled['left_pupil_diameter']
+    assert np.array_equal(np.array([s['left_pupil_diameter'] for s in streamed], dtype=pupil.dtype), pupil, equal_nan=True)
+    print(f"resampled {len(frame)} samples to {len(resampled)} at {rate_hz} Hz, stream matches")
+    print(features_frame(frame).describe().T[['mean', 'min', 'max']])
+
+if __name__ == '__main__':
+    _self_check()
@@ -0,0 +1,322 @@
+'''
+    gaze_filters.py
+    @file      gaze_filters.py
+    @brief     Streaming smoothing filters for gaze coordinates, between preprocess_gaze and the power mapper
+
+    Every filter works on the four screen coordinates of a gazexy tuple (left x, left y, right x, right y)
+    and keeps a fixed amount of state per channel, allocated once in the constructor, so update() costs
+    the same on the millionth sample as on the first. A nan coordinate (eye not tracked) is passed
+    through and restarts that channel, so the filter never smears a lost eye into the next fixation.
+
+        EMAFilter       exponential moving average, one multiply-add per channel
+        MedianFilter    median of the last window samples, removes single-sample spikes
+        OneEuroFilter   low pass whose cutoff rises with gaze speed (Casiez et al. 2012): smooth
+                        during fixations, little lag on saccades
+
+    batch() runs a filter over a whole recording, and evaluate_filter / compare_filters measure the
+    jitter versus step latency trade-off on sample_data/ and a synthetic saccade recording.
+
+    Usage: python gaze_filters.py  (prints the comparison table)
+'''
+
+from bisect import bisect_left, insort
+import glob
+import json
+import math
+import os
+import time
+import numpy as np
+
+N_CHANNELS = 4 # left x, left y, right x, right y
+DEFAULT_DT = 1 / 600 # seconds between samples when the timestamps don't say
+
+class GazeFilter:
+    """Base class: subclasses implement reset() and update()."""
+
+    name = 'none'
+
+    def reset(self):
+        pass
+
+    def update(self, values, t):
+        """Filters one sample. values: N_CHANNELS floats, t: timestamp in seconds. Returns a list of N_CHANNELS floats."""
+        return list(values)
+
+    def filter_gazexy(self, gazexy, t):
+        """update() on the ([left_x], [left_y], [right_x], [right_y]) tuple preprocess_gaze returns, same layout out."""
+        left_x, left_y, right_x, right_y = self.update((gazexy[0][0], gazexy[1][0], gazexy[2][0], gazexy[3][0]), t)
+        return [left_x], [left_y], [right_x], [right_y]
+
+    def batch(self, gazexy, t):
+        """
+        Runs the filter over a whole recording from a fresh state.
+
+        Args:
+        gazexy: (left_x, left_y, right_x, right_y) arrays, e.g. from preprocess_gaze_batch.
+        t: array of timestamps in seconds.
+
+        Returns: tuple of four filtered arrays.
+        """
+        self.reset()
+        values = np.stack([np.asarray(v, dtype=np.float64) for v in gazexy], axis=1)
+        out = np.empty_like(values)
+        for i, (row, ti) in enumerate(zip(values.tolist(), np.asarray(t, dtype=np.float64).tolist())):
+            out[i] = self.update(row, ti)
+        self.reset()
+        return tuple(out[:, c] for c in range(N_CHANNELS))
+
+    def config(self):
+        return {'type': self.name}
+
+class EMAFilter(GazeFilter):
+    """
+    Exponential moving average: y += alpha * (x - y).
+
+    Args:
+    alpha: float in (0, 1], weight of the newest sample. Lower is smoother and laggier.
+    """
+
+    name = 'ema'
+
+    def __init__(self, alpha=0.2):
+        if not 0 < alpha <= 1:
+            raise ValueError("alpha must be in (0, 1]")
+        self.alpha = alpha
+        self._y = [math.nan] * N_CHANNELS
+
+    def reset(self):
+        for c in range(N_CHANNELS):
+            self._y[c] = math.nan
+
+    def update(self, values, t):
+        y, alpha = self._y, self.alpha
+        for c in range(N_CHANNELS):
+            x = values[c]
+            if x != x or y[c] != y[c]: # nan input restarts the channel, nan state takes the input as is
+                y[c] = x
+            else:
+                y[c] += alpha * (x - y[c])
+        return y[:]
+
+    def config(self):
+        return {'type': self.name, 'alpha': self.alpha}
+
+class MedianFilter(GazeFilter):
+    """
+    Median of the last window samples per channel. The samples are kept in a preallocated ring, in arrival
+    order, and in a sorted list: a new sample removes the one it overwrites from the sorted list and is
+    inserted with bisect, so an update never sorts the window.
+
+    Args:
+    window: int, number of samples. Odd values give a true median.
+    """
+
+    name = 'median'
+
+    def __init__(self, window=5):
+        if window < 1:
+            raise ValueError("window must be at least 1")
+        self.window = window
+        self._ring = [[0.0] * window for _ in range(N_CHANNELS)]
+        self._sorted = [[] for _ in range(N_CHANNELS)]
+        self._pos = [0] * N_CHANNELS
+
+    def reset(self):
+        for c in range(N_CHANNELS):
+            self._sorted[c].clear()
+            self._pos[c] = 0
+
+    def update(self, values, t):
+        out = [0.0] * N_CHANNELS
+        window = self.window
+        for c in range(N_CHANNELS):
+            x = values[c]
+            ordered = self._sorted[c]
+            if x != x:
+                ordered.clear()
+                self._pos[c] = 0
+                out[c] = x
+                continue
+            ring = self._ring[c]
+            pos = self._pos[c]
+            if len(ordered) == window: # full: drop the sample this one overwrites
+                del ordered[bisect_left(ordered, ring[pos])]
+            insort(ordered, x)
+            ring[pos] = x
+            self._pos[c] = pos + 1 if pos + 1 < window else 0
+            n = len(ordered)
+            out[c] = ordered[n // 2] if n % 2 else (ordered[n // 2 - 1] + ordered[n // 2]) / 2
+        return out
+
+    def config(self):
+        return {'type': self.name, 'window': self.window}
+
+class OneEuroFilter(GazeFilter):
+    """
+    One Euro filter: an EMA whose cutoff frequency is min_cutoff + beta * |speed|, with the speed
+    itself low-passed at d_cutoff. Coordinates are preprocess_gaze screen units (-1 to 1 across the screen).
+
+    Args:
+    min_cutoff: float, Hz. Cutoff while the eye is still; lower removes more fixation jitter.
+    beta: float, how fast the cutoff rises with speed (screen units / s); higher cuts saccade lag.
+    d_cutoff: float, Hz, cutoff for the speed estimate.
+    """
+
+    name = 'one_euro'
+
+    def __init__(self, min_cutoff=1.0, beta=5.0, d_cutoff=1.0):
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self._x = [math.nan] * N_CHANNELS
+        self._dx = [0.0] * N_CHANNELS
+        self._t = math.nan
+
+    def reset(self):
+        for c in range(N_CHANNELS):
+            self._x[c] = math.nan
+            self._dx[c] = 0.0
+        self._t = math.nan
+
+    @staticmethod
+    def _alpha(cutoff, dt):
+        tau = 1.0 / (2 * math.pi * cutoff)
+        return 1.0 / (1.0 + tau / dt)
+
+    def update(self, values, t):
+        dt = t - self._t
+        if not dt > 0: # first sample, repeated or missing timestamps
+            dt = DEFAULT_DT
+        self._t = t
+        a_d = self._alpha(self.d_cutoff, dt)
+        prev, dprev = self._x, self._dx
+        for c in range(N_CHANNELS):
+            x = values[c]
+            if x != x or prev[c] != prev[c]:
+                prev[c] = x
+                dprev[c] = 0.0
+                continue
+            dx = dprev[c] + a_d * ((x - prev[c]) / dt - dprev[c])
+            dprev[c] = dx
+            a = self._alpha(self.min_cutoff + self.beta * abs(dx), dt)
+            prev[c] += a * (x - prev[c])
+        return prev[:]
+
+    def config(self):
+        return {'type': self.name, 'min_cutoff': self.min_cutoff, 'beta': self.beta, 'd_cutoff': self.d_cutoff}
+
+FILTERS = {cls.name: cls for cls in (GazeFilter, EMAFilter, MedianFilter, OneEuroFilter)}
+
+def make_filter(config):
+    """
+    Builds a filter from a per-user setting: None, a filter name ('ema', 'median', 'one_euro', 'none'),
+    a dict like {'type': 'one_euro', 'min_cutoff': 0.8, 'beta': 10}, or a json string of that dict.
+    Returns None for no filtering.
+    """
+    if config is None:
+        return None
+    if isinstance(config, GazeFilter):
+        return config
+    if isinstance(config, str):
+        config = json.loads(config) if config.lstrip().startswith('{') else {'type': config}
+    params = dict(config)
+    kind = params.pop('type', 'none')
+    if kind not in FILTERS:
+        raise ValueError(f"unknown gaze filter {kind}, expected one of {', '.join(FILTERS)}")
+    if kind == 'none':
+        return None
+    return FILTERS[kind](**params)
+
+################################################
+# EVALUATION
+################################################
+
+def _recording_gazexy(frame):
+    from utils import preprocess_gaze_batch
+    gazexy, ok = preprocess_gaze_batch(frame)
+    return gazexy, frame['device_time_stamp'].astype(np.float64) / 1e6
+
+def evaluate_filter(gaze_filter, recordings, steps):
+    """
+    Measures one filter (None for raw gaze).
+
+    Args:
+    recordings: list of (gazexy, t) from real recordings. recording_jitter is the RMS sample-to-sample
+                change of the filtered gaze there, in screen units.
+    steps: (gazexy, t, target, jumps) from saccade_steps. step_latency_ms is the mean time the filtered
+           left x takes to cover 90% of each jump; fixation_jitter is its RMS sample-to-sample change
+           and fixation_error its RMS distance from the target once it got there.
+
+    Returns: dict with recording_jitter, fixation_jitter, fixation_error, step_latency_ms, us_per_sample.
+    """
+    diffs = []
+    for gazexy, t in recordings:
+        out = gaze_filter.batch(gazexy, t) if gaze_filter else gazexy
+        for values in out:
+            d = np.diff(values)
+            diffs.append(d[~np.isnan(d)])
+    recording_jitter = float(np.sqrt(np.mean(np.concatenate(diffs) ** 2)))
+
+    gazexy, t, target, jumps = steps
+    start = time.perf_counter()
+    out = gaze_filter.batch(gazexy, t) if gaze_filter else gazexy
+    us_per_sample = (time.perf_counter() - start) / len(t) * 1e6 if gaze_filter else 0.0
+    x = out[0]
+    latencies, errors, moves = [], [], []
+    for j in jumps:
+        before, after = target[j - 1], target[j]
+        moved = np.flatnonzero(target[j:] != after) # end of this fixation
+        end = j + moved[0] if len(moved) else len(t)
+        reached = np.flatnonzero((x[j:end] - before) / (after - before) >= 0.9)
+        if len(reached):
+            latencies.append(t[j + reached[0]] - t[j])
+            settled = x[j + reached[0]:end]
+            errors.append(settled - after)
+            moves.append(np.diff(settled))
+    return {
+        'recording_jitter': round(recording_jitter, 4),
+        'fixation_jitter': round(float(np.sqrt(np.mean(np.concatenate(moves) ** 2))), 5),
+        'fixation_error': round(float(np.sqrt(np.mean(np.concatenate(errors) ** 2))), 5),
+        'step_latency_ms': round(float(np.mean(latencies)) * 1000, 1),
+        'us_per_sample': round(us_per_sample, 2),
+    }
+
+def saccade_steps(seconds=20.0, rate_hz=600, period=0.5, seed=1):
+    """Synthetic fixations joined by instant jumps, with the target left_x track and jump indices."""
+    from sim_tracker import synthetic_frame
+    frame = synthetic_frame(seconds, rate_hz, pattern='saccades', period=period, seed=seed)
+    gazexy, t = _recording_gazexy(frame)
+    idx = (np.arange(len(t)) / rate_hz / period).astype(int)
+    targets = np.random.default_rng(seed).uniform(0.1, 0.9, size=(idx[-1] + 1, 2))
+    target = 2 * (targets[idx, 0] - 0.005) - 1 # left eye x in screen units, see translate2ScreenX
+    jumps = np.flatnonzero(np.diff(idx)) + 1
+    jumps = jumps[np.abs(target[jumps] - target[jumps - 1]) > 0.2] # only jumps big enough to measure
+    return gazexy, t, target, jumps
+
+def compare_filters(configs=None, sample_dir=None):
+    """Prints jitter / step latency for each filter config on sample_data/ and synthetic saccades."""
+    from gaze_csv import load_gaze_frame
+    if sample_dir is None:
+        sample_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sample_data')
+    if configs is None:
+        configs = ['none', {'type': 'ema', 'alpha': 0.2}, {'type': 'ema', 'alpha': 0.05},
+                   {'type': 'median', 'window': 5}, {'type': 'median', 'window': 15},
+                   {'type': 'one_euro', 'min_cutoff': 1.0, 'beta': 5.0},
+                   {'type': 'one_euro', 'min_cutoff': 1.0, 'beta': 20.0}]
+    paths = sorted(glob.glob(os.path.join(sample_dir, '*.csv')))
+    recordings = [_recording_gazexy(load_gaze_frame(path, dtype=np.float64)) for path in paths]
+    steps = saccade_steps()
+
+    print(f"{'filter':<64}{'rec jitter':>11}{'fix jitter':>11}{'fix err':>9}{'step ms':>9}{'us/sample':>11}")
+    results = []
+    for config in configs:
+        gaze_filter = make_filter(config)
+        r = evaluate_filter(gaze_filter, recordings, steps)
+        label = json.dumps(gaze_filter.config()) if gaze_filter else 'none'
+        print(f"{label:<64}{r['recording_jitter']:>11}{r['fixation_jitter']:>11}{r['fixation_error']:>9}"
+              f"{r['step_latency_ms']:>9}{r['us_per_sample']:>11}")
+        results.append((label, r))
+    return results
+
+if __name__ == '__main__':
+    compare_filters()
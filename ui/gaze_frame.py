@@ -0,0 +1,244 @@
+import numpy as np
+import pandas as pd
+
+# every field of a tobii gaze dictionary: (key, kind, number of components)
+# kind decides the storage dtype: 'time' -> int64, 'float' -> float32 (or the frame dtype), 'validity' -> int8
+GAZE_FIELDS = [
+    ('device_time_stamp', 'time', 1),
+    ('system_time_stamp', 'time', 1),
+    ('left_gaze_point_on_display_area', 'float', 2),
+    ('left_gaze_point_in_user_coordinate_system', 'float', 3),
+    ('left_gaze_point_validity', 'validity', 1),
+    ('left_pupil_diameter', 'float', 1),
+    ('left_pupil_validity', 'validity', 1),
+    ('left_gaze_origin_in_user_coordinate_system', 'float', 3),
+    ('left_gaze_origin_in_trackbox_coordinate_system', 'float', 3),
+    ('left_gaze_origin_validity', 'validity', 1),
+    ('right_gaze_point_on_display_area', 'float', 2),
+    ('right_gaze_point_in_user_coordinate_system', 'float', 3),
+    ('right_gaze_point_validity', 'validity', 1),
+    ('right_pupil_diameter', 'float', 1),
+    ('right_pupil_validity', 'validity', 1),
+    ('right_gaze_origin_in_user_coordinate_system', 'float', 3),
+    ('right_gaze_origin_in_trackbox_coordinate_system', 'float', 3),
+    ('right_gaze_origin_validity', 'validity', 1),
+]
+
+AXES = 'xyz'
+
+def component_names(key, n):
+    """Returns the split column names for a field, e.g. key_x, key_y for a 2-tuple."""
+    if n == 1:
+        return [key]
+    return [f"{key}_{AXES[i]}" for i in range(n)]
+
+def column_dtype(kind, dtype=np.float32):
+    if kind == 'time':
+        return np.int64
+    if kind == 'validity':
+        return np.int8
+    return dtype
+
+class GazeSample:
+    """
+    Reusable record of the fields the live control path reads from a gaze sample. A consumer thread
+    keeps one and fill()s it from each SDK dictionary, so preprocess_gaze does not build the
+    ([lx], [ly], [rx], [ry]) lists and tuple for every sample. preprocess_gaze(sample) writes the screen
+    coordinates into the record's own gazexy tuple, xy, and returns it (utils.preprocess_sample), so
+    everything after preprocess_gaze only ever sees a gazexy tuple. The next fill() / preprocess_gaze
+    overwrites it: keep gazexy() instead if it has to outlive the sample.
+
+    Fields: device / system_time_stamp, left / right_validity (gaze point), left / right_px, _py
+    (display area point, 0 to 1) and xy, ([left_x], [left_y], [right_x], [right_y]) on screen (-1 to 1)
+    after preprocess_gaze.
+    """
+
+    __slots__ = ('device_time_stamp', 'system_time_stamp', 'left_validity', 'right_validity',
+                 'left_px', 'left_py', 'right_px', 'right_py', 'xy')
+
+    def __init__(self):
+        self.device_time_stamp = self.system_time_stamp = 0
+        self.left_validity = self.right_validity = 0
+        self.left_px = self.left_py = self.right_px = self.right_py = np.nan
+        self.xy = ([np.nan], [np.nan], [np.nan], [np.nan])
+
+    def fill(self, out):
+        """Copies the fields from an SDK gaze dictionary (references to its objects, nothing new) and returns self."""
+        self.device_time_stamp = out['device_time_stamp']
+        self.system_time_stamp = out['system_time_stamp']
+        self.left_validity = out['left_gaze_point_validity']
+        self.right_validity = out['right_gaze_point_validity']
+        left = out['left_gaze_point_on_display_area']
+        right = out['right_gaze_point_on_display_area']
+        self.left_px = left[0]
+        self.left_py = left[1]
+        self.right_px = right[0]
+        self.right_py = right[1]
+        return self
+
+    def gazexy(self):
+        """A copy of xy that the next sample doesn't overwrite (allocates)."""
+        return tuple([values[0]] for values in self.xy)
+
+class GazeFrame:
+    """
+    Columnar gaze recording. Every tuple field is split into contiguous per-axis NumPy arrays
+    (left_gaze_point_on_display_area -> left_gaze_point_on_display_area_x / _y), validity flags
+    are int8 and the rest float32, so analysis over a whole session is vectorized.
+
+    Slicing with a slice returns a GazeFrame of views over the same memory; columns that are
+    not part of the tobii schema (the 'type' label, an old csv index) are carried in extras.
+
+    Args:
+    columns: dict of column name -> 1-D array, all the same length.
+    extras: dict of column name -> 1-D array for non-gaze columns. Defaults to none.
+    """
+
+    def __init__(self, columns, extras=None):
+        self.columns = columns
+        self.extras = extras if extras is not None else {}
+        self._n = len(next(iter(columns.values()))) if columns else 0
+
+    def __len__(self):
+        return self._n
+
+    def __repr__(self):
+        return f"GazeFrame({self._n} samples, {len(self.columns)} columns)"
+
+    def __contains__(self, name):
+        return name in self.columns or name in self.extras
+
+    def __getitem__(self, item):
+        if isinstance(item, str):
+            if item in self.columns:
+                return self.columns[item]
+            return self.extras[item]
+        # slices give views, index arrays / masks give copies (numpy semantics)
+        columns = {name: col[item] for name, col in self.columns.items()}
+        extras = {name: col[item] for name, col in self.extras.items()}
+        return GazeFrame(columns, extras)
+
+    @property
+    def names(self):
+        return list(self.columns)
+
+    ################################################
+    # CONSTRUCTION
+    ################################################
+
+    @classmethod
+    def empty(cls, n, dtype=np.float32):
+        """Allocates a zeroed frame of n samples with every gaze column (floats start as nan)."""
+        columns = {}
+        for key, kind, n_comp in GAZE_FIELDS:
+            for name in component_names(key, n_comp):
+                if kind == 'float':
+                    columns[name] = np.full(n, np.nan, dtype=dtype)
+                else:
+                    columns[name] = np.zeros(n, dtype=column_dtype(kind))
+        return cls(columns)
+
+    @classmethod
+    def from_dicts(cls, dict_list, dtype=np.float32):
+        """Builds a frame from gaze dictionaries as delivered by the tracker callback. None entries are skipped."""
+        dict_list = [d for d in dict_list if d is not None]
+        columns = {}
+        for key, kind, n_comp in GAZE_FIELDS:
+            values = [d[key] for d in dict_list]
+            if n_comp > 1 and any(v is None for v in values):
+                missing = (np.nan,) * n_comp
+                values = [missing if v is None else v for v in values]
+            arr = np.array(values, dtype=column_dtype(kind, dtype))
+            if n_comp == 1:
+                columns[key] = arr.reshape(-1)
+            else:
+                # transpose into one (n_comp, n) block so every axis is a contiguous row
+                block = np.ascontiguousarray(arr.reshape(-1, n_comp).T)
+                for name, row in zip(component_names(key, n_comp), block):
+                    columns[name] = row
+        return cls(columns)
+
+    @classmethod
+    def from_pandas(cls, df, dtype=np.float32):
+        """
+        Builds a frame from a dataframe in either layout: tuple-valued columns (build_dataset,
+        build_dataset_from_csv) or already split key_x / key_y columns.
+        Any column outside the gaze schema is kept in extras.
+        """
+        columns = {}
+        used = set()
+        for key, kind, n_comp in GAZE_FIELDS:
+            names = component_names(key, n_comp)
+            if n_comp > 1 and key in df.columns:
+                n = len(df)
+                block = np.full((n, n_comp), np.nan, dtype=dtype)
+                points = df[key].tolist()
+                ok = [i for i, p in enumerate(points) if isinstance(p, (tuple, list)) and len(p) == n_comp]
+                if ok:
+                    block[ok] = [points[i] for i in ok]
+                block = np.ascontiguousarray(block.T)
+                for name, row in zip(names, block):
+                    columns[name] = row
+                used.add(key)
+            elif all(name in df.columns for name in names):
+                for name in names:
+                    values = pd.to_numeric(df[name], errors='coerce')
+                    if kind == 'float':
+                        columns[name] = values.to_numpy(dtype=dtype, na_value=np.nan)
+                    else:
+                        columns[name] = values.fillna(0).to_numpy(dtype=column_dtype(kind))
+                used.update(names)
+        extras = {name: df[name].to_numpy() for name in df.columns if name not in used}
+        return cls(columns, extras)
+
+    def set_row(self, i, sample):
+        """Writes one gaze dictionary into row i in place. Used to fill preallocated frames."""
+        columns = self.columns
+        for key, kind, n_comp in GAZE_FIELDS:
+            value = sample[key]
+            if n_comp == 1:
+                columns[key][i] = np.nan if value is None else value
+            else:
+                if value is None:
+                    value = (np.nan,) * n_comp
+                for name, v in zip(component_names(key, n_comp), value):
+                    columns[name][i] = v
+
+    ################################################
+    # CONVERSION
+    ################################################
+
+    def to_pandas(self, tuples=False):
+        """
+        Converts to a dataframe with split float columns, or with the legacy tuple-valued
+        columns if tuples is True (the layout of the csv files in sample_data/).
+        """
+        data = {}
+        for key, kind, n_comp in GAZE_FIELDS:
+            names = component_names(key, n_comp)
+            if not all(name in self.columns for name in names):
+                continue
+            if tuples and n_comp > 1:
+                data[key] = list(zip(*(self.columns[name].tolist() for name in names)))
+            else:
+                for name in names:
+                    data[name] = self.columns[name]
+        data.update(self.extras)
+        return pd.DataFrame(data)
+
+    ################################################
+    # VECTORIZED HELPERS
+    ################################################
+
+    def valid(self, eye):
+        """Boolean mask of samples where eye ('left' / 'right') has a valid gaze point."""
+        return self.columns[f"{eye}_gaze_point_validity"] == 1
+
+    def display_xy(self, eye):
+        """
+        Returns the gaze point of one eye in screen coordinates, the vectorized equivalent of
+        translate2ScreenX / translate2ScreenY: x goes left -1 to right 1, y goes bottom -1 to top 1.
+        """
+        x = self.columns[f"{eye}_gaze_point_on_display_area_x"]
+        y = self.columns[f"{eye}_gaze_point_on_display_area_y"]
+        return 2 * x - 1, 1 - 2 * y
@@ -0,0 +1,195 @@
+'''
+    gaze_regions.py
+    @file      gaze_regions.py
+    @brief     Table driven screen region classifier (o1 - o9 by default) with dwell time hysteresis
+
+    A RegionGrid is built from sorted column and row edges in preprocess_gaze screen units
+    (x -1 left to 1 right, y -1 bottom to 1 top). A lookup is two binary searches (bisect for one
+    sample, np.searchsorted for arrays) into those edges and one table read, for any number of rows
+    and columns. Regions are named row-major from the top left: o1 o2 o3 / o4 o5 o6 / o7 o8 o9.
+    Gaze that can't be placed (nan) gets OUTSIDE ("o"), like the old if/elif chain falling through.
+
+    DEFAULT_GRID reproduces the thresholds gaze_id and calculatePower_new2 used to hard-code, and
+    DEFAULT_POWER holds calculatePower_new2's motor power per region.
+
+    DwellFilter only switches to a new region once the gaze has stayed in it for dwell_ms, so a
+    glance across a boundary doesn't flash the UI or jerk the car.
+'''
+
+from bisect import bisect_left, bisect_right
+import numpy as np
+
+OUTSIDE = "o"
+
+class RegionGrid:
+    """
+    Rectangular grid of screen regions.
+
+    Args:
+    x_edges: increasing column boundaries. A point exactly on an edge belongs to the column on its right.
+    y_edges: increasing row boundaries. A point exactly on an edge belongs to the row below it.
+    names: region names, row-major from the top left. Defaults to o1, o2, ...
+    """
+
+    def __init__(self, x_edges, y_edges, names=None):
+        self.x_edges = [float(e) for e in x_edges]
+        self.y_edges = [float(e) for e in y_edges]
+        if self.x_edges != sorted(self.x_edges) or self.y_edges != sorted(self.y_edges):
+            raise ValueError("grid edges must be increasing")
+        self.n_cols = len(self.x_edges) + 1
+        self.n_rows = len(self.y_edges) + 1
+        n = self.n_cols * self.n_rows
+        if names is None:
+            names = [f"o{i}" for i in range(1, n + 1)]
+        if len(names) != n:
+            raise ValueError(f"{self.n_rows}x{self.n_cols} grid needs {n} names, got {len(names)}")
+        self.names = list(names)
+        # lookup tables: [bisect result on y][bisect result on x] -> name, y counted from the bottom
+        self._table = [[self.names[(self.n_rows - 1 - row) * self.n_cols + col] for col in range(self.n_cols)]
+                       for row in range(self.n_rows)]
+        self._x = np.array(self.x_edges)
+        self._y = np.array(self.y_edges)
+        self._names = np.array(self.names + [OUTSIDE]) # index -1 -> OUTSIDE
+
+    @classmethod
+    def uniform(cls, rows=3, cols=3, names=None):
+        """Evenly spaced rows x cols grid over the whole screen."""
+        return cls(np.linspace(-1, 1, cols + 1)[1:-1], np.linspace(-1, 1, rows + 1)[1:-1], names)
+
+    @classmethod
+    def from_spec(cls, spec):
+        """Builds a grid from {'x_edges': [...], 'y_edges': [...], 'names': [...]} or {'rows': 3, 'cols': 3}."""
+        if 'x_edges' in spec:
+            return cls(spec['x_edges'], spec['y_edges'], spec.get('names'))
+        return cls.uniform(spec.get('rows', 3), spec.get('cols', 3), spec.get('names'))
+
+    def spec(self):
+        return {'x_edges': self.x_edges, 'y_edges': self.y_edges, 'names': self.names}
+
+    def __len__(self):
+        return len(self.names)
+
+    def classify(self, gx, gy):
+        """Region name for one gaze point, OUTSIDE if either coordinate is nan."""
+        if gx != gx or gy != gy:
+            return OUTSIDE
+        return self._table[bisect_left(self.y_edges, gy)][bisect_right(self.x_edges, gx)]
+
+    def cells(self, values, default=None):
+        """Lays out a {region name: value} mapping as a lookup table for lookup(). Missing regions get default."""
+        return [[values.get(name, default) for name in row] for row in self._table]
+
+    def lookup(self, cells, gx, gy, default=None):
+        """Value of the region a gaze point is in, from a cells() table. default if either coordinate is nan."""
+        if gx != gx or gy != gy:
+            return default
+        return cells[bisect_left(self.y_edges, gy)][bisect_right(self.x_edges, gx)]
+
+    def compile(self, cells, default=None):
+        """
+        lookup() with cells and default bound, as a function of (gx, gy) for the per-sample path.
+        A grid with two edges per axis (DEFAULT_GRID) compares against the edges directly, which is
+        about three times faster than the two bisect calls; other grids use bisect.
+        """
+        if len(self.x_edges) == 2 and len(self.y_edges) == 2:
+            x0, x1 = self.x_edges
+            y0, y1 = self.y_edges
+            bottom, middle, top = cells
+            def lookup(gx, gy):
+                if gx != gx or gy != gy:
+                    return default
+                row = bottom if gy <= y0 else (middle if gy <= y1 else top)
+                return row[0] if gx < x0 else (row[1] if gx < x1 else row[2])
+            return lookup
+        x_edges, y_edges = self.x_edges, self.y_edges
+        def lookup(gx, gy):
+            if gx != gx or gy != gy:
+                return default
+            return cells[bisect_left(y_edges, gy)][bisect_right(x_edges, gx)]
+        return lookup
+
+    def index_batch(self, gx, gy):
+        """Region index (position in names) for arrays of gaze points, -1 where either coordinate is nan."""
+        gx = np.asarray(gx)
+        gy = np.asarray(gy)
+        col = np.searchsorted(self._x, gx, side='right')
+        row = self.n_rows - 1 - np.searchsorted(self._y, gy, side='left')
+        index = row * self.n_cols + col
+        index[np.isnan(gx) | np.isnan(gy)] = -1
+        return index
+
+    def classify_batch(self, gx, gy):
+        """Region names for arrays of gaze points."""
+        return self._names[self.index_batch(gx, gy)]
+
+# the boundaries gaze_id / calculatePower_new2 have always used
+DEFAULT_GRID = RegionGrid(x_edges=[-0.4, 0.2], y_edges=[-0.25, 0.35])
+
+# calculatePower_new2's motor power (left, right) per region
+DEFAULT_POWER = {
+    'o1': (1.2, 2.0), 'o2': (2.0, 2.0), 'o3': (2.0, 1.2),
+    'o4': (1.0, 2.0), 'o5': (1.0, 1.0), 'o6': (2.0, 1.0),
+    'o7': (1.2, 0.2), 'o8': (0.0, 0.0), 'o9': (0.2, 1.2),
+}
+
+# DEFAULT_POWER laid out on DEFAULT_GRID for RegionGrid.lookup
+DEFAULT_POWER_CELLS = DEFAULT_GRID.cells(DEFAULT_POWER)
+
+def power_table(grid, power=DEFAULT_POWER):
+    """(len(grid) + 1, 2) array of motor power by region index, with a nan row last for OUTSIDE (index -1)."""
+    table = np.full((len(grid) + 1, 2), np.nan)
+    for i, name in enumerate(grid.names):
+        table[i] = power[name]
+    return table
+
+class DwellFilter:
+    """
+    Hysteresis on region changes: a new region is committed only after it has been the raw region
+    for dwell_ms without interruption. Until then the previously committed region is kept.
+
+    Args:
+    dwell_ms: float, how long a region must be held. 0 commits every change immediately.
+    initial: region reported before anything has been committed. Defaults to None.
+    """
+
+    def __init__(self, dwell_ms=150.0, initial=None):
+        self.dwell_ms = dwell_ms
+        self.initial = initial
+        self.region = initial # committed region
+        self._candidate = None
+        self._since = 0.0
+
+    def reset(self):
+        self.region = self.initial
+        self._candidate = None
+
+    def update(self, region, t):
+        """Feeds the raw region at time t (seconds), returns the committed region."""
+        if region != self._candidate:
+            self._candidate = region
+            self._since = t
+        if region != self.region and (t - self._since) * 1000 >= self.dwell_ms:
+            self.region = region
+        return self.region
+
+    def batch(self, regions, t):
+        """update() over whole arrays of raw regions and timestamps from a fresh state, returns the committed regions."""
+        regions = np.asarray(regions)
+        t = np.asarray(t, dtype=np.float64)
+        n = len(regions)
+        out = np.empty(n, dtype=object)
+        if n == 0:
+            return out
+        edges = np.flatnonzero(regions[1:] != regions[:-1]) + 1
+        starts = np.concatenate([[0], edges])
+        ends = np.concatenate([edges, [n]])
+        committed = self.initial
+        for s, e in zip(starts, ends):
+            # the run's region takes over at the first sample held for dwell_ms
+            held = (t[s:e] - t[s]) * 1000 >= self.dwell_ms
+            switch = s + int(np.argmax(held)) if held.any() else e
+            out[s:switch] = committed
+            if switch < e:
+                committed = regions[s]
+                out[switch:e] = committed
+        return out
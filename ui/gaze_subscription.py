@@ -0,0 +1,172 @@
+'''
+    gaze_subscription.py
+    @file      gaze_subscription.py
+    @brief     One persistent gaze subscription per tracker, written into a lock-free ring buffer
+
+    Subscribing to a tobii tracker costs a round-trip, so gaze_data(), build_dataset() and the recorders
+    share one long-lived subscription per tracker (subscribe()) instead of subscribing for every read.
+    The SDK thread pushes every sample into a GazeRingBuffer; readers take the latest sample, the last
+    N, or everything since a cursor without ever blocking the SDK thread.
+
+    Only needs the tobii SDK, so both ui/utils.py and the notebook copy of utils.py at the repository
+    root import it from here.
+'''
+
+import threading
+import weakref
+import tobii_research as tr
+
+lock = threading.Lock()
+
+class GazeRingBuffer:
+    """
+    Fixed-capacity ring of gaze samples written by a single producer (the tracker SDK thread).
+
+    The slots are preallocated and the writer never takes a lock: it stores the sample and then
+    bumps a monotonically increasing write count. Readers snapshot the count, copy the slots they
+    need, and drop anything the writer lapped while they were copying, including the slot it may
+    be writing at that moment, so a full-capacity read can come back one sample short.
+
+    Args:
+    capacity: int, number of samples kept. Must cover the longest gap between reads.
+    """
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        self._count = 0 # total samples ever written, only the writer changes it
+        self.overruns = 0 # samples a since() reader was too slow to see
+
+    def push(self, sample):
+        self._slots[self._count % self.capacity] = sample
+        self._count += 1
+
+    @property
+    def cursor(self):
+        """Write position to pass to since() later."""
+        return self._count
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def latest(self):
+        """Returns the newest sample, or None if nothing has arrived yet."""
+        count = self._count
+        if count == 0:
+            return None
+        return self._slots[(count - 1) % self.capacity]
+
+    def last(self, n):
+        """Returns up to the n newest samples, oldest first."""
+        count = self._count
+        return self._read(max(0, count - min(n, self.capacity)), count)
+
+    def since(self, cursor):
+        """
+        Returns every sample written after cursor, oldest first, and the cursor to use next time.
+        If the reader fell more than capacity samples behind, the lost ones are counted in overruns.
+        """
+        count = self._count
+        start = max(cursor, count - self.capacity)
+        self.overruns += start - cursor
+        samples = self._read(start, count)
+        self.overruns += (count - start) - len(samples)
+        return samples, count
+
+    def _read(self, start, stop):
+        n = stop - start
+        if n <= 0:
+            return []
+        i = start % self.capacity
+        if i + n <= self.capacity:
+            samples = self._slots[i:i + n]
+        else:
+            samples = self._slots[i:] + self._slots[:i + n - self.capacity]
+        # the writer may have wrapped around onto the head of what we just copied. push() stores a slot
+        # before it bumps _count, so the slot being written right now counts as lapped too
+        lapped = self._count + 1 - self.capacity - start
+        if lapped > 0:
+            samples = samples[lapped:]
+        return samples
+
+class GazeSubscription:
+    """
+    Long-lived gaze subscription that writes every tracker callback into a GazeRingBuffer,
+    so reading the latest / last N / new samples costs no subscribe or unsubscribe round-trip.
+    It only holds a weak reference to the tracker, so a subscription never keeps a tracker alive.
+
+    Args:
+    eyetracker: the tracker to subscribe to (see get_tracker()).
+    capacity: int, ring buffer size in samples.
+    """
+
+    def __init__(self, eyetracker, capacity=4096):
+        self._tracker = weakref.ref(eyetracker)
+        self.buffer = GazeRingBuffer(capacity)
+        self.callback = self.buffer.push # bind once so unsubscribe_from gets the same object
+        self.active = False
+
+    @property
+    def eyetracker(self):
+        return self._tracker() # None once the tracker is gone
+
+    def start(self):
+        if not self.active:
+            self.eyetracker.subscribe_to(tr.EYETRACKER_GAZE_DATA, self.callback, as_dictionary=True)
+            self.active = True
+        return self
+
+    def stop(self):
+        if self.active:
+            eyetracker = self.eyetracker
+            if eyetracker is not None:
+                eyetracker.unsubscribe_from(tr.EYETRACKER_GAZE_DATA, self.callback)
+            self.active = False
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def cursor(self):
+        return self.buffer.cursor
+
+    def latest(self):
+        return self.buffer.latest()
+
+    def last(self, n):
+        return self.buffer.last(n)
+
+    def since(self, cursor):
+        return self.buffer.since(cursor)
+
+# one persistent subscription per tracker, shared by gaze_data(), build_dataset() and SessionRecorder.
+# Keyed by the tracker object itself, weakly: an entry goes away with its tracker, and a new tracker
+# that happens to get a dead one's id() can't pick up its subscription.
+_subscriptions = weakref.WeakKeyDictionary()
+
+def subscribe(eyetracker, capacity=4096):
+    """Returns the running GazeSubscription for eyetracker, starting one on first use."""
+    with lock:
+        sub = _subscriptions.get(eyetracker)
+        if sub is None:
+            sub = GazeSubscription(eyetracker, capacity).start()
+            _subscriptions[eyetracker] = sub
+    return sub
+
+def unsubscribe(eyetracker):
+    """Stops and forgets the persistent subscription for eyetracker, if any."""
+    with lock:
+        sub = _subscriptions.pop(eyetracker, None)
+    if sub is not None:
+        sub.stop()
+
+def close_subscriptions():
+    """Stops every persistent subscription, e.g. before the program exits."""
+    with lock:
+        subs = list(_subscriptions.values())
+        _subscriptions.clear()
+    for sub in subs:
+        sub.stop()
@@ -0,0 +1,319 @@
+'''
+    gesture_model.py
+    @file      gesture_model.py
+    @brief     Eye-roll gesture classifier: numpy training, plain-array export and a streaming predictor
+
+    Recordings are labeled by file name (Graham_eye_roll_left_3.csv -> eye_roll_left, see
+    catalog.parse_name). Every recording is cut into gaze_features windows, windows never straddle two
+    recordings, and a softmax (multinomial logistic) regression learns the gesture of each window. Every
+    recording that is not one of the gestures is the 'none' class, so looking around is not a command.
+
+    Window and stride are in seconds. Training and the predictor both put the gaze on the same fixed time
+    base first (gaze_features.resample_frame / Resampler, rate_hz ticks per second), so a model trained on
+    slow recordings sees the same windows from a 600 Hz tracker. The sample_data/ recordings are 12
+    samples ~0.5 s apart, hence the 2 Hz default time base: a faster one would only repeat their samples.
+
+    The model is a handful of arrays (feature mean / scale, weights, bias, class names, window, stride and
+    rate) saved with np.savez, so the control loop needs numpy and nothing else to run it. GesturePredictor
+    resamples every live sample, feeds the ticks through FeatureExtractor.update (constant time) and
+    scores each window with one small matrix product; a gesture fires when its probability passes
+    threshold, at most once per cooldown_s. GESTURE_ACTIONS says what a gesture does to the car (see
+    eye_tracking.CarSender).
+
+    train prints the held-out accuracy next to chance (the largest class's share of the windows). On
+    sample_data/ that is 58% against 40% per window: better than chance, still far from a dependable
+    stop, so CarSender's gesture option is for experiments until more recordings are in.
+
+    Usage: python gesture_model.py train [directory or glob] [--out model.npz] [--window S] [--stride S] [--rate HZ]
+           python gesture_model.py bench [--model model.npz]   (per-sample latency against the 600 Hz sample period)
+'''
+
+import argparse
+import math
+import time
+import numpy as np
+from gaze_features import FeatureExtractor, FEATURE_NAMES, Resampler, resample_frame
+
+GESTURES = ('eye_roll_left', 'eye_roll_right')
+OTHER = 'none'
+GESTURE_ACTIONS = {'eye_roll_left': 'stop', 'eye_roll_right': 'reverse'}
+SAMPLE_PERIOD_US = 1e6 / 600 # tracker sample period the predictor has to keep up with
+
+################################################
+# MODEL
+################################################
+
+class GestureModel:
+    """
+    Softmax regression over gaze_features windows.
+
+    Args:
+    classes: class names, weights' columns in order.
+    mean, scale: per-feature standardization (nan features are replaced by the mean).
+    weights: (n_features, n_classes) array.
+    bias: (n_classes,) array.
+    window_s, stride_s: float, seconds per feature window and between windows.
+    rate_hz: float, time base the gaze is resampled to before the features.
+    """
+
+    def __init__(self, classes, mean, scale, weights, bias, window_s, stride_s, rate_hz):
+        self.classes = [str(c) for c in classes]
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.bias = np.asarray(bias, dtype=np.float64)
+        self.window_s = float(window_s)
+        self.stride_s = float(stride_s)
+        self.rate_hz = float(rate_hz)
+        self.window, self.stride = window_ticks(self.window_s, self.stride_s, self.rate_hz)
+        # standardization folded into the weights: one product per window at inference
+        self._w = self.weights / self.scale[:, None]
+        self._b = self.bias - (self.mean / self.scale) @ self.weights
+
+    def __repr__(self):
+        return (f"GestureModel({', '.join(self.classes)}, window={self.window_s:g} s, stride={self.stride_s:g} s, "
+                f"rate={self.rate_hz:g} Hz)")
+
+    def predict_proba(self, X):
+        """Class probabilities for one feature vector or an (n, n_features) array."""
+        X = np.asarray(X, dtype=np.float64)
+        X = np.where(np.isnan(X), self.mean, X)
+        return _softmax(X @ self._w + self._b)
+
+    def predict(self, X):
+        """Class names for an (n, n_features) array."""
+        return np.array(self.classes)[np.argmax(self.predict_proba(X), axis=-1)]
+
+    def save(self, path):
+        np.savez(path, classes=np.array(self.classes), features=np.array(FEATURE_NAMES), mean=self.mean,
+                 scale=self.scale, weights=self.weights, bias=self.bias, window_s=self.window_s, stride_s=self.stride_s,
+                 rate_hz=self.rate_hz)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            if tuple(data['features'].tolist()) != FEATURE_NAMES:
+                raise ValueError(f"{path} was trained on different features: {data['features'].tolist()}")
+            if 'rate_hz' not in data:
+                raise ValueError(f"{path} counts its window in samples of no fixed rate, train it again")
+            return cls(data['classes'].tolist(), data['mean'], data['scale'], data['weights'], data['bias'],
+                       float(data['window_s']), float(data['stride_s']), float(data['rate_hz']))
+
+def window_ticks(window_s, stride_s, rate_hz):
+    """FeatureExtractor's (window, stride) in ticks of the rate_hz time base."""
+    return max(int(round(window_s * rate_hz)), 2), max(int(round(stride_s * rate_hz)), 1)
+
+def _softmax(z):
+    z = z - z.max(axis=-1, keepdims=True)
+    e = np.exp(z)
+    return e / e.sum(axis=-1, keepdims=True)
+
+################################################
+# TRAINING
+################################################
+
+def class_of(gesture, gestures=GESTURES):
+    return gesture if gesture in gestures else OTHER
+
+'''
+    @brief Cuts every recording of an ingest.ingest() frame into feature windows on the model's time base.
+
+    @param frame GazeFrame with 'type' and 'source' extras, one contiguous block of rows per recording.
+    @param window_s Seconds per window.
+    @param stride_s Seconds between windows.
+    @param rate_hz Time base every recording is resampled to.
+    @param gestures Labels kept as classes, everything else becomes OTHER.
+
+    @return (X, y, groups): features, class name and source recording of every window.
+'''
+def training_windows(frame, window_s, stride_s, rate_hz, gestures=GESTURES):
+    extractor = FeatureExtractor(*window_ticks(window_s, stride_s, rate_hz))
+    source = frame['source']
+    bounds = np.concatenate([[0], np.flatnonzero(source[1:] != source[:-1]) + 1, [len(frame)]])
+    X, y, groups = [], [], []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        ends, features = extractor.batch(resample_frame(frame[int(lo):int(hi)], rate_hz))
+        X.append(features)
+        y.extend([class_of(frame['type'][lo], gestures)] * len(ends))
+        groups.extend([source[lo]] * len(ends))
+    X = np.concatenate(X) if X else np.empty((0, len(FEATURE_NAMES)))
+    return X, np.array(y, dtype=object), np.array(groups, dtype=object)
+
+'''
+    @brief Fits a GestureModel by full-batch gradient descent on the class-balanced cross entropy.
+
+    @param X (n, n_features) feature windows.
+    @param y Class name of every window.
+    @param window_s, stride_s, rate_hz Stored in the model.
+    @param l2 Weight decay.
+    @param epochs Gradient steps.
+    @param lr Step size.
+
+    @return GestureModel
+'''
+def fit(X, y, window_s, stride_s, rate_hz, l2=1e-2, epochs=2000, lr=0.5):
+    classes = sorted(set(y))
+    if len(classes) < 2:
+        raise ValueError(f"need windows of at least two classes, got {classes}")
+    mean = np.nanmean(X, axis=0)
+    mean = np.where(np.isnan(mean), 0.0, mean) # a feature that is never valid
+    scale = np.nanstd(X, axis=0)
+    scale = np.where(~(scale > 0), 1.0, scale)
+    Z = np.where(np.isnan(X), 0.0, (X - mean) / scale)
+    target = np.array([classes.index(label) for label in y])
+    Y = np.eye(len(classes))[target]
+    counts = Y.sum(axis=0)
+    sample_weight = (len(y) / (len(classes) * counts))[target] / len(y) # every class counts the same
+
+    W = np.zeros((X.shape[1], len(classes)))
+    b = np.zeros(len(classes))
+    for _ in range(epochs):
+        error = (_softmax(Z @ W + b) - Y) * sample_weight[:, None]
+        W -= lr * (Z.T @ error + l2 * W)
+        b -= lr * error.sum(axis=0)
+    return GestureModel(classes, mean, scale, W, b, window_s, stride_s, rate_hz)
+
+def cross_validate(X, y, groups, window_s, stride_s, rate_hz, folds=5, **kwargs):
+    """Window accuracy with whole recordings held out, fold = recording number modulo folds."""
+    names = sorted(set(groups))
+    fold_of = {name: i % folds for i, name in enumerate(names)}
+    fold = np.array([fold_of[g] for g in groups])
+    correct = 0
+    for k in range(folds):
+        test = fold == k
+        if not test.any() or len(set(y[~test])) < 2:
+            continue
+        model = fit(X[~test], y[~test], window_s, stride_s, rate_hz, **kwargs)
+        correct += int((model.predict(X[test]) == y[test]).sum())
+    return correct / len(y) if len(y) else math.nan
+
+def chance(y):
+    """Accuracy of always answering the most common class."""
+    return max(int((y == name).sum()) for name in set(y)) / len(y) if len(y) else math.nan
+
+def train(source=None, window_s=3.0, stride_s=0.5, rate_hz=2.0, gestures=GESTURES, workers=None, **kwargs):
+    """Ingests the recordings in source (directory, glob or file list, default sample_data/) and fits a model on all of them."""
+    from ingest import ingest
+    from catalog import SAMPLE_DIR
+    frame = ingest(source or SAMPLE_DIR, workers=workers, dtype=np.float64)
+    X, y, groups = training_windows(frame, window_s, stride_s, rate_hz, gestures)
+    return fit(X, y, window_s, stride_s, rate_hz, **kwargs), (X, y, groups)
+
+################################################
+# STREAMING
+################################################
+
+class GesturePredictor:
+    """
+    Live gesture recognition on gaze dictionaries, at any sample rate: they are resampled to the model's time base.
+
+    Args:
+    model: GestureModel.
+    threshold: float, probability a gesture needs to fire.
+    cooldown_s: float, seconds (device_time_stamp) after a gesture before the next one can fire.
+    """
+
+    def __init__(self, model, threshold=0.9, cooldown_s=1.0):
+        self.model = model
+        self.threshold = threshold
+        self.cooldown_s = cooldown_s
+        self.resampler = Resampler(model.rate_hz)
+        self.extractor = FeatureExtractor(model.window, model.stride)
+        self.proba = None # probabilities of the last scored window
+        self.fired = 0
+        self._other = model.classes.index(OTHER) if OTHER in model.classes else -1
+        self._last_fire = -math.inf
+
+    def reset(self):
+        self.resampler.reset()
+        self.extractor.reset()
+        self.proba = None
+        self._last_fire = -math.inf
+
+    def update(self, sample):
+        """Adds one sample. Returns the gesture name when one fires, None otherwise."""
+        fired = None
+        for tick in self.resampler.update(sample):
+            features = self.extractor.update(tick)
+            if features is None:
+                continue
+            self.proba = proba = self.model.predict_proba(features)
+            best = int(proba.argmax())
+            t = tick['device_time_stamp'] / 1e6
+            if best == self._other or proba[best] < self.threshold or t - self._last_fire < self.cooldown_s:
+                continue
+            self._last_fire = t
+            self.fired += 1
+            fired = self.model.classes[best]
+        return fired
+
+def make_gesture_predictor(config):
+    """Builds a GesturePredictor from None, a model .npz path, or a dict like {'model': path, 'threshold': 0.95}."""
+    if config is None or isinstance(config, GesturePredictor):
+        return config
+    params = {'model': config} if isinstance(config, str) else dict(config)
+    model = params.pop('model')
+    if not isinstance(model, GestureModel):
+        model = GestureModel.load(model)
+    return GesturePredictor(model, **params)
+
+################################################
+# MAIN METHOD
+################################################
+
+def _bench(model, seconds=60.0):
+    # worst case: a stride of one tick scores a window on every tick. Ticks are rate_hz apart while samples come
+    # at 600 Hz, so most update() calls only resample; the calls that score a window are timed on their own
+    from sim_tracker import synthetic_frame, frame_to_dicts
+    model = GestureModel(model.classes, model.mean, model.scale, model.weights, model.bias, model.window_s,
+                         1 / model.rate_hz, model.rate_hz)
+    predictor = GesturePredictor(model)
+    samples = frame_to_dicts(synthetic_frame(seconds, 600, pattern='saccades', period=0.4, blink_every=3.0))
+    elapsed = np.empty(len(samples))
+    scored = np.zeros(len(samples), dtype=bool)
+    for i, sample in enumerate(samples):
+        proba = predictor.proba
+        start = time.perf_counter_ns()
+        predictor.update(sample)
+        elapsed[i] = time.perf_counter_ns() - start
+        scored[i] = predictor.proba is not proba
+    elapsed /= 1000
+    scoring, resampling = elapsed[scored], elapsed[~scored]
+    p50, p99, worst = np.percentile(scoring, 50), np.percentile(scoring, 99), scoring.max()
+    print(f"{model}, {len(samples)} samples, {len(scoring)} update() calls scored a window")
+    print(f"  scoring calls: p50 {p50:.1f} us, p99 {p99:.1f} us, max {worst:.1f} us "
+          f"(sample period {SAMPLE_PERIOD_US:.0f} us, the slowest uses {worst / SAMPLE_PERIOD_US:.1%} of it)")
+    print(f"  other calls: p50 {np.percentile(resampling, 50):.1f} us, p99 {np.percentile(resampling, 99):.1f} us")
+    assert worst < SAMPLE_PERIOD_US, "inference does not fit in one sample period"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=('train', 'bench'))
+    parser.add_argument('source', nargs='?', default=None, help='recordings directory or glob (default: sample_data/)')
+    parser.add_argument('--out', default='gesture_model.npz', help='where train writes the model')
+    parser.add_argument('--model', default=None, help='model for bench (default: train one on sample_data/)')
+    parser.add_argument('--window', type=float, default=3.0, help='seconds per feature window')
+    parser.add_argument('--stride', type=float, default=0.5, help='seconds between windows')
+    parser.add_argument('--rate', type=float, default=2.0, help='time base the gaze is resampled to (Hz)')
+    parser.add_argument('--workers', type=int, default=None, help='ingestion worker processes')
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        model = GestureModel.load(args.model) if args.model else train(args.source, args.window, args.stride, args.rate)[0]
+        _bench(model)
+        return
+    start = time.perf_counter()
+    model, (X, y, groups) = train(args.source, args.window, args.stride, args.rate, workers=args.workers)
+    print(f"{model}: {len(y)} windows from {len(set(groups))} recordings in {time.perf_counter() - start:.2f} s")
+    for name in model.classes:
+        print(f"  {name:16s} {int((y == name).sum()):5d} windows")
+    held_out = cross_validate(X, y, groups, args.window, args.stride, args.rate)
+    print(f"  training accuracy {float((model.predict(X) == y).mean()):.1%}, "
+          f"held-out recordings {held_out:.1%}, chance {chance(y):.1%}")
+    if not held_out > chance(y):
+        print("  no better than chance on held-out recordings: not usable as a car control")
+    model.save(args.out)
+    print(f"saved {args.out}")
+
+if __name__ == '__main__':
+    main()
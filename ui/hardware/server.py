@@ -16,10 +16,14 @@
         - link: https://pyserial.readthedocs.io/en/latest/index.html
 '''
 
-import serial
+import os
+import sys
 import time
 import tobii_research as tr
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # for car_link in ui/
+from car_link import CarLink
+
 def get_tracker():
   all_eyetrackers = tr.find_all_eyetrackers()
 
@@ -56,10 +60,9 @@ def setup():
 
 
     # set up serial port to communicate with the car over bluetooth
+    # (CarLink connects in the background, waits for the link to settle and reconnects if it drops)
     bluetoothPort = "COM10"
-    carSerial = serial.Serial(bluetoothPort, baud)
-    # give time to connect
-    time.sleep(2)
+    carSerial = CarLink(bluetoothPort, baud)
 
     # return eye tracker & serial port
     return tracker, carSerial
@@ -0,0 +1,151 @@
+'''
+    ingest.py
+    @file      ingest.py
+    @brief     Bulk ingestion of many recordings into one labeled GazeFrame
+
+    ingest() takes a glob, a directory or a list of files, parses them across a process pool (through
+    catalog.Recording, so the npz parse cache is used and filled) and copies the pieces into one frame
+    allocated once at the final size. That replaces looping build_dataset_from_csv and pd.concat-ing,
+    or build_dataset(add_on=True), which re-concatenates everything collected so far for every new session.
+
+    Labels come from the file name (the gesture part of <user>_<gesture>_<trial>.csv, see
+    catalog.parse_name), or from a mapping {file name / stem / path: label}, or a function of the path.
+    Rows are always in input order (sorted, for a glob or a directory), whatever order the workers finish in.
+
+    Usage: python ingest.py [glob or directory] [--workers N]
+           python ingest.py --bench [--files N]   (serial vs pool on a generated archive)
+'''
+
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from catalog import Recording, parse_name, EXTENSIONS, SAMPLE_DIR
+from gaze_frame import GazeFrame
+
+def resolve_paths(source):
+    """File list for a glob pattern, a directory (its csv / session files) or a list of paths (kept in its order)."""
+    if isinstance(source, str):
+        if os.path.isdir(source):
+            return sorted(os.path.join(source, f) for f in os.listdir(source) if f.endswith(EXTENSIONS))
+        return sorted(glob.glob(source))
+    return list(source)
+
+def label_for(path, labels=None):
+    """Label of one file: labels[name / stem / path] if labels is a mapping, labels(path) if callable, else its gesture."""
+    if callable(labels):
+        return labels(path)
+    if labels is not None:
+        name = os.path.basename(path)
+        for key in (path, name, os.path.splitext(name)[0]):
+            if key in labels:
+                return labels[key]
+        raise KeyError(f"no label for {path}")
+    return parse_name(path)[1]
+
+def _parse(args):
+    # runs in a worker process: returns plain arrays, which pickle cheaply back to the parent
+    path, dtype, cache = args
+    frame = Recording(path, dtype, cache).frame
+    return frame.columns, len(frame)
+
+'''
+    @brief Parses and concatenates recordings into one GazeFrame.
+
+    @param source Glob pattern, directory or list of paths.
+    @param labels None (label from the file name), a mapping or a function of the path.
+    @param workers Worker processes. None uses every core; 1, or fewer files than 2 per worker, parses in this process.
+    @param dtype Float dtype of the coordinate columns.
+    @param cache Use the catalog's npz parse cache.
+    @param chunksize Files handed to a worker at a time.
+
+    @return GazeFrame with every gaze column plus extras 'type' (label), 'user', 'trial' and 'source' (file name).
+'''
+def ingest(source, labels=None, workers=None, dtype=np.float32, cache=True, chunksize=8):
+    paths = resolve_paths(source)
+    file_labels = [label_for(path, labels) for path in paths] # fail on a missing label before parsing anything
+    workers = workers or os.cpu_count() or 1
+    jobs = [(path, dtype, cache) for path in paths]
+    if workers == 1 or len(paths) < 2 * workers:
+        pieces = [_parse(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pieces = list(pool.map(_parse, jobs, chunksize=chunksize)) # map keeps input order
+
+    total = sum(n for columns, n in pieces)
+    out = GazeFrame.empty(total, dtype)
+    extras = {'type': np.empty(total, dtype=object), 'user': np.empty(total, dtype=object),
+              'trial': np.empty(total, dtype=object), 'source': np.empty(total, dtype=object)}
+    row = 0
+    for i, path in enumerate(paths):
+        columns, n = pieces[i]
+        pieces[i] = None # let each piece go as soon as it is copied
+        for name, col in out.columns.items():
+            if name in columns:
+                col[row:row + n] = columns[name]
+        user, gesture, trial = parse_name(path)
+        extras['type'][row:row + n] = file_labels[i]
+        extras['user'][row:row + n] = user
+        extras['trial'][row:row + n] = trial
+        extras['source'][row:row + n] = os.path.basename(path)
+        row += n
+    out.extras.update(extras)
+    return out
+
+def ingest_df(source, labels=None, **kwargs):
+    """ingest() as a dataframe in build_dataset_from_csv's tuple layout, with the label in 'type'."""
+    return ingest(source, labels, **kwargs).to_pandas(tuples=True)
+
+################################################
+# MAIN METHOD
+################################################
+
+def _bench(files, workers):
+    # an archive of copies of sample_data, parsed without the cache so every run does the csv work
+    recordings = sorted(glob.glob(os.path.join(SAMPLE_DIR, '*.csv')))
+    folder = tempfile.mkdtemp(prefix='opticars_ingest_')
+    try:
+        for i in range(files):
+            src = recordings[i % len(recordings)]
+            user, gesture, trial = parse_name(src)
+            shutil.copy(src, os.path.join(folder, f"{user}_{gesture}_{i}.csv"))
+        times = {}
+        frames = {}
+        for n in sorted({1, workers}):
+            start = time.perf_counter()
+            frames[n] = ingest(folder, workers=n, cache=False)
+            times[n] = time.perf_counter() - start
+        for name in frames[1].columns:
+            assert np.array_equal(frames[1][name], frames[workers][name], equal_nan=True), name
+        assert list(frames[1]['source']) == list(frames[workers]['source'])
+        print(f"{files} files, {len(frames[1])} samples, {os.cpu_count()} cores")
+        for n, t in times.items():
+            print(f"  {n:3d} worker{'s' if n > 1 else ' '}: {t:6.2f} s  ({files / t:7.0f} files/s)")
+    finally:
+        shutil.rmtree(folder)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', nargs='?', default=SAMPLE_DIR, help='glob pattern or directory')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: every core)')
+    parser.add_argument('--bench', action='store_true', help='time serial vs pool ingestion')
+    parser.add_argument('--files', type=int, default=2000, help='archive size for --bench')
+    args = parser.parse_args()
+
+    if args.bench:
+        _bench(args.files, args.workers or os.cpu_count() or 1)
+        return
+    start = time.perf_counter()
+    frame = ingest(args.source, workers=args.workers)
+    elapsed = time.perf_counter() - start
+    print(f"{frame} from {len(set(frame['source']))} files in {elapsed:.2f} s")
+    labels, counts = np.unique(frame['type'].astype(str), return_counts=True)
+    for label, count in zip(labels, counts):
+        print(f"  {label:28s} {count:6d}")
+
+if __name__ == '__main__':
+    main()
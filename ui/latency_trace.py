@@ -0,0 +1,156 @@
+'''
+    latency_trace.py
+    @file      latency_trace.py
+    @brief     Per-sample latency tracing from the tracker's system_time_stamp to the serial flush
+
+    Every sample the CarSender sends carries a handful of perf_counter_ns marks: SDK callback entry,
+    taken off the mailbox, preprocess_gaze done, power computed, command encoded, car.write and
+    car.flush returned. LatencyTracer appends them to a list (the only per-sample cost) and folds
+    them into per-stage log-linear histograms in batches, then periodically dumps p50 / p99 / max
+    per stage to a json file.
+
+    Stages (all reported in microseconds):
+        sdk         tracker system_time_stamp -> SDK callback entry
+        queue       callback entry -> sender takes the sample
+        preprocess  preprocess_gaze (and the gaze filter, if the CarSender has one)
+        power       motor power (calculatePower_new3 or its compiled PowerTable)
+        encode      command encoding
+        write       car.write (queueing only, when car is a CarLink)
+        flush       car.flush (a no-op on a CarLink)
+        total       callback entry -> flush returned
+'''
+
+import json
+import os
+import time
+import numpy as np
+
+STAGES = ('sdk', 'queue', 'preprocess', 'power', 'encode', 'write', 'flush', 'total')
+
+class LatencyHistogram:
+    """
+    HDR style histogram of nanosecond latencies: SUB log-linear buckets per power of two
+    (about 2% relative resolution) from 1 ns to max_ns, plus exact count / sum / min / max.
+    """
+
+    SUB = 32
+
+    def __init__(self, max_ns=60e9):
+        self.counts = np.zeros(int(np.log2(max_ns) * self.SUB) + 2, dtype=np.int64)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def add(self, values_ns):
+        """Adds an array of latencies in ns. Negative values (clock mismatch) are ignored."""
+        values = np.asarray(values_ns, dtype=np.int64)
+        values = values[values >= 0]
+        if values.size == 0:
+            return
+        idx = np.floor(np.log2(np.maximum(values, 1)) * self.SUB).astype(np.int64)
+        np.minimum(idx, len(self.counts) - 1, out=idx)
+        self.counts += np.bincount(idx, minlength=len(self.counts))
+        self.count += int(values.size)
+        self.total += int(values.sum())
+        low, high = int(values.min()), int(values.max())
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = max(self.max, high)
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Returns the upper edge of the bucket holding quantile q (capped at the exact max), in ns."""
+        if self.count == 0:
+            return 0.0
+        i = int(np.searchsorted(np.cumsum(self.counts), q * self.count, side='left'))
+        return min(2 ** ((i + 1) / self.SUB), self.max)
+
+    def summary(self):
+        """p50 / p90 / p99 / p99.9 / max / mean in microseconds."""
+        if self.count == 0:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean_us': round(self.total / self.count / 1e3, 2),
+            'p50_us': round(self.quantile(0.50) / 1e3, 2),
+            'p90_us': round(self.quantile(0.90) / 1e3, 2),
+            'p99_us': round(self.quantile(0.99) / 1e3, 2),
+            'p999_us': round(self.quantile(0.999) / 1e3, 2),
+            'max_us': round(self.max / 1e3, 2),
+        }
+
+class LatencyTracer:
+    """
+    Collects per-sample stage marks and aggregates them into one LatencyHistogram per stage.
+
+    Args:
+    path: str, json file the summary is written to every interval seconds. None to never dump.
+    interval: float, seconds between dumps.
+    batch: int, marks are folded into the histograms every batch samples (or at each dump).
+    """
+
+    N_MARKS = len(STAGES) - 1 # perf_counter_ns marks per sample
+
+    def __init__(self, path=None, interval=10.0, batch=2048):
+        self.path = path
+        self.interval = interval
+        self.histograms = {stage: LatencyHistogram() for stage in STAGES}
+        self._batch_len = batch * self.N_MARKS
+        self._marks = [] # flat: N_MARKS ints per sample
+        self._sdk = [] # us between system_time_stamp and callback entry
+        self._next_dump_ns = time.perf_counter_ns() + int(interval * 1e9)
+
+    '''
+        @brief Records one sent sample. Arguments are the sample's system_time_stamp and the SDK clock at
+        callback entry (both in microseconds, either may be None), then the perf_counter_ns marks in stage order.
+    '''
+    def record(self, system_time_stamp, entry_us, entry_ns, taken_ns, preprocess_ns, power_ns, encode_ns, write_ns, flush_ns):
+        if system_time_stamp is not None and entry_us is not None:
+            self._sdk.append(entry_us - system_time_stamp)
+        marks = self._marks
+        marks.extend((entry_ns, taken_ns, preprocess_ns, power_ns, encode_ns, write_ns, flush_ns))
+        if len(marks) >= self._batch_len or flush_ns >= self._next_dump_ns:
+            self.flush(flush_ns)
+
+    def flush(self, now_ns=None):
+        """Folds pending marks into the histograms, and writes the dump file if it is due."""
+        if self._marks:
+            marks = np.array(self._marks, dtype=np.int64).reshape(-1, self.N_MARKS)
+            sdk = np.array(self._sdk, dtype=np.int64) * 1000
+            self._marks, self._sdk = [], []
+            deltas = np.diff(marks, axis=1)
+            self.histograms['sdk'].add(sdk)
+            for i, stage in enumerate(STAGES[1:-1]):
+                self.histograms[stage].add(deltas[:, i])
+            self.histograms['total'].add(marks[:, -1] - marks[:, 0])
+
+        now_ns = time.perf_counter_ns() if now_ns is None else now_ns
+        if now_ns >= self._next_dump_ns:
+            self._next_dump_ns = now_ns + int(self.interval * 1e9)
+            if self.path:
+                self.dump(self.path)
+
+    def summary(self):
+        return {stage: hist.summary() for stage, hist in self.histograms.items()}
+
+    def dump(self, path):
+        """Writes the summary to path, replacing it atomically so readers never see half a file."""
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'time': time.time(), 'stages': self.summary()}, f, indent=2)
+        os.replace(tmp, path)
+
+    def report(self):
+        """Returns the summary as a printable table."""
+        lines = [f"{'stage':<11}{'count':>8}{'p50 us':>10}{'p99 us':>10}{'max us':>10}"]
+        for stage, s in self.summary().items():
+            if s['count']:
+                lines.append(f"{stage:<11}{s['count']:>8}{s['p50_us']:>10}{s['p99_us']:>10}{s['max_us']:>10}")
+        return '\n'.join(lines)
@@ -0,0 +1,200 @@
+'''
+    metrics.py
+    @file      metrics.py
+    @brief     Lock-cheap counters and gauges with a Prometheus text rendering, for the /metrics route
+
+    Counter.inc() is what the hot path calls. Every thread increments its own cell (a one element
+    list found through a threading.local), so increments never take a lock and never lose counts when
+    the sender and region threads both count; the lock is only taken the first time a thread
+    increments. Reading a counter sums the cells.
+
+    Most of the pipeline already counts what it does (LatestMailbox.received / coalesced, CarSender.sent,
+    CarLink.metrics()). Those are exported with a collector: a function the registry calls at scrape time
+    that yields (name, type, help, value) from attributes it reads, so a scrape never waits on or
+    writes to anything the control loop uses. Deltas turns such totals into per-second rates between
+    scrapes.
+
+    Usage: REGISTRY.counter('opticars_x_total', 'what it counts').inc()
+           REGISTRY.collector(fn)   (fn yields (name, 'counter' / 'gauge', help, value))
+           render()                 (text for a scrape, served with CONTENT_TYPE)
+'''
+
+import math
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class Counter:
+    """
+    Monotonic count, incremented lock free from any number of threads.
+
+    Args:
+    name: str, metric name, ending in _total by convention.
+    help: str, one line description.
+    """
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self._local = threading.local()
+        self._cells = []
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        try:
+            self._local.cell[0] += n
+        except AttributeError: # first increment from this thread
+            cell = [n]
+            with self._lock:
+                self._cells.append(cell)
+            self._local.cell = cell
+
+    @property
+    def value(self):
+        return sum(cell[0] for cell in list(self._cells))
+
+    def collect(self):
+        yield self.name, 'counter', self.help, self.value
+
+class Gauge:
+    """
+    Value that goes up and down: set() from one thread, or fn evaluated at scrape time.
+
+    Args:
+    name: str, metric name.
+    help: str, one line description.
+    fn: optional function returning the current value (None to leave it out of the scrape).
+    """
+
+    def __init__(self, name, help='', fn=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self._value = None
+
+    def set(self, value):
+        self._value = value
+
+    @property
+    def value(self):
+        return self.fn() if self.fn is not None else self._value
+
+    def collect(self):
+        yield self.name, 'gauge', self.help, self.value
+
+class Deltas:
+    """
+    Per-second rates of running totals between two calls of update(), for rate gauges computed at scrape time.
+    Calls closer together than min_interval seconds return the previous rates.
+    """
+
+    def __init__(self, min_interval=0.5):
+        self.min_interval = min_interval
+        self._last = None # (time, totals)
+        self._rates = {}
+        self._changes = {}
+        self._lock = threading.Lock() # scrapes can overlap, the control loop never takes it
+
+    def update(self, totals):
+        """totals: {key: running total}. Returns ({key: change per second}, {key: change}) since the previous call."""
+        now = time.monotonic()
+        with self._lock:
+            if self._last is None:
+                self._last = (now, dict(totals))
+                return {key: math.nan for key in totals}, {key: 0 for key in totals}
+            then, previous = self._last
+            elapsed = now - then
+            if elapsed >= self.min_interval:
+                self._changes = {key: value - previous.get(key, 0) for key, value in totals.items()}
+                self._rates = {key: change / elapsed for key, change in self._changes.items()}
+                self._last = (now, dict(totals))
+            return dict(self._rates), dict(self._changes)
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def counter(self, name, help=''):
+        return self._add(Counter(name, help))
+
+    def gauge(self, name, help='', fn=None):
+        return self._add(Gauge(name, help, fn))
+
+    def _add(self, metric):
+        with self._lock:
+            if any(m.name == metric.name for m in self._metrics):
+                raise ValueError(f"metric {metric.name} is already registered")
+            self._metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        """Registers fn, called at every scrape, yielding (name, 'counter' / 'gauge', help, value). Returns fn."""
+        with self._lock:
+            self._collectors.append(fn)
+        return fn
+
+    def collect(self):
+        """Every (name, type, help, value), metrics first then collectors. A failing collector is left out."""
+        with self._lock:
+            sources = [m.collect for m in self._metrics] + list(self._collectors)
+        samples = []
+        errors = 0
+        for source in sources:
+            try:
+                samples.extend(source())
+            except Exception:
+                errors += 1
+        if errors:
+            samples.append(('opticars_metrics_collector_errors', 'gauge', 'Collectors that failed during this scrape', errors))
+        return samples
+
+    def render(self):
+        """The Prometheus text exposition format. Values that are None are left out."""
+        lines = []
+        for name, kind, help, value in self.collect():
+            if value is None:
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {_format(value)}")
+        return '\n'.join(lines) + '\n'
+
+def _format(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(int(value)) if value.is_integer() and abs(value) < 2 ** 53 else repr(value)
+
+REGISTRY = Registry()
+
+def render(registry=REGISTRY):
+    return registry.render()
+
+################################################
+# SELF CHECK
+################################################
+
+def _self_check(threads=4, n=200000):
+    registry = Registry()
+    counter = registry.counter('opticars_test_total', 'increments from several threads')
+    workers = [threading.Thread(target=lambda: [counter.inc() for _ in range(n)]) for _ in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    per_inc = (time.perf_counter() - start) / (threads * n)
+    assert counter.value == threads * n, counter.value
+    registry.gauge('opticars_test_gauge', 'scrape time value', fn=lambda: 0.25)
+    print(registry.render(), end='')
+    print(f"{threads} threads x {n} increments: none lost, {per_inc * 1e9:.0f} ns per inc()")
+
+if __name__ == '__main__':
+    _self_check()
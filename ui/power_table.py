@@ -0,0 +1,346 @@
+'''
+    power_table.py
+    @file      power_table.py
+    @brief     Compiles a gaze -> motor power function into a lookup table
+
+    compile_power(fn) samples a power function (calculatePower_new3 or any function taking a gazexy
+    tuple and returning (left, right)) once over a grid of averaged gaze
+    points (gx, gy) and stores the outputs quantized to out_step (0.01, the resolution of the
+    binary car frames) as int16. Looking a sample up is then an index computation and two list reads
+    instead of the rescale loops and np.sin calls.
+
+    calculatePower_new2 is not compiled: it is already a region lookup (gaze_regions.RegionGrid.compile)
+    that beats a table (0.5 against 1.1 us), and a sampled table blurs its region edges by a full
+    step of motor power. compile_power refuses it.
+
+    The table is a function of the two eyes' average. calculatePower_new3 clamps each eye to power_bounds(profile) before averaging, so its table is
+    built with eye_bounds and clamps each eye the same way before the lookup: the clamped average
+    then gives exactly what new3 computes, wherever the eyes are. Averages outside +-limit are
+    clamped onto the table edge.
+
+    Compiled tables are cached under cache_path('power_tables'), keyed by the function's source, the
+    source or value of every module level function and constant it uses (rescale_item, power_bounds,
+    DEFAULT_BOUNDS, ...), a fingerprint of its outputs on fixed gaze samples and the table parameters,
+    so editing the function or anything it calls rebuilds the table.
+
+    Usage: python power_table.py  (compiles new3, runs the correctness check and times lookups)
+'''
+
+import functools
+import hashlib
+import inspect
+import json
+import os
+import time
+import types
+import numpy as np
+
+NAN_CODE = -32768 # int16 code stored for nan outputs
+
+class PowerTable:
+    """
+    Precomputed (left, right) motor power over a square grid of averaged gaze points.
+    Call it like the function it was compiled from: table(gazexy) -> (left, right).
+
+    Args:
+    codes: (2, n, n) int16 array, outputs / out_step, indexed [output][y][x]. NAN_CODE for nan.
+    limit: float, the grid covers -limit to limit on both axes.
+    step: float, grid spacing in screen units.
+    out_step: float, output quantization.
+    key: str, cache key the table was built for.
+    eye_bounds: (x_min, x_max, y_min, y_max) each eye is clamped to before averaging, None to average as is.
+    """
+
+    def __init__(self, codes, limit, step, out_step, key='', eye_bounds=None):
+        self.codes = codes
+        self.limit = limit
+        self.step = step
+        self.out_step = out_step
+        self.key = key
+        self.eye_bounds = tuple(eye_bounds) if eye_bounds is not None else None
+        self.n = codes.shape[-1]
+        self._inv_step = 1.0 / step
+        # flat python lists: much faster than numpy scalar indexing for one lookup at a time
+        self._left = codes[0].ravel().tolist()
+        self._right = codes[1].ravel().tolist()
+
+    def lookup(self, gx, gy):
+        """(left, right) for an averaged gaze point, (nan, nan) if either coordinate is nan."""
+        if gx != gx or gy != gy:
+            return np.nan, np.nan
+        n, last = self.n, self.n - 1
+        ix = int((gx + self.limit) * self._inv_step + 0.5)
+        iy = int((gy + self.limit) * self._inv_step + 0.5)
+        i = (0 if iy < 0 else (last if iy > last else iy)) * n + (0 if ix < 0 else (last if ix > last else ix))
+        left, right = self._left[i], self._right[i]
+        if left == NAN_CODE or right == NAN_CODE:
+            return np.nan, np.nan
+        return left * self.out_step, right * self.out_step
+
+    def __call__(self, gazexy):
+        left_x, left_y, right_x, right_y = gazexy
+        lx, ly, rx, ry = left_x[0], left_y[0], right_x[0], right_y[0]
+        if self.eye_bounds is not None:
+            # nan fails every comparison and stays nan
+            x_min, x_max, y_min, y_max = self.eye_bounds
+            lx = x_min if lx < x_min else (x_max if lx > x_max else lx)
+            rx = x_min if rx < x_min else (x_max if rx > x_max else rx)
+            ly = y_min if ly < y_min else (y_max if ly > y_max else ly)
+            ry = y_min if ry < y_min else (y_max if ry > y_max else ry)
+        return self.lookup((lx + rx) / 2, (ly + ry) / 2)
+
+    def batch(self, gazexy):
+        """Lookup for (left_x, left_y, right_x, right_y) arrays. Returns (left, right) float arrays, nan where gaze is nan."""
+        left_x, left_y, right_x, right_y = (np.asarray(values, dtype=np.float64) for values in gazexy)
+        if self.eye_bounds is not None:
+            x_min, x_max, y_min, y_max = self.eye_bounds
+            left_x, right_x = np.clip(left_x, x_min, x_max), np.clip(right_x, x_min, x_max)
+            left_y, right_y = np.clip(left_y, y_min, y_max), np.clip(right_y, y_min, y_max)
+        gx = (left_x + right_x) / 2
+        gy = (left_y + right_y) / 2
+        bad = np.isnan(gx) | np.isnan(gy)
+        ix = np.clip(np.floor((np.where(bad, 0, gx) + self.limit) * self._inv_step + 0.5), 0, self.n - 1).astype(np.intp)
+        iy = np.clip(np.floor((np.where(bad, 0, gy) + self.limit) * self._inv_step + 0.5), 0, self.n - 1).astype(np.intp)
+        out = []
+        for codes in self.codes:
+            c = codes[iy, ix]
+            out.append(np.where(bad | (c == NAN_CODE), np.nan, c * self.out_step))
+        return tuple(out)
+
+    def save(self, path):
+        tmp = path + '.tmp.npz'
+        bounds = self.eye_bounds if self.eye_bounds is not None else [np.nan] * 4
+        np.savez_compressed(tmp, codes=self.codes, params=np.array([self.limit, self.step, self.out_step]),
+                            eye_bounds=np.array(bounds, dtype=np.float64), key=self.key)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            limit, step, out_step = data['params'].tolist()
+            bounds = data['eye_bounds'].tolist()
+            bounds = None if any(b != b for b in bounds) else bounds
+            return cls(data['codes'], limit, step, out_step, str(data['key']), bounds)
+
+    def check(self, fn, n=200000, seed=0, samples=None, spread=1.5):
+        """
+        Compares the table with the analytic function fn on n random gaze samples, the two eyes drawn
+        independently over spread * limit on both axes (so past the clamps too), plus the gazexy arrays
+        in samples (e.g. the sample_data rows from preprocess_gaze_batch). A sample passes if both
+        outputs are within out_step of fn (or both nan). Mismatches right next to a jump in the
+        function are counted separately: a sampled table can't
+        place a discontinuity more precisely than step / 2.
+
+        Returns: dict with max_error (over passing and failing samples), failures, edge_points, points.
+        """
+        rng = np.random.default_rng(seed)
+        width = spread * self.limit
+        gazexy = [rng.uniform(-width, width, n) for _ in range(4)]
+        if samples is not None:
+            gazexy = [np.concatenate([a, np.asarray(b, dtype=np.float64)]) for a, b in zip(gazexy, samples)]
+        n = len(gazexy[0])
+        table_left, table_right = self.batch(gazexy)
+        exact_left, exact_right = _evaluate(fn, gazexy)
+        err = np.maximum(_error(table_left, exact_left), _error(table_right, exact_right))
+        bad = err > self.out_step * (1 + 1e-9)
+        # is there a jump within half a step of the failing samples? (both eyes moved together)
+        edge = np.zeros(n, dtype=bool)
+        if bad.any():
+            idx = np.flatnonzero(bad)
+            left_x, left_y, right_x, right_y = (values[idx] for values in gazexy)
+            h = self.step / 2
+            for dx, dy in ((-h, 0), (h, 0), (0, -h), (0, h)):
+                near_left, near_right = _evaluate(fn, (left_x + dx, left_y + dy, right_x + dx, right_y + dy))
+                jump = np.maximum(_error(near_left, exact_left[idx]), _error(near_right, exact_right[idx]))
+                edge[idx] |= jump > self.out_step
+        finite = err[np.isfinite(err)]
+        return {
+            'points': n,
+            'max_error': float(finite.max()) if len(finite) else 0.0,
+            'max_error_off_edges': float(err[~edge].max()) if (~edge).any() else 0.0,
+            'failures': int((bad & ~edge).sum()),
+            'edge_points': int((bad & edge).sum()),
+        }
+
+def _error(a, b):
+    # nan matches nan, nan against a number is an infinite error
+    with np.errstate(invalid='ignore'):
+        return np.where(np.isnan(a) & np.isnan(b), 0.0, np.where(np.isnan(a) | np.isnan(b), np.inf, np.abs(a - b)))
+
+def _evaluate(fn, gazexy, batch_fn=None):
+    """Runs a power function over (left_x, left_y, right_x, right_y) arrays."""
+    batch_fn = batch_fn or _batch_version(fn)
+    if batch_fn is not None:
+        left, right = batch_fn(tuple(gazexy))
+        return np.asarray(left, dtype=np.float64), np.asarray(right, dtype=np.float64)
+    rows = zip(*(np.asarray(values).tolist() for values in gazexy))
+    out = np.array([fn(([lx], [ly], [rx], [ry])) for lx, ly, rx, ry in rows], dtype=np.float64).reshape(-1, 2)
+    return out[:, 0], out[:, 1]
+
+def _qualified_name(fn):
+    return f"{getattr(fn, '__module__', '')}.{getattr(fn, '__qualname__', repr(fn))}"
+
+def _batch_version(fn):
+    # functools.partial(calculatePower_new3, profile=...) -> the same partial of calculatePower_new3_batch
+    if isinstance(fn, functools.partial):
+        batch = _batch_version(fn.func)
+        return functools.partial(batch, *fn.args, **fn.keywords) if batch is not None else None
+    return BATCH_VERSIONS.get(_qualified_name(fn))
+
+def eye_bounds_of(fn):
+    """The per-eye clamp fn applies before averaging the eyes, (x_min, x_max, y_min, y_max), or None."""
+    args, keywords = (), {}
+    if isinstance(fn, functools.partial):
+        args, keywords, fn = fn.args, fn.keywords, fn.func
+    bounds = EYE_BOUNDS.get(_qualified_name(fn))
+    return tuple(bounds(*args, **keywords)) if bounds is not None else None
+
+def _load_batch_versions():
+    import utils
+    batch = {
+        _qualified_name(utils.calculatePower_new3): utils.calculatePower_new3_batch,
+    }
+    bounds = {
+        # rescale_item / rescale_item_2 clamp each eye to power_bounds(profile)
+        _qualified_name(utils.calculatePower_new3): lambda profile=None: utils.power_bounds(profile),
+    }
+    not_compiled = {
+        _qualified_name(utils.calculatePower_new2): "calculatePower_new2 is a region lookup already, a table is slower and blurs the region edges",
+    }
+    return batch, bounds, not_compiled
+
+# vectorized twins used to build tables quickly, must give the same results as the scalar function,
+# the per-eye clamps of the functions that clamp before averaging, and the functions a table only makes worse
+BATCH_VERSIONS, EYE_BOUNDS, NOT_COMPILED = _load_batch_versions()
+
+def _dependencies(fn, seen=None):
+    """Source of fn and of every module level function it reaches, repr of the plain constants it reads."""
+    seen = {} if seen is None else seen
+    code = getattr(fn, '__code__', None)
+    if code is None or _qualified_name(fn) in seen:
+        return seen
+    seen[_qualified_name(fn)] = inspect.getsource(fn)
+    names = set(code.co_names)
+    for const in code.co_consts: # names used by nested functions and comprehensions
+        if isinstance(const, types.CodeType):
+            names.update(const.co_names)
+    for name in sorted(names):
+        value = fn.__globals__.get(name)
+        if isinstance(value, types.FunctionType):
+            _dependencies(value, seen)
+        elif isinstance(value, (bool, int, float, str, tuple)):
+            seen[f"{fn.__module__}.{name}"] = repr(value)
+    return seen
+
+# fixed gaze samples for the output fingerprint: eyes apart, past the clamps and on region edges
+_FINGERPRINT_GAZE = [tuple([v] for v in row) for row in
+                     np.random.default_rng(1).uniform(-2.0, 2.0, (48, 4)).round(4).tolist()
+                     + [[-0.4, 0.35, 0.2, -0.25], [1.6, 0.0, 0.2, 0.0], [-1.5, 1.5, 1.5, -1.5], [0.0, 0.0, 0.0, 0.0]]]
+
+def table_key(fn, limit, step, out_step, eye_bounds=None):
+    """
+    Cache key: the source of fn and everything it calls (see _dependencies), the bound arguments of a
+    functools.partial (e.g. a CalibrationProfile), fn's outputs on _FINGERPRINT_GAZE (catches changes
+    the sources don't show, like a profile's bounds() or a numpy upgrade) and the table parameters.
+    """
+    bound = []
+    inner = fn
+    while isinstance(inner, functools.partial):
+        bound.append(repr((inner.args, sorted(inner.keywords.items()))))
+        inner = inner.func
+    try:
+        sources = sorted(_dependencies(inner).items())
+    except (OSError, TypeError):
+        return None # can't tell if the function changed, don't cache it
+    if not sources:
+        return None
+    fingerprint = [repr(tuple(float(v) for v in fn(gazexy))) for gazexy in _FINGERPRINT_GAZE]
+    blob = json.dumps([_qualified_name(inner), sources, bound, fingerprint, limit, step, out_step, eye_bounds])
+    return hashlib.sha1(blob.encode()).hexdigest()[:16]
+
+'''
+    @brief Builds (or loads from the disk cache) the lookup table for a power function.
+
+    @param fn Power function taking a gazexy tuple, e.g. calculatePower_new3.
+    @param step Grid spacing in screen units. The default keeps calculatePower_new3 within out_step.
+    @param limit Half width of the grid; rescale_item clamps at 1.2, so nothing changes beyond it.
+                 It must cover eye_bounds (a calibration profile's bounds).
+    @param out_step Output resolution, 0.01 like the binary car frames.
+    @param batch_fn Vectorized version of fn to build the table with, looked up for new3.
+    @param eye_bounds Per-eye clamp applied before averaging, looked up for new3 (see eye_bounds_of).
+                      A function of the eyes that is not new3 and not given eye_bounds is
+                      assumed to depend on their average only.
+    @param cache Use the disk cache under cache_path('power_tables').
+
+    @return PowerTable. Raises ValueError for a function in NOT_COMPILED (calculatePower_new2).
+'''
+def compile_power(fn, step=0.004, limit=1.2, out_step=0.01, batch_fn=None, eye_bounds=None, cache=True):
+    reason = NOT_COMPILED.get(_qualified_name(fn.func if isinstance(fn, functools.partial) else fn))
+    if reason is not None:
+        raise ValueError(reason)
+    eye_bounds = eye_bounds if eye_bounds is not None else eye_bounds_of(fn)
+    if eye_bounds is not None and max(abs(b) for b in eye_bounds) > limit + 1e-9:
+        raise ValueError(f"a {limit} table does not cover the eye bounds {eye_bounds}")
+    key = table_key(fn, limit, step, out_step, eye_bounds) if cache else None
+    path = None
+    if key is not None:
+        from utils import cache_path
+        name = getattr(fn.func if isinstance(fn, functools.partial) else fn, '__name__', 'power')
+        path = cache_path('power_tables', f"{name}_{key}.npz")
+        if os.path.exists(path):
+            try:
+                return PowerTable.load(path)
+            except (OSError, ValueError, KeyError):
+                pass # corrupt or old format, rebuild it
+
+    n = int(round(2 * limit / step)) + 1
+    axis = np.linspace(-limit, limit, n)
+    gy, gx = np.meshgrid(axis, axis, indexing='ij')
+    gx, gy = gx.ravel(), gy.ravel()
+    left, right = _evaluate(fn, (gx, gy, gx, gy), batch_fn) # both eyes on the grid point
+    codes = np.empty((2, n * n), dtype=np.int16)
+    for i, values in enumerate((left, right)):
+        q = np.round(np.where(np.isnan(values), 0, values) / out_step)
+        codes[i] = np.where(np.isnan(values), NAN_CODE, np.clip(q, -32767, 32767))
+    table = PowerTable(codes.reshape(2, n, n), limit, step, out_step, key or '', eye_bounds)
+    if path is not None:
+        table.save(path)
+    return table
+
+def sample_rows():
+    """The sample_data rows preprocess_gaze accepts, as gazexy arrays."""
+    import glob
+    from catalog import SAMPLE_DIR
+    from gaze_csv import load_gaze_frame
+    from utils import preprocess_gaze_batch
+    pieces = []
+    for path in sorted(glob.glob(os.path.join(SAMPLE_DIR, '*.csv'))):
+        gazexy, ok = preprocess_gaze_batch(load_gaze_frame(path, dtype=np.float64))
+        pieces.append([values[ok] for values in gazexy])
+    return tuple(np.concatenate(column) for column in zip(*pieces))
+
+if __name__ == '__main__':
+    from utils import calculatePower_new3
+    rows = sample_rows()
+    for fn in (calculatePower_new3,):
+        start = time.perf_counter()
+        table = compile_power(fn, cache=False)
+        built = time.perf_counter() - start
+        result = table.check(fn, samples=rows)
+        assert result['failures'] == 0, result
+        on_rows = table.check(fn, n=0, samples=rows)
+        assert on_rows['failures'] == 0 and on_rows['edge_points'] == 0, on_rows
+        gazexy = ([0.3], [-0.2], [0.32], [-0.18])
+        reps = 100000
+        start = time.perf_counter()
+        for _ in range(reps):
+            fn(gazexy)
+        analytic = (time.perf_counter() - start) / reps * 1e6
+        start = time.perf_counter()
+        for _ in range(reps):
+            table(gazexy)
+        lookup = (time.perf_counter() - start) / reps * 1e6
+        print(f"{fn.__name__}: {table.n}x{table.n} table built in {built * 1000:.0f} ms, {table.codes.nbytes // 1024} KiB")
+        print(f"  check: {result}")
+        print(f"  {on_rows['points']} sample_data rows: max error {on_rows['max_error']:.4f}")
+        print(f"  {analytic:.2f} us analytic -> {lookup:.2f} us lookup")
@@ -0,0 +1,296 @@
+'''
+    rigs.py
+    @file      rigs.py
+    @brief     One process driving several eye tracker -> car rigs with asyncio
+
+    Pairs eye trackers (by serial number) with car serial ports from a json config and runs every
+    pair as its own asyncio task. Each rig has its own queue, CarSender (filter, detector, power
+    table) and single-thread executor for the blocking serial write / flush. A Bluetooth link that
+    stalls only holds up its own executor; the event loop and the other rigs keep going. Cars are
+    driven through car_link.CarLink, which also reconnects a link that drops out.
+
+    The tracker SDK calls back on its own thread; the callback hands the sample to the loop with
+    call_soon_threadsafe. The queue holds one item and the newest sample replaces an unread one,
+    like eye_tracking's LatestMailbox, so a rig that falls behind sends fresh gaze instead of a backlog.
+
+    Config (json):
+        {
+          "baud": 9600,
+          "defaults": {"interval": 0.1, "detector": "ivt"},
+          "rigs": [
+            {"name": "rig1", "tracker": "TPSP1-010109", "port": "COM14", "user": "lam"},
+            {"name": "rig2", "tracker": "TPSP1-010245", "port": "COM3", "filter": "one_euro"}
+          ]
+        }
+    Per rig keys: name, tracker (serial number), port, baud, interval (seconds between commands),
+    binary, filter, detector, user (calibration profile), trace (latency trace json path), gesture
+    (gesture_model .npz path or dict; experimental, see CarSender, not a stop control).
+    "defaults" applies to every rig. With OPTICARS_SIMULATE set, every rig gets a simulated tracker
+    with its serial number and the ports are replaced by NullSerial.
+
+    Usage: python rigs.py <config.json> [--seconds N] [--stats-interval S]
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils import GazeRingBuffer
+
+RIG_DEFAULTS = {
+    'baud': 9600,
+    'interval': 0.1,
+    'binary': True,
+    'filter': None,
+    'detector': 'ivt',
+    'user': None,
+    'trace': None,
+    'gesture': None, # experimental, the sample_data/ models are not reliable enough to drive with
+}
+
+def load_config(path):
+    """Reads a rigs config and returns the list of rig dicts with defaults filled in."""
+    with open(path) as f:
+        config = json.load(f)
+    return rig_settings(config)
+
+def rig_settings(config):
+    defaults = dict(RIG_DEFAULTS, baud=config.get('baud', RIG_DEFAULTS['baud']), **config.get('defaults', {}))
+    rigs = []
+    for i, rig in enumerate(config['rigs']):
+        settings = dict(defaults, **rig)
+        settings.setdefault('name', f"rig{i + 1}")
+        for key in ('tracker', 'port'):
+            if key not in settings:
+                raise ValueError(f"rig {settings['name']} has no {key}")
+        rigs.append(settings)
+    names = [rig['name'] for rig in rigs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"rig names must be unique: {names}")
+    return rigs
+
+def find_trackers(serials, simulate=None):
+    """{serial number: tracker} for the requested serials that are connected (or simulated)."""
+    if simulate is None:
+        simulate = os.environ.get('OPTICARS_SIMULATE')
+    if simulate:
+        from sim_tracker import get_simulated_tracker
+        return {serial: get_simulated_tracker(speed=float(simulate), serial_number=serial) for serial in serials}
+    import tobii_research as tr
+    found = {tracker.serial_number: tracker for tracker in tr.find_all_eyetrackers()}
+    return {serial: found[serial] for serial in serials if serial in found}
+
+def open_car(port, baud, simulate=None):
+    """CarLink to the car's serial port. It connects (and reconnects) on its own thread."""
+    from car_link import CarLink
+    if simulate is None:
+        simulate = os.environ.get('OPTICARS_SIMULATE')
+    if simulate:
+        from sim_tracker import NullSerial
+        return CarLink(port, baud, opener=lambda: NullSerial(port, baud, emulate_baud=True), connect_delay=0)
+    return CarLink(port, baud)
+
+class Rig:
+    """
+    One tracker -> car pipeline on the event loop.
+
+    Args:
+    name: str, rig name for stats and logs.
+    tracker: tobii_research EyeTracker (or SimulatedEyeTracker).
+    car: connection to the car, a car_link.CarLink or anything with serial.Serial's write / flush / close.
+    sender: eye_tracking.CarSender doing the per-sample work. Its thread is never started; the rig calls send().
+    interval: float, seconds between commands.
+    system_clock: clock the tracker stamps system_time_stamp with, for the latency trace.
+    trace: str, json path the sender's latency trace summary is written to when the rig stops (None for none).
+    """
+
+    def __init__(self, name, tracker, car, sender, interval=0.1, system_clock=None, trace=None):
+        self.name = name
+        self.tracker = tracker
+        self.car = car
+        self.sender = sender
+        self.interval = interval
+        self.system_clock = system_clock or _tobii_clock()
+        self.trace = trace
+        self.history = sender.history
+        self.queue = None
+        self.loop = None
+        # one thread per rig: writes to a link stay in order and a stuck link can't take a shared worker
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"rig-{name}")
+        self.received = 0 # samples from the tracker
+        self.coalesced = 0 # samples replaced in the queue before the rig took them
+        self.errors = 0 # failed sends
+        self.last_error = None
+        self.send_s_total = 0.0
+        self.send_s_max = 0.0
+        self._task = None
+
+    def callback(self, out):
+        # tracker SDK thread: hand the sample over, nothing else
+        self.history.push(out)
+        item = (time.perf_counter_ns(), self.system_clock(), out)
+        try:
+            self.loop.call_soon_threadsafe(self._put, item)
+        except RuntimeError: # loop already closed while unsubscribing
+            pass
+
+    def _put(self, item):
+        self.received += 1
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.coalesced += 1
+        self.queue.put_nowait(item)
+
+    async def start(self):
+        import tobii_research as tr
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=1)
+        self.tracker.subscribe_to(tr.EYETRACKER_GAZE_DATA, self.callback, as_dictionary=True)
+        self._task = asyncio.create_task(self.run(), name=f"rig-{self.name}")
+        return self._task
+
+    async def run(self):
+        while True:
+            item = await self.queue.get()
+            start = time.perf_counter()
+            try:
+                await self.loop.run_in_executor(self.executor, self.sender.send, *item)
+            except Exception as e: # a broken link only takes down its own commands
+                self.errors += 1
+                self.last_error = repr(e)
+            elapsed = time.perf_counter() - start
+            self.send_s_total += elapsed
+            self.send_s_max = max(self.send_s_max, elapsed)
+            # pace the link; samples arriving meanwhile replace each other in the queue
+            await asyncio.sleep(self.interval)
+
+    async def stop(self):
+        import tobii_research as tr
+        # unsubscribe can join the tracker's delivery thread, keep it off the loop
+        await asyncio.to_thread(self.tracker.unsubscribe_from, tr.EYETRACKER_GAZE_DATA, self.callback)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        # waits for a send stuck on the link, keep it off the loop too
+        await asyncio.to_thread(self.executor.shutdown, True)
+        tracer = self.sender.tracer
+        if tracer is not None:
+            tracer.flush()
+            if self.trace: # the periodic dump misses whatever came after the last interval
+                await asyncio.to_thread(tracer.dump, self.trace)
+        await asyncio.to_thread(self.car.close) # a CarLink sends what is still queued first
+
+    def stats(self):
+        done = self.sender.sent + self.sender.dropped + self.sender.held + self.errors
+        return {
+            'received': self.received,
+            'coalesced': self.coalesced,
+            'sent': self.sender.sent,
+            'dropped': self.sender.dropped,
+            'held': self.sender.held,
+            'gestures': self.sender.gestures,
+            'errors': self.errors,
+            'send_ms_avg': round(self.send_s_total / done * 1000, 3) if done else 0.0,
+            'send_ms_max': round(self.send_s_max * 1000, 3),
+            'last_error': self.last_error,
+            'link': self.car.metrics() if hasattr(self.car, 'metrics') else None,
+        }
+
+def _tobii_clock():
+    import tobii_research as tr
+    return tr.get_system_time_stamp
+
+async def build_rigs(settings, simulate=None):
+    """Finds the trackers, opens the cars (concurrently, in threads) and builds a Rig per config entry that has both."""
+    from eye_tracking import CarSender, power_for_user
+    from latency_trace import LatencyTracer
+
+    if simulate is None:
+        simulate = os.environ.get('OPTICARS_SIMULATE')
+    trackers = await asyncio.to_thread(find_trackers, [rig['tracker'] for rig in settings], simulate)
+    usable = []
+    for rig in settings:
+        if rig['tracker'] in trackers:
+            usable.append(rig)
+        else:
+            print(f"{rig['name']}: tracker {rig['tracker']} not found, skipping")
+
+    cars = await asyncio.gather(*(asyncio.to_thread(open_car, rig['port'], rig['baud'], simulate) for rig in usable),
+                                return_exceptions=True)
+    clock = None
+    if simulate:
+        from sim_tracker import system_time_stamp
+        clock = system_time_stamp
+
+    rigs = []
+    for rig, car in zip(usable, cars):
+        if isinstance(car, Exception):
+            print(f"{rig['name']}: can't open {rig['port']} ({car}), skipping")
+            continue
+        tracer = LatencyTracer(rig['trace']) if rig['trace'] else None
+        sender = CarSender(None, car, min_interval=rig['interval'], binary=rig['binary'], verbose=False, tracer=tracer,
+                           gaze_filter=rig['filter'], detector=rig['detector'], history=GazeRingBuffer(),
+                           power=power_for_user(rig['user']), gesture=rig['gesture'])
+        rigs.append(Rig(rig['name'], trackers[rig['tracker']], car, sender, rig['interval'], clock, trace=rig['trace']))
+    return rigs
+
+'''
+    @brief Runs rigs until cancelled (or for seconds), printing per-rig stats every stats_interval.
+
+    @param rigs List of Rig.
+    @param seconds How long to run, None for until cancelled / Ctrl-C.
+    @param stats_interval Seconds between stats lines, None for none.
+
+    @return {rig name: stats} at the end.
+'''
+async def run_rigs(rigs, seconds=None, stats_interval=10.0):
+    for rig in rigs:
+        await rig.start()
+    start = time.monotonic()
+    try:
+        while seconds is None or time.monotonic() - start < seconds:
+            wait = stats_interval or 1.0
+            if seconds is not None:
+                wait = min(wait, seconds - (time.monotonic() - start))
+            await asyncio.sleep(max(wait, 0))
+            if stats_interval:
+                for rig in rigs:
+                    print(f"{rig.name}: {rig.stats()}")
+    finally:
+        await asyncio.gather(*(rig.stop() for rig in rigs), return_exceptions=True)
+    return {rig.name: rig.stats() for rig in rigs}
+
+################################################
+# MAIN METHOD
+################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('config', help='rigs json config')
+    parser.add_argument('--seconds', type=float, default=None, help='how long to run (default: until Ctrl-C)')
+    parser.add_argument('--stats-interval', type=float, default=10.0, help='seconds between per-rig stats lines')
+    args = parser.parse_args()
+
+    settings = load_config(args.config)
+
+    async def run():
+        rigs = await build_rigs(settings)
+        if not rigs:
+            print("no rig has both a tracker and a car")
+            return
+        final = await run_rigs(rigs, args.seconds, args.stats_interval)
+        for name, stats in final.items():
+            print(f"{name}: {stats}")
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass # run_rigs closed the ports on the way out
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+'''
+    session_reader.py
+    @file      session_reader.py
+    @brief     Memory-mapped random access to session files written by session_recorder.py
+
+    SessionReader maps the file read-only and only touches the chunks a query needs, so opening a
+    multi-hour recording and pulling ten seconds out of it reads a few chunks, not the file.
+
+    The index is sparse: one entry per chunk (file offset, first row, first and last device_time_stamp),
+    loaded from the footer, or rebuilt by walking the chunk headers when the recorder never wrote one.
+    A time query binary searches that index for the chunks, then the chunk's own device_time_stamp
+    column for the rows. That needs device_time_stamp to increase through the session, which it does
+    for a tracker (a looping sim_tracker replay starts over, so query those by rows()).
+
+    Results are GazeFrames. For raw chunks every column is a view straight into the memory map
+    (strided for downsampling), so nothing is copied until the data is used. zlib chunks are
+    decoded on first use and kept in a small LRU cache, and results come back as views of the decoded
+    chunk. A query spanning several chunks concatenates the pieces.
+
+    Usage: python session_reader.py <file.session> [--from S] [--to S] [--step N]
+           python session_reader.py --bench [--minutes M]   (writes a long raw session and times seeks into it)
+'''
+
+import argparse
+import collections
+import json
+import os
+import struct
+import time
+import zlib
+import numpy as np
+from gaze_frame import GazeFrame
+from session_recorder import MAGIC, CHUNK_MAGIC, END_MAGIC, CHUNK_HEADER, TRAILER, CODEC_RAW, decode_chunk, _padding
+
+class SessionFormatError(ValueError):
+    pass
+
+class SessionReader:
+    """
+    Args:
+    path: str, session file.
+    cache_chunks: int, decoded zlib chunks kept in memory.
+    verify: bool, check each chunk's crc32 when it is first read (costs a pass over the chunk).
+    """
+
+    def __init__(self, path, cache_chunks=8, verify=False):
+        self.path = path
+        self.verify = verify
+        self._buf = np.memmap(path, dtype=np.uint8, mode='r')
+        if len(self._buf) < len(MAGIC) + 4 or bytes(self._buf[:len(MAGIC)]) != MAGIC:
+            raise SessionFormatError(f"{path} is not a session file")
+        header_len = struct.unpack_from('<I', self._buf, len(MAGIC))[0]
+        start = len(MAGIC) + 4
+        self.header = json.loads(zlib.decompress(bytes(self._buf[start:start + header_len])))
+        self.columns = [tuple(column) for column in self.header['columns']]
+        self.label = self.header.get('label')
+        self.meta = self.header.get('meta', {})
+        self._data_start = start + header_len + _padding(start + header_len)
+
+        entries = self._read_footer()
+        self.recovered = entries is None # no footer: the recording was cut short
+        if entries is None:
+            entries = self._scan_chunks()
+        entries = np.array(entries, dtype=np.int64).reshape(-1, 4)
+        self.offsets = entries[:, 0]
+        self.chunk_rows = entries[:, 1]
+        self.t_first = entries[:, 2]
+        self.t_last = entries[:, 3]
+        self.row_start = np.concatenate([[0], np.cumsum(self.chunk_rows)]) # row_start[i]: first row of chunk i
+        self._cache = collections.OrderedDict()
+        self._cache_chunks = cache_chunks
+
+    ################################################
+    # INDEX
+    ################################################
+
+    def _read_footer(self):
+        if len(self._buf) < self._data_start + TRAILER.size:
+            return None
+        offset, length, end = TRAILER.unpack_from(self._buf, len(self._buf) - TRAILER.size)
+        if end != END_MAGIC or offset + length + TRAILER.size != len(self._buf):
+            return None
+        return json.loads(bytes(self._buf[offset:offset + length]))['chunks']
+
+    def _scan_chunks(self):
+        """Rebuilds the index from the chunk headers, stopping at the first incomplete or corrupt chunk."""
+        entries = []
+        offset, size = self._data_start, len(self._buf)
+        while offset + CHUNK_HEADER.size <= size:
+            magic, rows, length, crc, codec = CHUNK_HEADER.unpack_from(self._buf, offset)
+            end = offset + CHUNK_HEADER.size + length
+            if magic != CHUNK_MAGIC or end > size:
+                break
+            payload = self._buf[offset + CHUNK_HEADER.size:end]
+            if zlib.crc32(payload) != crc: # torn write at the end of a killed recording
+                break
+            stamps = decode_chunk(payload, rows, codec, self.columns)['device_time_stamp']
+            entries.append([offset, rows, int(stamps[0]), int(stamps[-1])])
+            offset = end + _padding(length)
+        return entries
+
+    def __len__(self):
+        return int(self.row_start[-1])
+
+    @property
+    def n_chunks(self):
+        return len(self.offsets)
+
+    def __repr__(self):
+        return f"SessionReader({self.path!r}, {len(self)} samples in {self.n_chunks} chunks, label={self.label!r})"
+
+    def close(self):
+        self._cache.clear()
+        self._buf = None # the map is released once no returned view refers to it
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    ################################################
+    # CHUNKS
+    ################################################
+
+    def chunk_columns(self, i):
+        """{name: array} for chunk i: views into the map for raw chunks, the cached decoded arrays otherwise."""
+        if i in self._cache:
+            self._cache.move_to_end(i)
+            return self._cache[i]
+        offset = int(self.offsets[i])
+        magic, rows, length, crc, codec = CHUNK_HEADER.unpack_from(self._buf, offset)
+        if magic != CHUNK_MAGIC or rows != self.chunk_rows[i]:
+            raise SessionFormatError(f"chunk {i} of {self.path} does not match the index")
+        payload = self._buf[offset + CHUNK_HEADER.size:offset + CHUNK_HEADER.size + length]
+        if self.verify and zlib.crc32(payload) != crc:
+            raise SessionFormatError(f"chunk {i} of {self.path} is corrupt")
+        columns = decode_chunk(payload, rows, codec, self.columns)
+        if codec != CODEC_RAW: # raw views are free to rebuild, only keep decoded chunks
+            self._cache[i] = columns
+            if len(self._cache) > self._cache_chunks:
+                self._cache.popitem(last=False)
+        return columns
+
+    def chunk(self, i):
+        return GazeFrame(self.chunk_columns(i))
+
+    def iter_chunks(self):
+        for i in range(self.n_chunks):
+            yield self.chunk(i)
+
+    ################################################
+    # QUERIES
+    ################################################
+
+    def rows(self, start=0, stop=None, step=1):
+        """Rows start:stop:step as a GazeFrame. Views into the map when they fall in one raw chunk."""
+        start, stop, step = slice(start, stop, step).indices(len(self))
+        if step <= 0:
+            raise ValueError("step must be positive")
+        if stop <= start:
+            return GazeFrame({name: np.empty(0, np.dtype(dtype)) for name, dtype in self.columns})
+        first = int(np.searchsorted(self.row_start, start, side='right')) - 1
+        last = int(np.searchsorted(self.row_start, stop - 1, side='right')) - 1
+        pieces = []
+        for i in range(first, last + 1):
+            base = int(self.row_start[i])
+            lo = max(start, base)
+            lo = start + -(-(lo - start) // step) * step # keep the stride's phase across chunks
+            hi = min(stop, int(self.row_start[i + 1]))
+            if lo < hi:
+                pieces.append({name: col[lo - base:hi - base:step] for name, col in self.chunk_columns(i).items()})
+        if len(pieces) == 1:
+            return GazeFrame(pieces[0])
+        return GazeFrame({name: np.concatenate([piece[name] for piece in pieces]) for name, dtype in self.columns})
+
+    def time_rows(self, t0, t1):
+        """(start, stop) rows with t0 <= device_time_stamp < t1 (microseconds)."""
+        first = int(np.searchsorted(self.t_last, t0, side='left')) # first chunk that reaches t0
+        if first == self.n_chunks:
+            return len(self), len(self)
+        stamps = self.chunk_columns(first)['device_time_stamp']
+        start = int(self.row_start[first]) + int(np.searchsorted(stamps, t0, side='left'))
+        last = int(np.searchsorted(self.t_first, t1, side='left')) - 1 # last chunk starting before t1
+        if last < first:
+            return start, start
+        stamps = self.chunk_columns(last)['device_time_stamp']
+        stop = int(self.row_start[last]) + int(np.searchsorted(stamps, t1, side='left'))
+        return start, max(start, stop)
+
+    def time_range(self, t0, t1, step=1):
+        """Samples with t0 <= device_time_stamp < t1 (microseconds), every step-th one."""
+        start, stop = self.time_rows(t0, t1)
+        return self.rows(start, stop, step)
+
+    def seconds(self, start_s, end_s=None, step=1):
+        """Samples from start_s to end_s seconds after the first one."""
+        if not self.n_chunks:
+            return self.rows(0, 0)
+        origin = int(self.t_first[0])
+        end = int(self.t_last[-1]) + 1 if end_s is None else origin + int(round(end_s * 1e6))
+        return self.time_range(origin + int(round(start_s * 1e6)), end, step)
+
+    def downsample(self, step):
+        """Every step-th sample of the whole session (copies once it spans more than one chunk)."""
+        return self.rows(0, len(self), step)
+
+    def duration(self):
+        """Seconds between the first and the last device_time_stamp."""
+        return (int(self.t_last[-1]) - int(self.t_first[0])) / 1e6 if self.n_chunks else 0.0
+
+################################################
+# MAIN METHOD
+################################################
+
+def _bench(minutes, path):
+    from sim_tracker import synthetic_frame
+    from session_recorder import SessionWriter
+    import resource
+    block = synthetic_frame(pattern='saccades', seconds=60, rate_hz=600)
+    if not os.path.exists(path):
+        with SessionWriter(path, 'bench', codec='raw') as writer:
+            step = len(block)
+            for m in range(int(minutes)):
+                block.columns['device_time_stamp'] += step * 1667 # keep the stamps increasing
+                block.columns['system_time_stamp'] += step * 1667
+                writer.write_frame(block)
+    del block
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    reader = SessionReader(path)
+    opened = time.perf_counter() - start
+    rng = np.random.default_rng(0)
+    offsets = rng.uniform(0, reader.duration() - 10, 200)
+    start = time.perf_counter()
+    for s in offsets:
+        frame = reader.seconds(s, s + 10)
+    seek = (time.perf_counter() - start) / len(offsets)
+    start = time.perf_counter()
+    total = sum(float(np.nansum(reader.seconds(s, s + 10)['left_gaze_point_on_display_area_x'])) for s in offsets[:20])
+    touched = (time.perf_counter() - start) / 20
+    print(f"{reader}: {os.path.getsize(path) / 2 ** 20:.0f} MiB, {reader.duration() / 60:.0f} min")
+    print(f"  open {opened * 1000:.1f} ms, 10 s query {seek * 1e6:.0f} us ({len(frame)} samples), "
+          f"reading a column of it {touched * 1e6:.0f} us")
+    requested = len(offsets) * len(frame) * sum(np.dtype(dtype).itemsize for name, dtype in reader.columns)
+    print(f"  max rss grew {(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) / 1024:.1f} MiB for "
+          f"{len(offsets)} random windows holding {requested / 2 ** 20:.1f} MiB of samples")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', nargs='?', help='session file')
+    parser.add_argument('--from', dest='start', type=float, default=0.0, help='seconds from the start')
+    parser.add_argument('--to', dest='end', type=float, default=None, help='seconds from the start')
+    parser.add_argument('--step', type=int, default=1, help='keep every step-th sample')
+    parser.add_argument('--bench', action='store_true', help='time seeks into a long synthetic session')
+    parser.add_argument('--minutes', type=float, default=60, help='length of the --bench session')
+    args = parser.parse_args()
+
+    if args.bench:
+        from utils import cache_path
+        _bench(args.minutes, args.path or cache_path('bench', f"bench_{int(args.minutes)}min.session"))
+        return
+    with SessionReader(args.path) as reader:
+        frame = reader.seconds(args.start, args.end, args.step)
+        print(f"{reader}{' (recovered, no footer)' if reader.recovered else ''}, {reader.duration():.1f} s")
+        print(frame.to_pandas().describe().T[['count', 'mean', 'min', 'max']])
+
+if __name__ == '__main__':
+    main()
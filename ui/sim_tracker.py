@@ -0,0 +1,316 @@
+'''
+    sim_tracker.py
+    @file      sim_tracker.py
+    @brief     Simulated eye tracker that replays recordings through the real callback pipeline
+
+    SimulatedEyeTracker has the same subscribe_to / unsubscribe_from surface as a tobii_research
+    EyeTracker and delivers gaze dictionaries from its own thread, like the SDK does. It can replay
+    sample_data/*.csv at the original device_time_stamp cadence, N times faster, or at a fixed rate,
+    so eye_tracking.py, build_dataset() and the benchmarks run without a physical tracker.
+
+    NullSerial stands in for the car's serial port and can emulate the 9600 baud link.
+
+    Usage: python sim_tracker.py [csv ...] [--speed N] [--rate HZ] [--seconds S]
+'''
+
+import argparse
+import glob
+import os
+import threading
+import time
+import numpy as np
+from gaze_csv import load_gaze_frame
+from gaze_frame import GazeFrame, GAZE_FIELDS, component_names
+
+EYETRACKER_GAZE_DATA = "gaze_data" # same value as tobii_research.EYETRACKER_GAZE_DATA
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sample_data')
+
+# nominal rig geometry for synthetic samples, in the tracker's user coordinate system (mm, tracker at the origin)
+SCREEN_MM = (530.0, 300.0) # display area width, height
+SCREEN_BOTTOM_MM = 20.0 # height of the display area's bottom edge above the tracker
+EYE_MM = (32.0, 200.0, 600.0) # right eye x (left eye is -x), eye height, distance from the screen
+
+def system_time_stamp():
+    """The simulator's stand-in for tr.get_system_time_stamp(), in microseconds."""
+    return time.perf_counter_ns() // 1000
+
+def frame_to_dicts(frame):
+    """Turns a GazeFrame back into the gaze dictionaries the SDK delivers with as_dictionary=True."""
+    n = len(frame)
+    dicts = [{} for _ in range(n)]
+    for key, kind, n_comp in GAZE_FIELDS:
+        names = component_names(key, n_comp)
+        if n_comp == 1:
+            values = frame[key].tolist()
+        else:
+            values = list(zip(*(frame[name].tolist() for name in names)))
+        for d, value in zip(dicts, values):
+            d[key] = value
+    return dicts
+
+def synthetic_frame(seconds=10.0, rate_hz=600, pattern='circle', period=4.0, seed=0, blink_every=None, blink_ms=150):
+    """
+    Builds a GazeFrame with a synthetic trajectory in display-area coordinates (0 to 1).
+
+    Args:
+    seconds: float, length of the trajectory.
+    rate_hz: float, sample rate.
+    pattern: 'circle' (smooth pursuit around the screen), 'saccades' (fixations joined by jumps)
+             or 'noise' (random points).
+    period: float, seconds per circle / between saccades.
+    seed: int, random seed for the noise and saccade targets.
+    blink_every: float, seconds between blinks (both eyes invalid for blink_ms). None for no blinks.
+    """
+    n = int(seconds * rate_hz)
+    rng = np.random.default_rng(seed)
+    t = np.arange(n) / rate_hz
+    if pattern == 'circle':
+        x = 0.5 + 0.35 * np.cos(2 * np.pi * t / period)
+        y = 0.5 + 0.35 * np.sin(2 * np.pi * t / period)
+    elif pattern == 'saccades':
+        targets = rng.uniform(0.1, 0.9, size=(int(seconds / period) + 1, 2))
+        idx = (t / period).astype(int)
+        x, y = targets[idx, 0], targets[idx, 1]
+    elif pattern == 'noise':
+        x, y = rng.uniform(0, 1, n), rng.uniform(0, 1, n)
+    else:
+        raise ValueError(f"unknown pattern {pattern}")
+    x = x + rng.normal(0, 0.003, n) # fixational jitter
+    y = y + rng.normal(0, 0.003, n)
+
+    frame = GazeFrame.empty(n, dtype=np.float64)
+    stamps = (t * 1e6).astype(np.int64)
+    frame['device_time_stamp'][:] = stamps
+    frame['system_time_stamp'][:] = stamps
+    blinking = np.zeros(n, dtype=bool)
+    if blink_every:
+        blinking = (t % blink_every) >= blink_every - blink_ms / 1000
+    for eye, offset, side in (('left', -0.005, -1), ('right', 0.005, 1)):
+        frame[f"{eye}_gaze_point_on_display_area_x"][:] = x + offset
+        frame[f"{eye}_gaze_point_on_display_area_y"][:] = y
+        frame[f"{eye}_gaze_point_in_user_coordinate_system_x"][:] = (x + offset - 0.5) * SCREEN_MM[0]
+        frame[f"{eye}_gaze_point_in_user_coordinate_system_y"][:] = SCREEN_BOTTOM_MM + (1 - y) * SCREEN_MM[1]
+        frame[f"{eye}_gaze_point_in_user_coordinate_system_z"][:] = 0.0
+        frame[f"{eye}_gaze_origin_in_user_coordinate_system_x"][:] = side * EYE_MM[0]
+        frame[f"{eye}_gaze_origin_in_user_coordinate_system_y"][:] = EYE_MM[1]
+        frame[f"{eye}_gaze_origin_in_user_coordinate_system_z"][:] = EYE_MM[2]
+        frame[f"{eye}_gaze_origin_in_trackbox_coordinate_system_x"][:] = 0.5 - side * 0.05
+        frame[f"{eye}_gaze_origin_in_trackbox_coordinate_system_y"][:] = 0.5
+        frame[f"{eye}_gaze_origin_in_trackbox_coordinate_system_z"][:] = 0.5
+        frame[f"{eye}_pupil_diameter"][:] = 3.5 + rng.normal(0, 0.05, n)
+        for field in ('gaze_point', 'pupil', 'gaze_origin'):
+            frame[f"{eye}_{field}_validity"][:] = ~blinking
+    for key, kind, n_comp in GAZE_FIELDS:
+        if kind == 'float':
+            for name in component_names(key, n_comp):
+                frame[name][blinking] = np.nan
+    return frame
+
+class SimulatedEyeTracker:
+    """
+    Drop-in stand-in for a tobii_research EyeTracker that replays GazeFrames on a background thread.
+
+    Args:
+    frames: list of GazeFrame to play back to back (see load_recordings / synthetic_frame).
+    speed: float, playback speed relative to the recorded device_time_stamp cadence. 0 means as fast as possible.
+    rate_hz: float, if given ignore the recorded timestamps and deliver at this fixed rate instead.
+    loop: bool, start over when the recordings run out.
+    serial_number: str, reported like the real tracker (used to match rigs to trackers).
+    restamp: bool, deliver a copy of each sample with system_time_stamp set to system_time_stamp()
+             at delivery, like the SDK stamping a fresh sample. False delivers the recorded dicts as is.
+    """
+
+    def __init__(self, frames, speed=1.0, rate_hz=None, loop=True, serial_number='SIM-0001', restamp=True):
+        self.samples = [d for frame in frames for d in frame_to_dicts(frame)]
+        self._stamps = [frame['device_time_stamp'] for frame in frames]
+        self.speed = speed
+        self.rate_hz = rate_hz
+        self.loop = loop
+        self.restamp = restamp
+        self.serial_number = serial_number
+        self.model = 'Simulated'
+        self.device_name = 'Simulated eye tracker'
+        self.delivered = 0
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def _delays(self):
+        # seconds to wait before each sample, from the device_time_stamp (microsecond) gaps within each recording
+        if self.rate_hz:
+            return [1.0 / self.rate_hz] * len(self.samples)
+        if self.speed == 0:
+            return [0.0] * len(self.samples)
+        delays = []
+        for stamps in self._stamps:
+            gaps = np.diff(stamps.astype(np.float64), prepend=stamps[:1]) / 1e6 / self.speed
+            gaps[0] = np.median(gaps[1:]) if len(gaps) > 1 else 0 # no gap between recordings
+            delays.extend(np.clip(gaps, 0, None).tolist())
+        return delays
+
+    ################################################
+    # TOBII EYETRACKER SURFACE
+    ################################################
+
+    def subscribe_to(self, stream, callback, as_dictionary=True):
+        if stream != EYETRACKER_GAZE_DATA:
+            raise ValueError(f"simulated tracker only streams {EYETRACKER_GAZE_DATA}")
+        if not as_dictionary:
+            raise ValueError("simulated tracker only delivers dictionaries")
+        with self._lock:
+            self._callbacks.append(callback)
+            if self._thread is None:
+                self._stop_event.clear()
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def unsubscribe_from(self, stream, callback=None):
+        with self._lock:
+            if callback is None:
+                self._callbacks.clear()
+            elif callback in self._callbacks:
+                self._callbacks.remove(callback)
+            thread = self._thread if not self._callbacks else None
+            if thread is not None:
+                self._thread = None
+                self._stop_event.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    ################################################
+    # PLAYBACK
+    ################################################
+
+    def _run(self):
+        delays = self._delays()
+        if not self.samples:
+            return
+        # deadline based pacing so per-sample overhead doesn't accumulate into drift
+        next_time = time.perf_counter()
+        i = 0
+        while not self._stop_event.is_set():
+            if i == len(self.samples):
+                if not self.loop:
+                    break
+                i = 0
+            next_time += delays[i]
+            wait = next_time - time.perf_counter()
+            if wait > 0.01:
+                self._stop_event.wait(wait)
+            elif wait > 0:
+                time.sleep(wait) # finer grained than Event.wait, needed for 600 Hz+
+            elif wait < -0.25:
+                next_time = time.perf_counter() # fell far behind (callback too slow), don't burst to catch up
+
+            sample = self.samples[i]
+            if self.restamp:
+                sample = dict(sample, system_time_stamp=system_time_stamp())
+            for callback in tuple(self._callbacks):
+                callback(sample)
+            self.delivered += 1
+            i += 1
+
+def load_recordings(paths=None):
+    """Loads csv recordings (default: everything in sample_data/) as float64 GazeFrames."""
+    if paths is None:
+        paths = sorted(glob.glob(os.path.join(SAMPLE_DIR, '*.csv')))
+    return [load_gaze_frame(path, dtype=np.float64) for path in paths]
+
+def get_simulated_tracker(paths=None, speed=1.0, rate_hz=None, synthetic=None, **kwargs):
+    """
+    Convenience constructor: replays recordings (default sample_data/), or a synthetic
+    trajectory if synthetic is a pattern name ('circle', 'saccades', 'noise').
+    """
+    if synthetic:
+        frames = [synthetic_frame(pattern=synthetic, rate_hz=rate_hz or 600)]
+    else:
+        frames = load_recordings(paths)
+    return SimulatedEyeTracker(frames, speed=speed, rate_hz=rate_hz, **kwargs)
+
+class NullSerial:
+    """
+    Stand-in for serial.Serial that swallows writes. With emulate_baud set, flush() blocks for as
+    long as the bytes written since the last flush would take on a real link (10 bits per byte).
+    """
+
+    def __init__(self, port='SIM', baudrate=9600, emulate_baud=False):
+        self.port = port
+        self.baudrate = baudrate
+        self.emulate_baud = emulate_baud
+        self.is_open = True
+        self.bytes_written = 0
+        self.writes = 0
+        self._pending = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        self.writes += 1
+        self._pending += len(data)
+        return len(data)
+
+    def flush(self):
+        if self.emulate_baud and self._pending:
+            time.sleep(self._pending * 10 / self.baudrate)
+        self._pending = 0
+
+    def close(self):
+        self.is_open = False
+
+################################################
+# MAIN METHOD
+################################################
+
+'''
+    @brief Replays recordings through the eye_tracking callback -> CarSender -> serial path and prints its counters.
+'''
+def main():
+    import eye_tracking
+    from latency_trace import LatencyTracer
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='*', help='csv recordings to replay (default: sample_data/)')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 0 = as fast as possible')
+    parser.add_argument('--rate', type=float, default=None, help='fixed delivery rate in Hz instead of recorded timing')
+    parser.add_argument('--synthetic', default=None, help="synthetic trajectory instead of recordings: circle, saccades, noise")
+    parser.add_argument('--seconds', type=float, default=5.0, help='how long to run')
+    parser.add_argument('--interval', type=float, default=0.0, help='CarSender min_interval')
+    parser.add_argument('--filter', default=None, help="gaze filter: ema, median, one_euro or a json config")
+    parser.add_argument('--detector', default=None, help="skip saccades / blinks: ivt or idt")
+    parser.add_argument('--dwell', type=float, default=0.0, help='ms the gaze must stay in a region before it is published')
+    parser.add_argument('--link', action='store_true', help='write through a car_link.CarLink instead of straight to the port')
+    args = parser.parse_args()
+
+    tracker = get_simulated_tracker(args.paths or None, speed=args.speed, rate_hz=args.rate, synthetic=args.synthetic)
+    port = car = NullSerial(emulate_baud=True)
+    if args.link:
+        from car_link import CarLink
+        car = CarLink('SIM', port.baudrate, opener=lambda: port, connect_delay=0)
+    tracer = LatencyTracer()
+    eye_tracking.system_clock = system_time_stamp
+    eye_tracking.sender = eye_tracking.CarSender(eye_tracking.mailbox, car, min_interval=args.interval, verbose=False, tracer=tracer,
+                                                 gaze_filter=args.filter, detector=args.detector)
+    eye_tracking.sender.start()
+    eye_tracking.publisher = eye_tracking.RegionPublisher(eye_tracking.region_mailbox, dwell_ms=args.dwell)
+    eye_tracking.publisher.start()
+
+    tracker.subscribe_to(EYETRACKER_GAZE_DATA, eye_tracking.gaze_data_callback, as_dictionary=True)
+    time.sleep(args.seconds)
+    tracker.unsubscribe_from(EYETRACKER_GAZE_DATA, eye_tracking.gaze_data_callback)
+    eye_tracking.sender.stop()
+    eye_tracking.publisher.stop()
+    eye_tracking.sender.join()
+    eye_tracking.publisher.join()
+
+    stats = eye_tracking.stats()
+    print(f"delivered {tracker.delivered} samples in {args.seconds:.1f} s ({tracker.delivered / args.seconds:.0f} Hz)")
+    print(f"pipeline: {stats}, {eye_tracking.publisher.processed} samples through gaze_id")
+    print(f"serial: {port.bytes_written} bytes in {port.writes} writes")
+    if args.link:
+        car.close()
+        print(f"link: {car.metrics()}")
+    tracer.flush()
+    print(tracer.report())
+
+if __name__ == '__main__':
+    main()
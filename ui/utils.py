@@ -1,13 +1,60 @@
+import os
 import time 
 import tobii_research as tr
 import pandas as pd
-import math
 import ast
 import threading
 import numpy as np
+from gaze_frame import GazeFrame, GazeSample
+from gaze_subscription import lock, GazeRingBuffer, GazeSubscription, subscribe, unsubscribe, close_subscriptions
+from gaze_csv import read_gaze_csv
+from gaze_regions import DEFAULT_GRID, DEFAULT_POWER_CELLS, DEFAULT_POWER, power_table
 
-global_gaze_data = None
-lock = threading.Lock()
+class LatestMailbox:
+    """
+    Single-slot "latest value" handoff between the tracker SDK thread and a consumer thread.
+    put() never waits on the consumer: it overwrites whatever is still unread (counted in coalesced).
+    get() waits for and takes the newest item.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._item = None
+        self._full = False
+        self.closed = False
+        self.received = 0 # items put
+        self.coalesced = 0 # items overwritten before anyone took them
+
+    def put(self, item):
+        with self._cond:
+            if self._full:
+                self.coalesced += 1
+            self._item = item
+            self._full = True
+            self.received += 1
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Returns the newest item, or None if nothing arrives within timeout or the mailbox is closed."""
+        with self._cond:
+            if not self._full and not self.closed:
+                self._cond.wait(timeout)
+            if not self._full:
+                return None
+            item = self._item
+            self._item = None
+            self._full = False
+            return item
+
+    @property
+    def pending(self):
+        """1 while an item waits to be taken, else 0 (read without the lock, for metrics)."""
+        return 1 if self._full else 0
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
 
 def combine_dicts_with_labels(dict_list):
     combined_dict = {}
@@ -17,41 +64,45 @@ def combine_dicts_with_labels(dict_list):
 
     return combined_dict
 
-def gaze_data_callback(gaze_data):
-  global global_gaze_data
-  with lock:
-    global_gaze_data = gaze_data
-  
-def gaze_data(eyetracker, wait_time=5):
-  global global_gaze_data
-  
-  eyetracker.subscribe_to(tr.EYETRACKER_GAZE_DATA, gaze_data_callback, as_dictionary=True)
-
-  time.sleep(wait_time)
-  
-  eyetracker.unsubscribe_from(tr.EYETRACKER_GAZE_DATA, gaze_data_callback)
-
-  return global_gaze_data
-
+# gaze_data returns the newest sample after wait_time seconds
+# - keep=False unsubscribes afterwards; by default the subscription stays up for the next call (unsubscribe() ends it)
+def gaze_data(eyetracker, wait_time=5, keep=True):
+    sub = subscribe(eyetracker)
+    try:
+        time.sleep(wait_time)
+        return sub.latest()
+    finally:
+        if not keep:
+            unsubscribe(eyetracker)
+
+# build_dataset records gaze data for tot_time_min minutes and returns it labeled
+# - as_frame=True returns a columnar GazeFrame instead of the tuple-column dataframe
+# - keep=False unsubscribes when the recording is done, like gaze_data
 def build_dataset(tracker, label, add_on = False, df_orig = pd.DataFrame(), 
-                  time_step_sec = 0.5, tot_time_min = 0.1):
+                  time_step_sec = 0.5, tot_time_min = 0.1, as_frame = False, keep = True):
     
-    global global_gaze_data
-    
-    intervals = math.ceil((tot_time_min * 60) / time_step_sec)
+    sub = subscribe(tracker)
+    cursor = sub.cursor
+    deadline = time.monotonic() + tot_time_min * 60
     dict_list = []
     
-    for _ in range(intervals):
-        data = gaze_data(tracker, time_step_sec)
-        # print(data)
-        dict_list.append(data)
+    # drain the ring buffer every time_step_sec so every sample the tracker produced is kept
+    try:
+        while time.monotonic() < deadline:
+            time.sleep(min(time_step_sec, max(0, deadline - time.monotonic())))
+            samples, cursor = sub.since(cursor)
+            dict_list.extend(samples)
+    finally:
+        if not keep:
+            unsubscribe(tracker)
         
-    # print(data)
-    
-    tot_dict = combine_dicts_with_labels(dict_list)
-    index = range(intervals)
+    if as_frame:
+        frame = GazeFrame.from_dicts(dict_list)
+        frame.extras['type'] = np.full(len(frame), label, dtype=object)
+        return frame, dict_list
 
-    df = pd.DataFrame(tot_dict, index=index).T
+    # float64 keeps the tuples identical to what the tracker delivered
+    df = GazeFrame.from_dicts(dict_list, dtype=np.float64).to_pandas(tuples=True)
     df['type'] = label
         
     if add_on:
@@ -62,8 +113,33 @@ def build_dataset(tracker, label, add_on = False, df_orig = pd.DataFrame(),
     else:
         return df, dict_list
     
+# preprocess_sample is preprocess_gaze for a GazeSample: same eye fallback and translation, written into
+# the sample's reused gazexy tuple, which it returns
+def preprocess_sample(sample):
+    if sample.right_validity == 0:
+        lx = rx = sample.left_px
+        ly = ry = sample.left_py
+    elif sample.left_validity == 0:
+        lx = rx = sample.right_px
+        ly = ry = sample.right_py
+    elif sample.left_validity == 1 and sample.right_validity == 1:
+        lx = sample.left_px
+        ly = sample.left_py
+        rx = sample.right_px
+        ry = sample.right_py
+    else:
+        return "o1"
+    left_x, left_y, right_x, right_y = xy = sample.xy
+    left_x[0] = translate2ScreenX(lx)
+    left_y[0] = translate2ScreenY(ly)
+    right_x[0] = translate2ScreenX(rx)
+    right_y[0] = translate2ScreenY(ry)
+    return xy
+
 # gaze id takes in an x and y coordinate and returns the id that should be highlighted
 def preprocess_gaze(dataframe):
+    if type(dataframe) is GazeSample:
+        return preprocess_sample(dataframe)
     #if right eye is invalid, use left eye data
     if dataframe['right_gaze_point_validity'] == 0:
         left_gp = dataframe['left_gaze_point_on_display_area']
@@ -77,7 +153,6 @@ def preprocess_gaze(dataframe):
         left_gp = dataframe['left_gaze_point_on_display_area']
         right_gp = dataframe['right_gaze_point_on_display_area']
     else:
-        print('ouch!')
         return "o1" 
         # returns now so it wont be overwritten later
 
@@ -106,7 +181,6 @@ def preprocess_gaze(dataframe):
 def gaze_id(gazexy):
     
     left_x_values, left_y_values, right_x_values, right_y_values = gazexy
-    
     gx = (left_x_values[0] + right_x_values[0])/2
     gy = (left_y_values[0] + right_y_values[0])/2 
     
@@ -115,26 +189,8 @@ def gaze_id(gazexy):
     if gy > 2:
         gy = 2
     
-    element = "o"
-    
-    if (gx < -0.4 and gy > .35):
-        element += "1"
-    elif (gx < .2 and gy > .35):
-        element += "2"
-    elif (gx >= .2 and gy > .35):
-        element += "3"
-    elif (gx < -0.4 and gy > -.25):
-        element += "4"
-    elif (gx < .2 and gy > -.25):
-        element += "5"
-    elif (gx >= .2 and gy > -.25):
-        element += "6"
-    elif (gx < -0.4 and gy <= -.25):
-        element += "7"
-    elif (gx < .2 and gy <= -.25):
-        element += "8"
-    elif (gx >= .2 and gy <= -.25):
-        element += "9"
+    # o1 - o9 from the grid in gaze_regions.py, "o" if the gaze is nan
+    element = DEFAULT_GRID.classify(gx, gy)
     # print(element)
 
     return element
@@ -178,24 +234,8 @@ def build_dataset_from_csv(file_path, label):
     returns: dataframe with data from csv file
     '''
 
-    # all the columns that are tuples
-    # TODO: compute programmatically
-    tuples = ['left_gaze_point_on_display_area',
-    'left_gaze_point_in_user_coordinate_system',
-    'left_gaze_origin_in_user_coordinate_system',
-    'left_gaze_origin_in_trackbox_coordinate_system',
-    'right_gaze_point_on_display_area',
-    'right_gaze_point_in_user_coordinate_system',
-    'right_gaze_origin_in_user_coordinate_system',
-    'right_gaze_origin_in_trackbox_coordinate_system']
-
-    #converters = {key: safe_tuple_eval for key in tuples}
-    converters = {key: lambda s: safe_tuple_eval(s, default_value=None) for key in tuples}
-    # converters = {key: lambda s: safe_tuple_eval(s, default_value=(0, 0)) for key in tuples}
-    
-    df = pd.read_csv(file_path, converters=converters)
-    #df = pd.read_csv(file_path, converters={key: ast.literal_eval for key in tuples})
-    df['type'] = label
+    # tuple columns are found and parsed by gaze_csv instead of ast.literal_eval per cell
+    df = read_gaze_csv(file_path, label, split=False)
     df['left_pupil_diameter'].fillna("None", inplace=True)
     df['right_pupil_diameter'].fillna("None", inplace=True)
     #df = df.applymap(lambda x: None if pd.isna(x) else x)
@@ -254,47 +294,30 @@ def calculatePower_new(gazexy):
     if abs(rightMagnitude) > 2.0:
         rightMagnitude /= abs(rightMagnitude)
         
+_power_new2_lookup = DEFAULT_GRID.compile(DEFAULT_POWER_CELLS, (np.nan, np.nan))
+
 def calculatePower_new2(gazexy):
     left_x, left_y, right_x, right_y = gazexy
     
     gx = (left_x[0] + right_x[0])/2
     gy = (left_y[0] + right_y[0])/2
         
-    if (gx < -0.4 and gy > .35):
-        left = 1.2
-        right = 2.0
-    elif (gx < .2 and gy > .35):
-        left = 2.0
-        right = 2.0
-    elif (gx >= .2 and gy > .35):
-        left = 2.0
-        right = 1.2
-    elif (gx < -0.4 and gy > -.25):
-        left = 1.0
-        right = 2.0
-    elif (gx < .2 and gy > -.25):
-        left = 1.0
-        right = 1.0
-    elif (gx >= .2 and gy > -.25):
-        left = 2.0
-        right = 1.0
-    elif (gx < -0.4 and gy <= -.25):
-        left = 1.2
-        right = 0.2
-    elif (gx < .2 and gy <= -.25):
-        left = 0.0
-        right = 0.0
-    elif (gx >= .2 and gy <= -.25):
-        left = 0.2
-        right = 1.2
-    
-    return left, right
+    # discrete power per region of DEFAULT_GRID as a (left, right) tuple, nan when the gaze is nan
+    return _power_new2_lookup(gx, gy)
+
+# fixed range rescale_item has always used: (x_min, x_max, y_min, y_max)
+DEFAULT_BOUNDS = (-1.2, 1.2, -1.2, 1.2)
+
+def power_bounds(profile=None):
+    """Gaze range to rescale with: the calibration profile's (calibration.CalibrationProfile) or DEFAULT_BOUNDS."""
+    return DEFAULT_BOUNDS if profile is None else profile.bounds()
 
-def calculatePower_new3(gazexy):
+def calculatePower_new3(gazexy, profile=None):
     left_x, left_y, right_x, right_y = gazexy
+    x_min, x_max, y_min, y_max = power_bounds(profile)
     
-    left_x, right_x = rescale_item((left_x[0], right_x[0]), -1.2, 1.2) 
-    left_y, right_y = rescale_item_2((left_y[0] * -1, right_y[0] * -1), -1.2, 1.2) # -1.2
+    left_x, right_x = rescale_item((left_x[0], right_x[0]), x_min, x_max) 
+    left_y, right_y = rescale_item_2((left_y[0] * -1, right_y[0] * -1), -y_max, -y_min) # y is flipped
 
     x = (left_x + right_x) / 2
     y = (left_y + right_y) / 2 # 0.9 * 
@@ -310,6 +333,99 @@ def calculatePower_new3(gazexy):
         
     # return np.round(leftMagnitude, 1), np.round(rightMagnitude, 1)
 
+################################################
+# BATCH VERSIONS (whole recordings at once)
+################################################
+
+# the *_batch functions below follow the same steps as their scalar versions with numpy arrays,
+# so the results are bit-for-bit identical when the frame holds float64
+# (GazeFrame.from_pandas(df, dtype=np.float64) or gaze_csv.load_gaze_frame(path, dtype=np.float64))
+
+def rescale_array(values, min_value=-1.2, max_value=1.2):
+    """Array version of rescale_item: clamps to [min_value, max_value] and rescales to -1 to 1."""
+    values = np.clip(values, min_value, max_value)
+    return 2 * (values - min_value) / (max_value - min_value) - 1
+
+def rescale_array_2(values, min_value=-1.2, max_value=1.2):
+    """Array version of rescale_item_2: clamps to [min_value, max_value] and rescales to 0 to 2."""
+    values = np.clip(values, min_value, max_value)
+    return 2 * ((values - min_value) / (max_value - min_value))
+
+def preprocess_gaze_batch(frame):
+    """
+    preprocess_gaze for every row of a GazeFrame, with the same validity fallback:
+    right eye invalid -> use the left eye for both, left eye invalid -> use the right eye for both.
+
+    Returns:
+    (left_x, left_y, right_x, right_y) screen coordinate arrays, and a boolean array that is False
+    for rows preprocess_gaze rejects (the 'ouch!' branch). Those rows hold nan.
+    """
+    left_valid = frame['left_gaze_point_validity']
+    right_valid = frame['right_gaze_point_validity']
+    left_only = right_valid == 0
+    right_only = ~left_only & (left_valid == 0)
+    ok = left_only | right_only | ((left_valid == 1) & (right_valid == 1))
+
+    left_x, left_y = frame.display_xy('left')
+    right_x, right_y = frame.display_xy('right')
+    gazexy = (np.where(right_only, right_x, left_x),
+              np.where(right_only, right_y, left_y),
+              np.where(left_only, left_x, right_x),
+              np.where(left_only, left_y, right_y))
+    gazexy = tuple(np.where(ok, values, np.nan) for values in gazexy)
+    return gazexy, ok
+
+def gaze_id_batch(gazexy, ok=None):
+    """
+    gaze_id for every row. Rows with ok False get "o1" like preprocess_gaze's fallback,
+    rows whose coordinates are nan get "o" like the scalar chain falling through.
+    """
+    left_x, left_y, right_x, right_y = gazexy
+
+    gx = (left_x + right_x)/2
+    gy = (left_y + right_y)/2
+    gx = np.where(gx > 2, 2, gx)
+    gy = np.where(gy > 2, 2, gy)
+
+    elements = DEFAULT_GRID.classify_batch(gx, gy)
+    if ok is not None:
+        elements = np.where(ok, elements, "o1")
+    return elements
+
+def calculatePower_new3_batch(gazexy, profile=None):
+    """calculatePower_new3 for every row. Returns (left, right) motor power arrays, nan where gazexy is nan."""
+    left_x, left_y, right_x, right_y = gazexy
+    x_min, x_max, y_min, y_max = power_bounds(profile)
+
+    left_x, right_x = rescale_array(left_x, x_min, x_max), rescale_array(right_x, x_min, x_max)
+    left_y, right_y = rescale_array_2(left_y * -1, -y_max, -y_min), rescale_array_2(right_y * -1, -y_max, -y_min)
+
+    x = (left_x + right_x) / 2
+    y = (left_y + right_y) / 2
+
+    R = 1 - abs(y - 1) # the radius of the imaginary circle
+
+    left = y + R * np.sin(x * np.pi / 2) # the speed of left motor
+    right = y - R * np.sin(x * np.pi / 2) # the speed of right motor
+
+    return left, right
+
+_power_new2_table = power_table(DEFAULT_GRID, DEFAULT_POWER)
+
+def calculatePower_new2_batch(gazexy):
+    """calculatePower_new2 for every row. Returns (left, right) motor power arrays, nan where gazexy is nan."""
+    left_x, left_y, right_x, right_y = gazexy
+    index = DEFAULT_GRID.index_batch((left_x + right_x)/2, (left_y + right_y)/2)
+    power = _power_new2_table[index]
+    return power[:, 0], power[:, 1]
+
+# replay_gaze runs a whole recording through the control path and returns what the car and ui would have received:
+# region ids, left and right motor power, and the validity mask from preprocess_gaze_batch
+def replay_gaze(frame):
+    gazexy, ok = preprocess_gaze_batch(frame)
+    left, right = calculatePower_new3_batch(gazexy)
+    return gaze_id_batch(gazexy, ok), left, right, ok
+
 def calculatePowerold(dataframe):
     left_x, left_y, right_x, right_y = parse_gaze_data(dataframe)
 
@@ -345,6 +461,9 @@ def translate2ScreenY(ycoord):
 # gaze_detection takes in a dataframe and column name and returns x and y coordinates
 # - column_name must be left eye or right eye data values
 def gaze_detection(dataframe, column_name):
+    if isinstance(dataframe, GazeFrame):
+        return dataframe[column_name + '_x'], dataframe[column_name + '_y']
+
     # extract x and y coordinates from the specified column
     x_values = [point[0] for point in dataframe[column_name]]
     y_values = [point[1] for point in dataframe[column_name]]
@@ -356,7 +475,24 @@ def gaze_detection(dataframe, column_name):
     # return an id from 01 to 09
     return x_values, y_values
 
-def get_tracker():
+# cache_path returns a path under the opticars cache directory ($OPTICARS_CACHE, default ~/.cache/opticars),
+# creating the directory. Used for compiled power tables and other derived data that is safe to delete.
+def cache_path(*parts):
+    root = os.environ.get('OPTICARS_CACHE') or os.path.join(os.path.expanduser('~'), '.cache', 'opticars')
+    path = os.path.join(root, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+# get_tracker returns the first eye tracker found
+# - simulate (or the OPTICARS_SIMULATE environment variable) returns a SimulatedEyeTracker replaying
+#   sample_data/ instead, at that speed factor (e.g. "1" for real time, "10" for 10x, "0" for flat out)
+def get_tracker(simulate=None):
+  if simulate is None:
+    simulate = os.environ.get('OPTICARS_SIMULATE')
+  if simulate:
+    from sim_tracker import get_simulated_tracker
+    return get_simulated_tracker(speed=float(simulate))
+
   all_eyetrackers = tr.find_all_eyetrackers()
 
   for tracker in all_eyetrackers:
@@ -367,6 +503,11 @@ def get_tracker():
     return tracker
 
 def parse_gaze_data(dataframe):
+    if isinstance(dataframe, GazeFrame):
+        left_x, left_y = dataframe.display_xy('left')
+        right_x, right_y = dataframe.display_xy('right')
+        return left_x.mean(), left_y.mean(), right_x.mean(), right_y.mean()
+
      # extract x and y coordinates from the specified column
     left_x_values = [point[0] for point in dataframe['left_gaze_point_on_display_area']]
     left_y_values = [point[1] for point in dataframe['left_gaze_point_on_display_area']]
@@ -1,12 +1,13 @@
+import os
+import sys
 import time 
 import tobii_research as tr
 import pandas as pd
-import math
 import ast
-import threading
 
-global_gaze_data = None
-lock = threading.Lock()
+# the gaze subscription and its ring buffer are shared with the ui/ scripts, see ui/gaze_subscription.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ui'))
+from gaze_subscription import lock, GazeRingBuffer, GazeSubscription, subscribe, unsubscribe, close_subscriptions
 
 def combine_dicts_with_labels(dict_list):
     combined_dict = {}
@@ -16,45 +17,42 @@ def combine_dicts_with_labels(dict_list):
 
     return combined_dict
 
-def gaze_data_callback(gaze_data):
-  global global_gaze_data
-  with lock:
-    global_gaze_data = gaze_data
-  
-def gaze_data(eyetracker, wait_time=5):
-  global global_gaze_data
-  
-  with lock:
-    eyetracker.subscribe_to(tr.EYETRACKER_GAZE_DATA, gaze_data_callback, as_dictionary=True)
-
-  time.sleep(wait_time)
-  
-  with lock:
-    eyetracker.unsubscribe_from(tr.EYETRACKER_GAZE_DATA, gaze_data_callback)
-
-  return global_gaze_data
-
+# gaze_data returns the newest sample after wait_time seconds
+# - keep=False unsubscribes afterwards; by default the subscription stays up for the next call (unsubscribe() ends it)
+def gaze_data(eyetracker, wait_time=5, keep=True):
+    sub = subscribe(eyetracker)
+    try:
+        time.sleep(wait_time)
+        return sub.latest()
+    finally:
+        if not keep:
+            unsubscribe(eyetracker)
+
+# build_dataset records gaze data for tot_time_min minutes and returns it labeled
+# - keep=False unsubscribes when the recording is done, like gaze_data
 def build_dataset(tracker, label, add_on = False, df_orig = pd.DataFrame(), 
-                  time_step_sec = 0, tot_time_min = 0.1):
+                  time_step_sec = 0.5, tot_time_min = 0.1, keep = True):
     
-    global global_gaze_data
-    
-    intervals = math.ceil((tot_time_min * 60) / time_step_sec)
+    sub = subscribe(tracker)
+    cursor = sub.cursor
+    deadline = time.monotonic() + tot_time_min * 60
     dict_list = []
     
-    for _ in range(intervals):
-        data = gaze_data(tracker, time_step_sec)
-        # print(data)
-        dict_list.append(data)
-    
-    print(data)
+    # drain the ring buffer every time_step_sec so every sample the tracker produced is kept
+    try:
+        while time.monotonic() < deadline:
+            time.sleep(min(time_step_sec, max(0, deadline - time.monotonic())))
+            samples, cursor = sub.since(cursor)
+            dict_list.extend(samples)
+    finally:
+        if not keep:
+            unsubscribe(tracker)
     
     tot_dict = combine_dicts_with_labels(dict_list)
     df = pd.DataFrame(tot_dict).T
     df['type'] = label
     
-    index = range(intervals)
-    df.index = index
+    df.index = range(len(dict_list))
         
     if add_on:
         df_new = pd.concat([df_orig, df])